@@ -0,0 +1,205 @@
+'''JSON API under ``/api/v1``.
+
+Lets clients update part of a page (a like button, a feed page, a few user
+cards) without a full page load and redirect:
+
+* ``GET /timeline`` and ``GET /users/<id>/messages``: newest-first pages of
+  messages, with ``?after=<cursor>`` and ``?limit=`` up to ``FEED_PAGE_SIZE``
+* ``GET /users?ids=1,2`` and ``GET /messages?ids=1,2``: batch lookups of up to
+  ``API_MAX_IDS`` rows, in the order asked for; missing ids are left out
+* ``PUT`` / ``DELETE /messages/<id>/like``: idempotent like and unlike,
+  answering with the new state only
+
+Message ids are 64-bit (see messageids.py), more than a JavaScript number holds
+exactly, so they are sent as strings; ids in requests may be either.
+
+Rows are read as column projections (``USER_COLUMNS`` and ``MESSAGE_COLUMNS``)
+and serialized straight from the result rows, so no ORM objects are built and
+no relationships are walked. Viewer-specific flags (``liked``, ``following``)
+are added for the logged-in user with one extra query, or the follow graph.
+
+The API uses the session cookie of the site. Browsers preflight cross-site
+``PUT`` and ``DELETE`` requests, so the write endpoints cannot be driven by
+another site's form.
+'''
+
+from flask import Blueprint, abort, current_app, g, jsonify, request
+from sqlalchemy import select
+from werkzeug.exceptions import HTTPException
+from models import db, Message, User
+from pagination import decode_message_cursor, make_page, message_key, messages_before
+from followgraph import follow_graph
+from httpcache import not_modified
+from likes import like_message, likeable_message, liked_ids, unlike_message
+import timeline
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+USER_COLUMNS = (
+    User.id,
+    User.username,
+    User.image_url,
+    User.header_image_url,
+    User.bio,
+    User.location,
+    User.messages_count,
+    User.following_count,
+    User.followers_count,
+    User.likes_count,
+)
+
+MESSAGE_COLUMNS = (
+    Message.id,
+    Message.text,
+    Message.timestamp,
+    Message.likes_count,
+    Message.user_id,
+    User.username,
+    User.image_url,
+)
+
+
+def message_json(row):
+    return {
+        'id': str(row.id),
+        'text': row.text,
+        'timestamp': row.timestamp.isoformat(),
+        'likes_count': row.likes_count,
+        'user': {'id': row.user_id, 'username': row.username, 'image_url': row.image_url},
+    }
+
+
+def user_json(row):
+    return row._asdict()
+
+
+def parse_ids():
+    '''Reads the ?ids= list of a batch lookup, keeping the order and dropping repeats'''
+
+    try:
+        ids = [int(value) for value in request.args.get('ids', '').split(',') if value]
+    except ValueError:
+        abort(400, 'ids must be a comma-separated list of integers')
+    if not ids or len(ids) > current_app.config['API_MAX_IDS']:
+        abort(400, f'between 1 and {current_app.config["API_MAX_IDS"]} ids are allowed')
+    return list(dict.fromkeys(ids))
+
+
+def page_size():
+    per_page = current_app.config['FEED_PAGE_SIZE']
+    limit = request.args.get('limit', per_page, type=int)
+    return max(1, min(limit, per_page))
+
+
+def require_user():
+    if not g.user:
+        abort(401)
+    return g.user
+
+
+def message_rows(ids):
+    '''Projected rows for messages by id, in the order of ids, skipping deleted authors'''
+
+    if not ids:
+        return []
+    rows = db.session.execute(
+        select(*MESSAGE_COLUMNS)
+        .join(User, User.id == Message.user_id)
+        .where(Message.id.in_(ids), User.deleted_at.is_(None))
+    ).all()
+    by_id = {row.id: row for row in rows}
+    return [by_id[message_id] for message_id in ids if message_id in by_id]
+
+
+def messages_json(rows):
+    '''Serializes message rows, with the viewer's likes when logged in'''
+
+    messages = [message_json(row) for row in rows]
+    if g.user and messages:
+        liked = liked_ids(g.user.id, [row.id for row in rows])
+        for message, row in zip(messages, rows):
+            message['liked'] = row.id in liked
+    return messages
+
+
+def page_response(messages, next_cursor):
+    return not_modified(messages, next_cursor) or jsonify(messages=messages, next_cursor=next_cursor)
+
+
+@api.route('/timeline')
+def timeline_page():
+    '''The logged-in user's home feed'''
+
+    user = require_user()
+    ids = timeline.home_ids(user.id, page_size() + 1, decode_message_cursor(request.args.get('after')))
+    page = make_page(ids, page_size(), lambda message_id: (message_id,))
+
+    rows = message_rows(page.items)
+    return page_response(messages_json(rows), page.next_cursor)
+
+
+@api.route('/users/<int:user_id>/messages')
+def user_messages(user_id):
+    '''A user's own messages'''
+
+    if db.session.scalar(select(User.id).where(User.id == user_id, User.deleted_at.is_(None))) is None:
+        abort(404)
+
+    query = select(*MESSAGE_COLUMNS).join(User, User.id == Message.user_id).where(Message.user_id == user_id)
+    before = decode_message_cursor(request.args.get('after'))
+    rows = db.session.execute(
+        messages_before(query, Message.id, before).limit(page_size() + 1)
+    ).all()
+    page = make_page(rows, page_size(), message_key)
+    return page_response(messages_json(page.items), page.next_cursor)
+
+
+@api.route('/users')
+def users_batch():
+    '''Users by id'''
+
+    ids = parse_ids()
+    rows = db.session.execute(select(*USER_COLUMNS).where(User.id.in_(ids), User.deleted_at.is_(None))).all()
+    by_id = {row.id: user_json(row) for row in rows}
+    users = [by_id[user_id] for user_id in ids if user_id in by_id]
+    if g.user:
+        for user in users:
+            user['following'] = follow_graph.is_following(g.user.id, user['id'])
+
+    return not_modified(users) or jsonify(users=users)
+
+
+@api.route('/messages')
+def messages_batch():
+    '''Messages by id'''
+
+    messages = messages_json(message_rows(parse_ids()))
+    return not_modified(messages) or jsonify(messages=messages)
+
+
+@api.route('/messages/<int:message_id>/like', methods=['PUT', 'DELETE'])
+def like(message_id):
+    '''Likes (PUT) or unlikes (DELETE) a message; repeating a request changes nothing'''
+
+    user = require_user()
+    message = likeable_message(message_id)
+    if message is None:
+        abort(404)
+    if message.user_id == user.id:
+        abort(403, 'you cannot like your own message')
+
+    if request.method == 'PUT':
+        like_message(user.id, message_id)
+    else:
+        unlike_message(user.id, message_id)
+    likes_count = db.session.scalar(select(Message.likes_count).where(Message.id == message_id))
+    db.session.commit()
+
+    return jsonify(id=str(message_id), liked=request.method == 'PUT', likes_count=likes_count)
+
+
+@api.errorhandler(HTTPException)
+def error_json(error):
+    '''Answers API errors with JSON instead of the HTML error pages'''
+
+    return jsonify(error=error.description), error.code
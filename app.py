@@ -1,27 +1,108 @@
-from flask import Flask, redirect, render_template, flash, g, session, request
-from flask_debugtoolbar import DebugToolbarExtension
-from models import *
+import os
+import sys
+from flask import Blueprint, Flask, abort, current_app, redirect, render_template, flash, g, session, request
+from models import db, connect_db, User, Message, Follows, Likes
+from deletion import AccountDeleter, account_deleter, hide_user
+from fragments import FragmentCache
+from livefeed import LiveFeed, live_feed
+from images import ImageProxy
+from assets import Assets, build_assets_command
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import contains_eager, joinedload
 from forms import LoginForm, UserAddForm, MessageForm, EditUserForm
+import timeline
+from timeline import TimelineSettler
+import counters
+from config import PROFILES, engine_options
+from pagination import paginate_messages, paginate_users
+from likes import likeable_message, liked_ids, toggle_like
+from querybudget import QueryBudget
+from search import search_engine
+from followgraph import FollowGraph, follow_graph
+from usercache import UserCache, user_cache
+from passwords import PasswordHasher, HasherBusy, HashTimeout
+from httpcache import apply_policy, not_modified
+from instrumentation import Instrumentation
+from replicas import read_replicas
+from api import api
+from migrations import migrate_command
+from queryplans import check_plans_command
+from streaming import stream_page
 
 CURRENT_USER_KEY = 'current_user'
 
-app = Flask(__name__)
-
-app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///warbler_db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = True
-app.config['SQLALCHEMY_ECHO'] = True
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-app.config['SECRET_KEY'] = 'dassa324'
-debug = DebugToolbarExtension(app)
-
-connect_db(app)
+bp = Blueprint('warbler', __name__, cli_group=None)
+
+
+def create_app(profile='dev', **overrides):
+    '''Builds the app for a config profile (dev, test or prod); overrides win over the profile'''
+
+    config = PROFILES[profile]
+    app = Flask(__name__)
+    app.config.from_object(config)
+    app.config.update(config.from_env())
+    app.config.update(overrides)
+    if not app.config['SECRET_KEY']:
+        raise RuntimeError(f'SECRET_KEY must be set for the {profile} profile')
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config))
+
+    if app.config['DEBUG_TB_ENABLED']:
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    # Extensions keeping state get a fresh instance per app, in app.extensions
+    Instrumentation(app)
+    PasswordHasher(app)
+    read_replicas.init_app(app)
+    connect_db(app)
+    QueryBudget(app)
+    search_engine.init_app(app)
+    FollowGraph(app)
+    UserCache(app)
+    AccountDeleter(app)
+    TimelineSettler(app)
+    FragmentCache(app)
+    LiveFeed(app)
+    ImageProxy(app)
+    Assets(app)
+    app.register_blueprint(bp)
+    app.register_blueprint(api)
+    app.cli.add_command(migrate_command)
+    app.cli.add_command(check_plans_command)
+    app.cli.add_command(build_assets_command)
+    return app
+
+
+def __getattr__(name):
+    '''Builds the module-level ``app`` on first use, for ``from app import app``
+
+    The profile comes from WARBLER_PROFILE (default dev). Like the app this
+    module used to build at import time, it keeps an app context pushed.
+    '''
+
+    if name != 'app':
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+    app = create_app(os.environ.get('WARBLER_PROFILE', 'dev'))
+    app.app_context().push()
+    setattr(sys.modules[__name__], 'app', app)
+    return app
+
+
+@bp.cli.command('recount')
+def recount_command():
+    '''Rebuilds the follower, following, message and like counters'''
+    counters.recount_all()
+    db.session.commit()
 
-@app.before_request
+@bp.before_app_request
 def add_user_to_g():
     '''Before the requests it adds the current user to g'''
-    if CURRENT_USER_KEY in session:
-        g.user = User.query.get(session[CURRENT_USER_KEY])
+    if CURRENT_USER_KEY in session and request.endpoint != 'static':
+        g.user = user_cache.load(session[CURRENT_USER_KEY])
+        if g.user is not None and g.user.deleted_at is not None:
+            do_logout()
+            g.user = None
     else:
         g.user = None
 
@@ -37,7 +118,7 @@ def do_logout():
         del session[CURRENT_USER_KEY]
 
 
-@app.route('/signup', methods=['GET', 'POST'])
+@bp.route('/signup', methods=['GET', 'POST'])
 def signup():
     '''Brings up signup form, makes new user. If username is taken it will flash message'''
 
@@ -57,9 +138,13 @@ def signup():
 
             db.session.add(new_user)
             db.session.commit()
+            search_engine.index_user(new_user)
             flash('Account Created!', 'success')
         except IntegrityError:
             flash('Username taken. Please Try Again', 'danger')
+        except (HasherBusy, HashTimeout):
+            flash('Too many people are signing up right now. Try again in a moment', 'danger')
+            return render_template('users/signup.html', form=form), 503
     
         do_login(new_user)
 
@@ -68,7 +153,7 @@ def signup():
     else:
         return render_template('users/signup.html', form=form)
     
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
 def login():
     '''Brings up login form'''
 
@@ -79,55 +164,86 @@ def login():
         username = form.username.data
         password = form.password.data
 
-        user = User.authenticate(username, password)
+        try:
+            user = User.authenticate(username, password)
+        except (HasherBusy, HashTimeout):
+            flash('Too many people are logging in right now. Try again in a moment', 'danger')
+            return render_template('users/login.html', form=form), 503
 
         if user:
+            db.session.commit()
             do_login(user)
             flash(f'Welcome back, {user.username}!', 'success')
             return redirect('/')
 
         flash('Wrong username/password. Try again', 'danger')
         
-    else:
-        return render_template('users/login.html', form=form)
+    return render_template('users/login.html', form=form)
     
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     '''Logs user out'''
     do_logout()
     flash('Logged out', 'success')
     return redirect('/')
 
-@app.route('/users')
+@bp.route('/users')
 def search_for_user():
     '''Makes a search for the user'''
 
     search = request.args.get('q')
 
-    if not search:
-        users = User.query.all()
+    if search:
+        users = [user for user in search_engine.search_users(search) if user.deleted_at is None]
+        next_cursor = None
     else:
-        users = User.query.filter(User.username.like(f'%{search}%')).all()
+        users, next_cursor = paginate_users(
+            User.query.filter(User.deleted_at.is_(None)),
+            User,
+            request.args.get('after'),
+            current_app.config['USERS_PAGE_SIZE']
+        )
+
+    cached = not_modified(
+        [(user.id, user.profile_version) for user in users],
+        next_cursor,
+        g.user and [g.user.is_following(user) for user in users]
+    )
+    if cached:
+        return cached
 
-    return render_template('/users/index.html', users=users)
+    return render_template('/users/index.html', users=users, next_cursor=next_cursor)
 
-@app.route('/users/<int:user_id>')
+@bp.route('/users/<int:user_id>')
 def show_user(user_id):
     '''Shows a list of the user and other messages'''
 
-    user = User.query.get_or_404(user_id)
-
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all()
-            )
+    user = User.query.filter_by(id=user_id, deleted_at=None).first_or_404()
+
+    page = paginate_messages(
+        Message.query.filter(Message.user_id == user_id),
+        Message,
+        request.args.get('after'),
+        current_app.config['FEED_PAGE_SIZE']
+    )
+
+    cached = not_modified(
+        user.id,
+        user.profile_version,
+        user.messages_count,
+        user.following_count,
+        user.followers_count,
+        user.likes_count,
+        [message.id for message in page.items],
+        page.next_cursor,
+        g.user and g.user.is_following(user)
+    )
+    if cached:
+        return cached
     
-    return render_template('users/show.html', user=user, messages=messages)
+    return render_template('users/show.html', user=user, messages=page.items, next_cursor=page.next_cursor)
 
-@app.route('/users/<int:user_id>/following')
+@bp.route('/users/<int:user_id>/following')
 def show_following(user_id):
     '''Shows who the user followed'''
 
@@ -135,23 +251,35 @@ def show_following(user_id):
         flash('You do no have access', 'danger')
         return redirect('/')
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    user = User.query.filter_by(id=user_id, deleted_at=None).first_or_404()
+    following = (User
+                 .query
+                 .join(Follows, Follows.user_being_followed_id == User.id)
+                 .filter(Follows.user_following_id == user_id, User.deleted_at.is_(None))
+                 .order_by(User.id)
+                 .yield_per(current_app.config['STREAM_BATCH_SIZE']))
+    return stream_page('users/following.html', user=user, following=following)
 
 
-@app.route('/users/<int:user_id>/followers')
+@bp.route('/users/<int:user_id>/followers')
 def show_followers(user_id):
     '''Shows the user's followers'''
 
     if not g.user:
         flash('You do not have accces', 'danger')
         return redirect('/')
-    user = User.query.get_or_404(user_id)
+    user = User.query.filter_by(id=user_id, deleted_at=None).first_or_404()
+    followers = (User
+                 .query
+                 .join(Follows, Follows.user_following_id == User.id)
+                 .filter(Follows.user_being_followed_id == user_id, User.deleted_at.is_(None))
+                 .order_by(User.id)
+                 .yield_per(current_app.config['STREAM_BATCH_SIZE']))
 
-    return render_template('users/followers.html', user=user)
+    return stream_page('users/followers.html', user=user, followers=followers)
 
 
-@app.route('/users/follow/<int:follow_id>', methods=['POST'])
+@bp.route('/users/follow/<int:follow_id>', methods=['POST'])
 def follow(follow_id):
     '''Shows the user who was just followed'''
 
@@ -159,18 +287,28 @@ def follow(follow_id):
         flash('You do not have access', 'danger')
         return redirect('/')
     
-    followed_user = User.query.get_or_404(follow_id)
+    # FOR SHARE: an account being deleted cannot gain a follower mid-purge
+    followed_user = (User.query
+                     .filter_by(id=follow_id, deleted_at=None)
+                     .with_for_update(read=True)
+                     .first_or_404())
     try:
-        g.user.following.append(followed_user)
+        db.session.add(Follows(user_being_followed_id=followed_user.id, user_following_id=g.user.id))
+        db.session.flush()
+        counters.followed(g.user.id, followed_user.id)
+        timeline.backfill_follow(g.user.id, followed_user.id)
+        follow_graph.add_edge(g.user.id, followed_user.id)
         db.session.commit()
+        live_feed.followed(g.user.id, followed_user.id)
         flash(f'Following {followed_user.username}', 'success')
     except IntegrityError:
+        db.session.rollback()
         flash("You can't follow yourself", 'danger')
         return redirect('/users')
 
     return redirect(f'/users/{g.user.id}/following')
 
-@app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
+@bp.route('/users/stop-following/<int:follow_id>', methods=['POST'])
 def stop_following(follow_id):
     '''Shows the user who was just unfollowed'''
 
@@ -178,15 +316,27 @@ def stop_following(follow_id):
         flash('You do not have access', 'danger')
         return redirect('/')
     
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.remove(followed_user)
+    followed_user = User.query.filter_by(id=follow_id, deleted_at=None).first_or_404()
+    unfollowed = (Follows
+                  .query
+                  .filter_by(user_being_followed_id=followed_user.id, user_following_id=g.user.id)
+                  .delete(synchronize_session=False))
+    if not unfollowed:
+        flash(f'You are not following {followed_user.username}', 'danger')
+        return redirect(f'/users/{g.user.id}/following')
+
+    counters.followed(g.user.id, followed_user.id, -1)
+    timeline.prune_follow(g.user.id, followed_user.id)
+    timeline.settle_authors([followed_user.id])
+    follow_graph.remove_edge(g.user.id, followed_user.id)
     db.session.commit()
+    live_feed.unfollowed(g.user.id, followed_user.id)
 
     flash(f'Unfollowed {followed_user.username}', 'danger')
 
     return redirect(f'/users/{g.user.id}/following')
 
-@app.route('/users/profile', methods=['GET', 'POST'])
+@bp.route('/users/profile', methods=['GET', 'POST'])
 def edit_profile():
     '''Shows profile edit form'''
 
@@ -200,16 +350,18 @@ def edit_profile():
         username = form.username.data
         email = form.email.data
         password = form.password.data
-        if User.authenticate(username=g.user.username, password=password):
-            user = User.query.get_or_404(g.user.id)
+        if g.user.check_password(password):
+            user = g.user
             user.username = username
             user.email = email
             user.image_url = form.image_url.data or User.image_url.default.arg
             user.header_image_url = form.header_image_url.data or User.header_image_url.default.arg
             user.bio = form.bio.data
             user.location = form.location.data
+            user.profile_version += 1
 
             db.session.commit()
+            search_engine.index_user(user)
             flash('Changes saved!', 'success')
             return redirect(f'/users/{g.user.id}')
         
@@ -219,7 +371,7 @@ def edit_profile():
     else:
             return render_template('/users/edit.html', form=form)
 
-@app.route('/users/delete', methods=['POST'])
+@bp.route('/users/delete', methods=['POST'])
 def delete_user():
     '''Deletes user from db'''
 
@@ -228,14 +380,18 @@ def delete_user():
         return redirect('/')
     
     do_logout()
-    
-    db.session.delete(g.user)
+
+    user = g.user
+    hide_user(user)
+    follow_graph.remove_user(user.id)
     db.session.commit()
+    search_engine.remove_user(user.id)
+    account_deleter.enqueue(user.id)
     flash('User deleted', 'success')
 
     return redirect('/signup')
 
-@app.route('/messages/new', methods=['GET', 'POST'])
+@bp.route('/messages/new', methods=['GET', 'POST'])
 def new_message():
     '''Creates a new message'''
 
@@ -250,21 +406,47 @@ def new_message():
 
         message = Message(text=text)
         g.user.messages.append(message)
+        db.session.flush()
+        counters.message_posted(g.user.id)
+        timeline.fan_out_message(message)
         db.session.commit()
+        search_engine.index_message(message)
+        live_feed.publish_message(message)
 
         return redirect(f'/users/{g.user.id}')
     
     else:
         return render_template('messages/new.html', form=form)
     
-@app.route('/messages/<int:message_id>', methods=['GET'])
+@bp.route('/messages/search')
+def search_messages():
+    '''Searches message text'''
+
+    search = request.args.get('q')
+    messages = search_engine.search_messages(search) if search else []
+    messages = [message for message in messages if message.user.deleted_at is None]
+
+    return render_template('messages/search.html', messages=messages, search=search)
+
+@bp.route('/messages/<int:message_id>', methods=['GET'])
 def show_specific_message(message_id):
     '''Shows messages by looking them by id'''
-    message = Message.query.get_or_404(message_id)
+    message = Message.query.options(joinedload(Message.user)).get_or_404(message_id)
+    if message.user.deleted_at is not None:
+        abort(404)
+
+    cached = not_modified(
+        message.id,
+        message.user.id,
+        message.user.profile_version,
+        g.user and g.user.is_following(message.user)
+    )
+    if cached:
+        return cached
 
     return render_template('messages/show.html', message=message)
 
-@app.route('/messages/<int:message_id>/delete', methods=['POST'])
+@bp.route('/messages/<int:message_id>/delete', methods=['POST'])
 def delete_message(message_id):
     '''Deletes specific message'''
 
@@ -272,79 +454,80 @@ def delete_message(message_id):
         flash('You do not have access', 'danger')
         return redirect('/')
     
-    message = Message.query.get(message_id)
+    message = Message.query.get_or_404(message_id)
 
+    counters.message_deleted(message)
+    timeline.remove_message(message.id)
     db.session.delete(message)
     db.session.commit()
+    search_engine.remove_message(message_id)
 
     return redirect(f'/users/{g.user.id}')
 
-@app.route('/')
+@bp.route('/')
 def homepage():
     '''If logged in, it will show a list of all posts. If a user is not logged in it will show the signup page'''
 
     if g.user:
-        followed_users = [user.id for user in g.user.following]
-        followed_users.append(g.user.id)
-        user = User.query.get_or_404(g.user.id)
-        messages = user.likes
-        likes = [message.id for message in messages]
-        messages = (Message
-            .query
-            .filter(Message.user_id.in_(followed_users))
-            .order_by(Message.timestamp.desc())
-            .limit(100)
-            .all()
+        user = g.user
+        page = timeline.home_page(user, request.args.get('after'), current_app.config['FEED_PAGE_SIZE'])
+        likes = liked_ids(user.id, [msg.id for msg in page.items])
+
+        cached = not_modified(
+            user.messages_count,
+            user.following_count,
+            user.followers_count,
+            [(msg.id, msg.user.id, msg.user.profile_version, msg.id in likes) for msg in page.items],
+            page.next_cursor
         )
+        if cached:
+            return cached
         
-        return render_template('home.html', messages=messages, user=user, likes=likes)
+        return render_template('home.html', messages=page.items, user=user, likes=likes, next_cursor=page.next_cursor)
     else:
-        return render_template('home-anon.html')
+        return not_modified('home-anon') or render_template('home-anon.html')
     
-@app.route('/users/likes')
+@bp.route('/users/likes')
 def show_liked_messages():
     '''Shows the user's likes'''
     if g.user:
-        user = User.query.get_or_404(g.user.id)
-        messages = user.likes
-        likes = [message.id for message in messages]
-        
+        user = g.user
+        page = paginate_messages(
+            Message
+            .query
+            .join(Likes, Likes.message_id == Message.id)
+            .join(Message.user)
+            .filter(Likes.user_id == user.id, User.deleted_at.is_(None))
+            .options(contains_eager(Message.user)),
+            Message,
+            request.args.get('after'),
+            current_app.config['FEED_PAGE_SIZE']
+        )
+        likes = {message.id for message in page.items}
 
-        return render_template('users/likes.html', messages=messages, user=user, likes=likes)
+        return render_template('users/likes.html', messages=page.items, user=user, likes=likes,
+                               next_cursor=page.next_cursor)
     flash('You do not have access', 'danger')
     return redirect('/')
     
-@app.route('/users/add_like/<int:message_id>', methods=['POST'])
+@bp.route('/users/add_like/<int:message_id>', methods=['POST'])
 def add_like(message_id):
     '''Gives ability to add and remove a like'''
     if g.user:
-        user = g.user
-        message = Message.query.get_or_404(message_id)
+        message = likeable_message(message_id)
+        if message is None:
+            abort(404)
         if message.user_id != g.user.id:
-            try:
-                existing_like = Likes.query.filter_by(user_id=user.id, message_id=message_id).first()
-                if existing_like:
-                    db.session.delete(existing_like)
-                    db.session.commit()
-                    flash('Unliked', 'danger')
-                else:
-                    new_like = Likes(user_id=user.id, message_id=message.id)
-
-                    db.session.add(new_like)
-                    db.session.commit()
-                    flash('Liked!', 'success')
-                    return redirect('/')
-            except IntegrityError:
-                db.session.rollback()
-                flash('Already liked', 'danger')
+            if toggle_like(g.user.id, message.id):
+                flash('Liked!', 'success')
+            else:
+                flash('Unliked', 'danger')
+            db.session.commit()
     return redirect('/')
 
     
-@app.after_request
+@bp.after_app_request
 def add_header(req):
+    '''Applies the HTTP caching policy to every response'''
 
-    req.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-    req.headers['Pragma'] = 'no-cache'
-    req.headers['Expires'] = '0'
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
\ No newline at end of file
+    return apply_policy(req)
\ No newline at end of file
@@ -0,0 +1,216 @@
+'''Fingerprinted, precompressed static assets.
+
+``build`` copies every file under ``static/`` into ``ASSETS_FOLDER`` with the
+first 12 hex digits of its SHA-256 in the name (``stylesheets/style.css``
+becomes ``stylesheets/style.3f9c2a1b7d4e.css``) and writes ``manifest.json``
+mapping one to the other. ``url('/static/...')`` references inside stylesheets
+are rewritten to the fingerprinted names first, so a stylesheet's hash changes
+with the images it uses. Text files are also written gzipped (``.gz``) and, if
+the ``brotli`` package is installed, brotli-compressed (``.br``), when that
+makes them smaller.
+
+Templates link to assets with ``static_url('stylesheets/style.css')``, which
+gives ``/assets/<fingerprinted name>``. Those responses are ``immutable`` for a
+year, since new content gets a new name, and the precompressed copy the client
+accepts is sent with ``Content-Encoding``, so nothing is compressed per
+request. Files left over from older builds are kept for pages that still link
+to them.
+
+The app builds on startup when the static files changed since the last build
+(``ASSETS_BUILD_ON_STARTUP``); the prod profile turns that off, so workers do
+not race to build, and runs ``flask build-assets`` at deploy time instead.
+Started with a stale build, it keeps serving that build and logs a warning.
+With ``ASSETS_ENABLED`` off (the dev profile), ``static_url`` links to
+``/static/`` so edits show up without a rebuild.
+'''
+
+import gzip
+import hashlib
+import json
+import os
+import re
+import tempfile
+from mimetypes import guess_type
+import click
+from flask import abort, current_app, request, send_file, url_for
+from werkzeug.local import LocalProxy
+from werkzeug.security import safe_join
+from httpcache import cache_for, STATIC_MAX_AGE
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MANIFEST = 'manifest.json'
+COMPRESSIBLE = {'.css', '.js', '.svg', '.txt', '.json', '.ico', '.map', '.html'}
+# Keep a compressed copy only if it saves at least this fraction of the file
+MIN_SAVING = 0.1
+STATIC_REFERENCE = re.compile(r'''url\((['"]?)/static/([^'")]+)\1\)''')
+
+# Suffix of the precompressed copy for each Content-Encoding, best first
+ENCODINGS = {'br': 'br', 'gzip': 'gz'}
+PREFERENCE = list(ENCODINGS)
+
+
+def fingerprint(name, data):
+    '''The name of a file with its content hash before the extension'''
+
+    digest = hashlib.sha256(data).hexdigest()[:12]
+    stem, extension = os.path.splitext(name)
+    return f'{stem}.{digest}{extension}'
+
+
+def write(path, data):
+    '''Writes a file atomically, so a concurrent build or request never sees part of it'''
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.')
+    with os.fdopen(descriptor, 'wb') as out:
+        out.write(data)
+    os.replace(temporary, path)
+
+
+def compressed(data):
+    '''{encoding: bytes} for the encodings that make data noticeably smaller'''
+
+    variants = {'gzip': gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants['br'] = brotli.compress(data, quality=11)
+    return {encoding: body for encoding, body in variants.items() if len(body) <= len(data) * (1 - MIN_SAVING)}
+
+
+def source_files(static_folder):
+    '''Paths of the static files relative to the static folder, stylesheets last'''
+
+    names = []
+    for root, dirs, files in os.walk(static_folder):
+        for file in files:
+            if not file.startswith('.'):
+                names.append(os.path.relpath(os.path.join(root, file), static_folder).replace(os.sep, '/'))
+    return sorted(names, key=lambda name: (name.endswith('.css'), name))
+
+
+def signature(static_folder):
+    '''Changes whenever a static file is added, removed or modified'''
+
+    parts = []
+    for name in source_files(static_folder):
+        stat = os.stat(os.path.join(static_folder, name))
+        parts.append(f'{name}:{stat.st_size}:{stat.st_mtime_ns}')
+    return hashlib.sha256('\n'.join(parts).encode('utf-8')).hexdigest()
+
+
+def build(static_folder, output_folder, url_prefix='/assets'):
+    '''Fingerprints and precompresses the static files; returns the manifest'''
+
+    files, encodings = {}, {}
+    for name in source_files(static_folder):
+        with open(os.path.join(static_folder, name), 'rb') as source:
+            data = source.read()
+        if name.endswith('.css'):
+            data = STATIC_REFERENCE.sub(
+                lambda match: f"url('{url_prefix}/{files.get(match.group(2), match.group(2))}')",
+                data.decode('utf-8')
+            ).encode('utf-8')
+
+        hashed = files[name] = fingerprint(name, data)
+        path = os.path.join(output_folder, hashed)
+        if not os.path.exists(path):
+            write(path, data)
+        if os.path.splitext(name)[1] in COMPRESSIBLE:
+            variants = compressed(data)
+            for encoding, body in variants.items():
+                write(f'{path}.{ENCODINGS[encoding]}', body)
+            if variants:
+                encodings[hashed] = sorted(variants, key=PREFERENCE.index)
+
+    manifest = {'signature': signature(static_folder), 'files': files, 'encodings': encodings}
+    write(os.path.join(output_folder, MANIFEST), json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+    return manifest
+
+
+def read_manifest(output_folder):
+    try:
+        with open(os.path.join(output_folder, MANIFEST)) as manifest:
+            return json.load(manifest)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+class Assets:
+    '''Flask extension serving fingerprinted assets and providing static_url'''
+
+    def __init__(self, app=None):
+        self.manifest = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('ASSETS_ENABLED', True)
+        app.config.setdefault('ASSETS_FOLDER', os.path.join(app.instance_path, 'assets'))
+        app.config.setdefault('ASSETS_URL_PATH', '/assets')
+        app.config.setdefault('ASSETS_BUILD_ON_STARTUP', True)
+
+        self.manifest = None
+        if app.config['ASSETS_ENABLED']:
+            folder = app.config['ASSETS_FOLDER']
+            manifest = read_manifest(folder)
+            stale = manifest is None or manifest['signature'] != signature(app.static_folder)
+            if stale and app.config['ASSETS_BUILD_ON_STARTUP']:
+                manifest = build(app.static_folder, folder, app.config['ASSETS_URL_PATH'])
+            elif stale:
+                app.logger.warning('Static files changed since the last asset build; run flask build-assets')
+            self.manifest = manifest
+        app.extensions['assets'] = self
+
+        app.add_template_global(self.static_url)
+        app.add_url_rule(app.config['ASSETS_URL_PATH'] + '/<path:filename>', 'assets', self.view)
+
+    def static_url(self, filename):
+        '''The URL of a static file: fingerprinted when it has been built, else under /static/'''
+
+        hashed = self.manifest['files'].get(filename) if self.manifest else None
+        if hashed is None:
+            return url_for('static', filename=filename)
+        return url_for('assets', filename=hashed)
+
+    def view(self, filename):
+        '''Serves a built asset, precompressed if the client accepts it'''
+
+        path = safe_join(current_app.config['ASSETS_FOLDER'], filename)
+        # Names from earlier builds are served too, for pages rendered before a deploy
+        if path is None or filename == MANIFEST or not os.path.isfile(path):
+            abort(404)
+
+        encoding = None
+        for candidate in (self.manifest or {}).get('encodings', {}).get(filename, ()):
+            if request.accept_encodings[candidate] > 0:
+                encoding = candidate
+                break
+
+        mimetype = None
+        if encoding is not None:
+            mimetype = guess_type(filename)[0] or 'application/octet-stream'
+            path = f'{path}.{ENCODINGS[encoding]}'
+
+        response = send_file(path, mimetype=mimetype, conditional=True)
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        cache_for(current_app.config.get('STATIC_MAX_AGE', STATIC_MAX_AGE), immutable=True)
+        return response
+
+
+@click.command('build-assets')
+def build_assets_command():
+    '''Fingerprints and precompresses the static files into ASSETS_FOLDER'''
+
+    config = current_app.config
+    manifest = build(current_app.static_folder, config['ASSETS_FOLDER'], config['ASSETS_URL_PATH'])
+    click.echo(f'{len(manifest["files"])} files built into {config["ASSETS_FOLDER"]}, '
+               f'{len(manifest["encodings"])} precompressed')
+
+
+# The current app's Assets; create_app makes one per app
+assets = LocalProxy(lambda: current_app.extensions['assets'])
@@ -0,0 +1,103 @@
+'''Benchmark likes for users who have liked a very large number of messages.
+
+Loads a scratch database where a few heavy users have each liked --likes
+messages, then times, for one heavy user:
+
+* the old home page lookup: load every liked message (``user.likes``) and
+  test the page's 100 ids against that list
+* ``liked_ids``: one primary key lookup for just the page's ids
+* a like toggle through ``toggle_like``, committed, as ``add_like`` runs it
+
+    python benchmarks/likes_bench.py --likes 100000
+    python benchmarks/likes_bench.py --url postgresql:///warbler_bench
+'''
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from sqlalchemy import insert
+from app import create_app
+from models import db, Likes, Message, User
+from likes import liked_ids, toggle_like
+import counters
+
+
+def load(heavy, messages, likes, rng, batch=10000):
+    db.drop_all()
+    db.create_all()
+    db.session.execute(insert(User), [
+        dict(email=f'user{i}@example.com', username=f'user{i}', password='x') for i in range(heavy + 1)
+    ])
+    author_id = heavy + 1
+    for start in range(0, messages, batch):
+        db.session.execute(insert(Message), [
+            dict(text=f'Message {i}', user_id=author_id) for i in range(start, min(start + batch, messages))
+        ])
+    for user_id in range(1, heavy + 1):
+        liked = rng.sample(range(1, messages + 1), likes)
+        for start in range(0, likes, batch):
+            db.session.execute(insert(Likes), [
+                dict(user_id=user_id, message_id=message_id) for message_id in liked[start:start + batch]
+            ])
+    counters.recount_all()
+    db.session.commit()
+
+
+def timed(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        db.session.expire_all()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='sqlite:///likes_bench.db')
+    parser.add_argument('--heavy-users', type=int, default=3)
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--likes', type=int, default=100000)
+    parser.add_argument('--page', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    app = create_app('test', SQLALCHEMY_DATABASE_URI=args.url, DB_STATEMENT_TIMEOUT_MS=None)
+    rng = random.Random(args.seed)
+    with app.app_context():
+        start = time.perf_counter()
+        load(args.heavy_users, args.messages, args.likes, rng)
+        print(f'loaded {args.heavy_users} users with {args.likes} likes each '
+              f'in {time.perf_counter() - start:.1f}s')
+
+        user = db.session.get(User, 1)
+        page = rng.sample(range(1, args.messages + 1), args.page)
+
+        def relationship_scan():
+            likes = [message.id for message in user.likes]
+            return [message_id in likes for message_id in page]
+
+        scan = timed(relationship_scan, args.repeat)
+        lookup = timed(lambda: liked_ids(user.id, page), args.repeat)
+
+        def toggle():
+            toggle_like(user.id, page[0])
+            db.session.commit()
+
+        toggled = timed(toggle, args.repeat)
+
+        print(f'{"user.likes scan":<22}{scan * 1000:>12.2f} ms')
+        print(f'{"liked_ids lookup":<22}{lookup * 1000:>12.2f} ms{scan / max(lookup, 1e-9):>9.1f}x')
+        print(f'{"toggle + commit":<22}{toggled * 1000:>12.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+'''Benchmark login password checks under concurrency.
+
+Simulates request threads that each verify one password, first inline on the
+request thread and then through the bounded PasswordHasher pool, and reports
+throughput, latency percentiles and how many logins were shed as busy.
+
+    python benchmarks/login_bench.py --clients 32 --logins 256 --rounds 10
+'''
+
+import argparse
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import bcrypt
+from passwords import HasherBusy, HashTimeout, PasswordHasher
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def run(label, verify, clients, logins):
+    latencies, shed = [], 0
+
+    def login():
+        start = time.perf_counter()
+        try:
+            verify()
+        except (HasherBusy, HashTimeout):
+            return None
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as request_threads:
+        for latency in request_threads.map(lambda _: login(), range(logins)):
+            if latency is None:
+                shed += 1
+            else:
+                latencies.append(latency)
+    elapsed = time.perf_counter() - start
+
+    print(f'{label:<24}{len(latencies) / elapsed:>10.1f}'
+          f'{statistics.median(latencies) * 1000:>10.1f}'
+          f'{percentile(latencies, 95) * 1000:>10.1f}'
+          f'{percentile(latencies, 99) * 1000:>10.1f}{shed:>8}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--logins', type=int, default=256)
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--queue', type=int, default=None)
+    args = parser.parse_args()
+
+    hashed = bcrypt.hashpw(b'password', bcrypt.gensalt(args.rounds)).decode('utf-8')
+
+    print(f'{args.clients} concurrent clients, {args.logins} logins, cost {args.rounds}, {args.workers} workers')
+    print(f'{"mode":<24}{"logins/s":>10}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"shed":>8}')
+
+    run('inline', lambda: bcrypt.checkpw(b'password', hashed.encode('utf-8')), args.clients, args.logins)
+
+    hasher = PasswordHasher()
+    hasher.timeout = 60
+    hasher.start(args.workers, args.queue if args.queue is not None else args.clients)
+    run('pool', lambda: hasher.verify(hashed, 'password'), args.clients, args.logins)
+
+    hasher.start(args.workers, args.workers)
+    run('pool, short queue', lambda: hasher.verify(hashed, 'password'), args.clients, args.logins)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,363 @@
+'''End-to-end benchmark of the main Warbler routes.
+
+Seeds a scratch database at a chosen scale with the dataset generator and the
+bulk loader, then drives each route from concurrent clients, either through
+the Flask test client or over HTTP against a local WSGI server. For every
+route it reports p50/p95/p99 latency, throughput, SQL statements per request,
+errors and peak memory, and writes the results as JSON. Peak memory is the most
+Python memory allocated at once while serving the route, measured with
+tracemalloc in a separate, untimed pass of --memory-requests requests so the
+tracing does not slow the timed run.
+
+    python benchmarks/routes_bench.py --scale small
+    python benchmarks/routes_bench.py --scale medium --clients 16 --server
+    python benchmarks/routes_bench.py --scale medium --out after.json --baseline before.json
+
+The app is built with the prod profile. The database comes from DATABASE_URL
+(default: a SQLite file next to this script). Generated CSVs are kept in
+benchmarks/data/ and reused by later runs with the same generator code, sizes
+and seed. Any response other than a 2xx or 3xx counts as an error. Against a
+baseline, the script exits with status 1 if any route's p50 or p95 latency got
+worse by more than --threshold percent.
+'''
+
+import argparse
+import hashlib
+import http.client
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import urlencode
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(ROOT, 'benchmarks', 'routes_bench.db'))
+
+from flask import g, request
+from sqlalchemy import func, select
+from werkzeug.serving import make_server
+from app import create_app, CURRENT_USER_KEY
+from models import db, Follows, Message, User
+from bulkload import bulk_load
+from streaming import after_stream, streaming
+
+SCALES = {
+    'small': dict(users=300, messages=3000, follows=5000),
+    'medium': dict(users=10000, messages=200000, follows=300000),
+    'large': dict(users=100000, messages=2000000, follows=5000000),
+}
+
+app = create_app(
+    'prod',
+    SECRET_KEY='routes-bench',
+    WTF_CSRF_ENABLED=False,
+    # Seeding the large dataset runs statements longer than a request's timeout
+    DB_STATEMENT_TIMEOUT_MS=None,
+)
+
+GENERATOR = [os.path.join(ROOT, 'generator', name) for name in ('create_csvs.py', 'helpers.py')]
+DATA_END = '2024-01-01'
+LIKE_SAMPLE = 1000
+
+SEARCH_TERMS = ['an', 'son', 'mar', 'lee', 'jo', 'ra', 'chris', 'ton']
+
+# Each request carries an id; its SQL statement count is left here under that id
+REQUEST_HEADER = 'X-Bench-Request'
+statement_counts = {}
+
+local = threading.local()
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def report_statements(response):
+    '''Records the request's SQL statement count (kept by QueryBudget) for the driver.
+
+    A streamed page runs most of its statements after the headers are sent, so
+    its count is recorded once the body is finished, before the client has read
+    it all.
+    '''
+
+    key = request.headers.get(REQUEST_HEADER)
+    if key is None:
+        return response
+    if streaming():
+        after_stream(lambda: statement_counts.__setitem__(key, g.get('query_count', 0)))
+    else:
+        statement_counts[key] = g.get('query_count', 0)
+    return response
+
+
+def peak_memory_kb(driver, make_request, clients, requests):
+    '''Most memory allocated at once, above what was in use before, while sending the requests'''
+
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        run_route(driver, make_request, clients, requests)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return (peak - baseline) // 1024
+
+
+def dataset_key(sizes, seed):
+    '''Identifies a generated dataset by the generator's code and arguments'''
+
+    digest = hashlib.sha256(repr((sorted(sizes.items()), seed, DATA_END)).encode('utf-8'))
+    for path in GENERATOR:
+        with open(path, 'rb') as source:
+            digest.update(source.read())
+    return digest.hexdigest()[:12]
+
+
+def dataset(scale, seed):
+    '''Generates (or reuses) the CSVs for a scale, returning bulk_load sources'''
+
+    sizes = SCALES[scale]
+    # CSVs from an older generator can have other columns; never reuse them
+    out = os.path.join(ROOT, 'benchmarks', 'data', f'{scale}-{seed}-{dataset_key(sizes, seed)}')
+    paths = {name: os.path.join(out, f'{name}.csv') for name in ('users', 'messages', 'follows')}
+
+    if not all(os.path.exists(path) for path in paths.values()):
+        os.makedirs(out, exist_ok=True)
+        subprocess.run([
+            sys.executable, os.path.join(ROOT, 'generator', 'create_csvs.py'),
+            '--users', str(sizes['users']),
+            '--messages', str(sizes['messages']),
+            '--follows', str(sizes['follows']),
+            '--seed', str(seed),
+            '--end', DATA_END,
+            '--out', out,
+        ], check=True, cwd=os.path.join(ROOT, 'generator'))
+
+    return [(User, paths['users']), (Message, paths['messages']), (Follows, paths['follows'])]
+
+
+class TestClientDriver:
+    '''Sends requests through the Flask test client, one client per thread'''
+
+    def __init__(self, cookie):
+        self.cookie = cookie
+
+    def client(self):
+        if getattr(local, 'client', None) is None:
+            local.client = app.test_client()
+            local.client.set_cookie(app.config.get('SESSION_COOKIE_NAME', 'session'), self.cookie)
+        return local.client
+
+    def request(self, method, path, data=None):
+        # Streamed pages render while the body is read; read it here, on this thread, so the timing
+        # includes the render and the request context is closed where it was pushed
+        key = uuid.uuid4().hex
+        response = self.client().open(path, method=method, data=data, headers={REQUEST_HEADER: key}, buffered=True)
+        response.close()
+        return response.status_code, statement_counts.pop(key, 0)
+
+    def close(self):
+        pass
+
+
+class ServerDriver:
+    '''Sends requests over HTTP to a threaded WSGI server in this process'''
+
+    def __init__(self, cookie):
+        self.cookie = cookie
+        self.server = make_server('127.0.0.1', 0, app, threaded=True)
+        self.port = self.server.socket.getsockname()[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def request(self, method, path, data=None):
+        conn = http.client.HTTPConnection('127.0.0.1', self.port)
+        key = uuid.uuid4().hex
+        headers = {
+            'Cookie': f'{app.config.get("SESSION_COOKIE_NAME", "session")}={self.cookie}',
+            REQUEST_HEADER: key,
+        }
+        body = None
+        if data is not None:
+            body = urlencode(data)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        conn.request(method, path, body=body, headers=headers)
+        response = conn.getresponse()
+        response.read()
+        conn.close()
+        return response.status, statement_counts.pop(key, 0)
+
+    def close(self):
+        self.server.shutdown()
+
+
+def routes(user_id, rng):
+    '''The benchmarked routes, as name -> function returning (method, path, data)'''
+
+    with app.app_context():
+        max_user = db.session.query(func.max(User.id)).scalar()
+        # Message ids are sparse snowflakes, so sample real ones to like; not the user's own
+        likeable = db.session.scalars(
+            select(Message.id).where(Message.user_id != user_id).order_by(func.random()).limit(LIKE_SAMPLE)
+        ).all()
+        popular = (db.session
+                   .query(User.id)
+                   .order_by(User.followers_count.desc())
+                   .limit(20)
+                   .all())
+    popular = [row.id for row in popular]
+
+    return {
+        'GET /': lambda: ('GET', '/', None),
+        'GET /users/<id>': lambda: ('GET', f'/users/{rng.randint(1, max_user)}', None),
+        'GET /users?q=': lambda: ('GET', f'/users?q={rng.choice(SEARCH_TERMS)}', None),
+        'GET /users/<id>/followers': lambda: ('GET', f'/users/{rng.choice(popular)}/followers', None),
+        'POST /messages/new': lambda: ('POST', '/messages/new', {'text': f'benchmark {rng.random()}'}),
+        'POST /users/add_like/<id>': lambda: ('POST', f'/users/add_like/{rng.choice(likeable)}', None),
+    }
+
+
+def run_route(driver, make_request, clients, requests):
+    '''Sends requests from concurrent clients and summarises the results'''
+
+    def one(_):
+        method, path, data = make_request()
+        start = time.perf_counter()
+        try:
+            status, statements = driver.request(method, path, data)
+        except Exception:
+            status, statements = None, 0
+        return time.perf_counter() - start, statements, status
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        results = list(pool.map(one, range(requests)))
+    elapsed = time.perf_counter() - start
+
+    latencies = [latency for latency, statements, status in results]
+    statements = [statements for latency, statements, status in results]
+    errors = sum(1 for latency, statements, status in results if status is None or not 200 <= status < 400)
+
+    return {
+        'requests': requests,
+        'errors': errors,
+        'throughput_rps': round(requests / elapsed, 1),
+        'p50_ms': round(statistics.median(latencies) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'sql_statements_mean': round(statistics.mean(statements), 1),
+        'sql_statements_max': max(statements),
+    }
+
+
+def compare(results, baseline, threshold):
+    '''Prints the change against a baseline run; returns the regressed routes'''
+
+    regressed = []
+    print(f'\n{"route vs baseline":<30}{"p50":>10}{"p95":>10}{"rps":>10}')
+    for name, current in results['routes'].items():
+        before = baseline['routes'].get(name)
+        if before is None:
+            continue
+        change = {key: (current[key] - before[key]) / max(before[key], 1e-9) * 100
+                  for key in ('p50_ms', 'p95_ms', 'throughput_rps')}
+        print(f'{name:<30}{change["p50_ms"]:>+9.1f}%{change["p95_ms"]:>+9.1f}%{change["throughput_rps"]:>+9.1f}%')
+        if change['p50_ms'] > threshold or change['p95_ms'] > threshold:
+            regressed.append(name)
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', choices=SCALES, default='small')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--no-seed', action='store_true', help='reuse the database as it is')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=400, help='requests per route')
+    parser.add_argument('--memory-requests', type=int, default=50, help='requests per route in the memory pass')
+    parser.add_argument('--route', action='append', help='only run routes whose name contains this')
+    parser.add_argument('--server', action='store_true', help='go through a local WSGI server')
+    parser.add_argument('--out', default='bench_routes.json')
+    parser.add_argument('--baseline')
+    parser.add_argument('--threshold', type=float, default=10.0)
+    args = parser.parse_args()
+
+    app.after_request(report_statements)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    with app.app_context():
+        if not args.no_seed:
+            started = time.perf_counter()
+            bulk_load(dataset(args.scale, args.seed))
+            print(f'seeded {args.scale} dataset in {time.perf_counter() - started:.1f}s')
+
+        # Benchmark as the most followed user, so the home timeline is full
+        user_id = db.session.query(User.id).order_by(User.following_count.desc()).limit(1).scalar()
+        dialect = db.engine.dialect.name
+        db.session.remove()
+
+    cookie = app.session_interface.get_signing_serializer(app).dumps({CURRENT_USER_KEY: user_id})
+    driver = ServerDriver(cookie) if args.server else TestClientDriver(cookie)
+    rng = random.Random(args.seed)
+
+    results = {
+        'meta': {
+            'scale': args.scale,
+            **SCALES[args.scale],
+            'seed': args.seed,
+            'clients': args.clients,
+            'requests_per_route': args.requests,
+            'memory_requests_per_route': args.memory_requests,
+            'driver': 'wsgi-server' if args.server else 'test-client',
+            'database': dialect,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'commit': subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                     capture_output=True, text=True).stdout.strip(),
+            'started_at': datetime.now(timezone.utc).isoformat(),
+        },
+        'routes': {},
+    }
+
+    print(f'{args.clients} clients, {args.requests} requests per route, {results["meta"]["driver"]}')
+    print(f'{"route":<30}{"rps":>9}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}{"sql":>7}{"errors":>8}{"mem MB":>8}')
+
+    try:
+        for name, make_request in routes(user_id, rng).items():
+            if args.route and not any(part in name for part in args.route):
+                continue
+            run_route(driver, make_request, 1, 5)
+            result = run_route(driver, make_request, args.clients, args.requests)
+            result['peak_memory_kb'] = peak_memory_kb(driver, make_request, args.clients, args.memory_requests)
+            results['routes'][name] = result
+            print(f'{name:<30}{result["throughput_rps"]:>9.1f}{result["p50_ms"]:>9.1f}{result["p95_ms"]:>9.1f}'
+                  f'{result["p99_ms"]:>9.1f}{result["sql_statements_mean"]:>7.1f}{result["errors"]:>8}'
+                  f'{result["peak_memory_kb"] / 1024:>8.1f}')
+    finally:
+        driver.close()
+
+    with open(args.out, 'w') as out:
+        json.dump(results, out, indent=2)
+    print(f'\nwrote {args.out}')
+
+    if args.baseline:
+        with open(args.baseline) as source:
+            regressed = compare(results, json.load(source), args.threshold)
+        if regressed:
+            print(f'regressed by more than {args.threshold}%: {", ".join(regressed)}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
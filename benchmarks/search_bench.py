@@ -0,0 +1,104 @@
+'''Benchmark user search: the old LIKE '%q%' scan against the search subsystem.
+
+Loads N synthetic users into a scratch database and times each query both as
+the original unindexed LIKE and through the backend search.py would use for
+that database (trigram ILIKE on PostgreSQL, the in-process inverted index
+elsewhere).
+
+    python benchmarks/search_bench.py --users 1000000
+    python benchmarks/search_bench.py --url postgresql:///warbler_bench
+'''
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from sqlalchemy import create_engine, func, insert, or_, select
+from models import db, User
+from search import InvertedIndex, USER_FIELDS, escape_like, user_fields
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ra', 'tu', 'ne', 'so', 'vi', 'da', 'pe', 'zu', 'ch', 'ar', 'en', 'ox']
+CITIES = ['Austin', 'Boston', 'Denver', 'Fresno', 'Lisbon', 'Madrid', 'Oslo', 'Quito', 'Tulsa', 'Vienna']
+QUERIES = ['kalo', 'oslo', 'zuchar', 'mirasoda', 'venox']
+
+
+def fake_name(rng):
+    return ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+
+
+def load(engine, count, rng, batch=10000):
+    db.metadata.drop_all(engine)
+    db.metadata.create_all(engine)
+    with engine.begin() as conn:
+        for start in range(0, count, batch):
+            rows = [dict(
+                email=f'user{i}@example.com',
+                username=f'{fake_name(rng)}{i}',
+                password='x',
+                bio=' '.join(fake_name(rng) for _ in range(6)),
+                location=rng.choice(CITIES),
+            ) for i in range(start, min(start + batch, count))]
+            conn.execute(insert(User), rows)
+
+
+def timed(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000000)
+    parser.add_argument('--url', default='sqlite:///search_bench.db')
+    parser.add_argument('--limit', type=int, default=60)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    engine = create_engine(args.url)
+    rng = random.Random(args.seed)
+
+    start = time.perf_counter()
+    load(engine, args.users, rng)
+    print(f'loaded {args.users} users in {time.perf_counter() - start:.1f}s')
+
+    postgres = engine.dialect.name == 'postgresql'
+    index = InvertedIndex()
+    if not postgres:
+        start = time.perf_counter()
+        columns = [getattr(User, name) for name, weight in USER_FIELDS]
+        with engine.connect() as conn:
+            for row in conn.execution_options(yield_per=10000).execute(select(User.id, *columns)):
+                index.add(row.id, user_fields(row))
+        print(f'built inverted index in {time.perf_counter() - start:.1f}s')
+
+    print(f'{"query":<10}{"like ms":>12}{"search ms":>12}{"speedup":>10}{"hits":>8}')
+    with engine.connect() as conn:
+        for q in QUERIES:
+            like = select(User.id).where(User.username.like(f'%{q}%')).limit(args.limit)
+            like_time, _ = timed(lambda: conn.execute(like).all(), args.repeat)
+
+            if postgres:
+                pattern = f'%{escape_like(q)}%'
+                ranked = (select(User.id)
+                          .where(or_(*[getattr(User, name).ilike(pattern, escape='\\') for name, weight in USER_FIELDS]))
+                          .order_by(func.similarity(User.username, q).desc(), User.id)
+                          .limit(args.limit))
+                search_time, hits = timed(lambda: conn.execute(ranked).all(), args.repeat)
+            else:
+                search_time, hits = timed(lambda: index.search(q, args.limit), args.repeat)
+
+            print(f'{q:<10}{like_time * 1000:>12.2f}{search_time * 1000:>12.2f}'
+                  f'{like_time / max(search_time, 1e-9):>9.1f}x{len(hits):>8}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+'''Benchmark cold start: importing app and building it with create_app.
+
+Starts fresh interpreters, each timing ``import app`` and ``create_app`` for a
+profile, and reports the median and worst time per profile. With --target-ms
+the script exits with status 1 if the prod median is over the target, so the
+time a pre-forked worker needs to boot can be checked in CI.
+
+    python benchmarks/startup_bench.py --runs 10 --target-ms 800
+'''
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.create_app(sys.argv[1], SQLALCHEMY_DATABASE_URI='sqlite://')
+built = time.perf_counter()
+print(json.dumps({'import_ms': (imported - start) * 1000, 'create_ms': (built - imported) * 1000}))
+'''
+
+
+def measure(profile, runs):
+    env = dict(os.environ, SECRET_KEY=os.environ.get('SECRET_KEY', 'startup-bench'))
+    samples = []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, '-c', PROBE, profile], cwd=ROOT, env=env,
+                                capture_output=True, text=True, check=True)
+        samples.append(json.loads(result.stdout.strip().splitlines()[-1]))
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--profile', action='append', choices=['dev', 'test', 'prod'])
+    parser.add_argument('--target-ms', type=float, default=None, help='fail if the prod median is slower')
+    args = parser.parse_args()
+
+    print(f'{"profile":<10}{"import ms":>12}{"create ms":>12}{"total ms":>12}{"worst ms":>12}')
+    medians = {}
+    for profile in args.profile or ['dev', 'test', 'prod']:
+        samples = measure(profile, args.runs)
+        totals = [sample['import_ms'] + sample['create_ms'] for sample in samples]
+        medians[profile] = statistics.median(totals)
+        print(f'{profile:<10}{statistics.median(s["import_ms"] for s in samples):>12.0f}'
+              f'{statistics.median(s["create_ms"] for s in samples):>12.0f}'
+              f'{medians[profile]:>12.0f}{max(totals):>12.0f}')
+
+    if args.target_ms is not None and medians.get('prod', 0) > args.target_ms:
+        print(f'prod cold start {medians["prod"]:.0f}ms is over the {args.target_ms:.0f}ms target')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+'''Streaming bulk loader for the seed CSVs.
+
+Loads users, messages and follows without going through the ORM or holding
+rows in the session:
+
+* PostgreSQL streams each file straight into ``COPY ... FROM STDIN``.
+* Other databases read the CSV in fixed-size chunks and insert each chunk with
+  one untyped ``executemany``, committing as they go; values go to the driver
+  as the strings in the file, as they would with COPY.
+
+Memory stays flat however large the files are. Secondary indexes (and on
+PostgreSQL, foreign keys) are dropped before the load and recreated once all
+rows are in. Counters and timelines are rebuilt at the end with set-based SQL.
+'''
+
+import csv
+import time
+from itertools import islice
+from sqlalchemy import inspect, text
+from models import db, Follows, Message, User
+from counters import recount_all
+from timeline import rebuild_timelines
+
+DEFAULT_CHUNK_SIZE = 10000
+
+SOURCES = [
+    (User, 'generator/users.csv'),
+    (Message, 'generator/messages.csv'),
+    (Follows, 'generator/follows.csv'),
+]
+
+
+def report(label, rows, started):
+    elapsed = max(time.perf_counter() - started, 1e-9)
+    print(f'{label:<10}{rows:>12,} rows {elapsed:>9.1f}s {rows / elapsed:>12,.0f} rows/s')
+
+
+def drop_foreign_keys(conn, table):
+    '''Drops a table's foreign keys, returning the statements that recreate them'''
+
+    restore = []
+    for fk in inspect(conn).get_foreign_keys(table.name):
+        ondelete = fk.get('options', {}).get('ondelete')
+        restore.append(
+            f'ALTER TABLE {table.name} ADD CONSTRAINT {fk["name"]} '
+            f'FOREIGN KEY ({", ".join(fk["constrained_columns"])}) '
+            f'REFERENCES {fk["referred_table"]} ({", ".join(fk["referred_columns"])})'
+            + (f' ON DELETE {ondelete}' if ondelete else '')
+        )
+        conn.execute(text(f'ALTER TABLE {table.name} DROP CONSTRAINT {fk["name"]}'))
+    return restore
+
+
+def copy_csv(conn, table, path):
+    '''Streams a CSV file into a table with PostgreSQL COPY'''
+
+    with open(path, newline='') as source:
+        columns = next(csv.reader(source))
+        source.seek(0)
+        cursor = conn.connection.cursor()
+        cursor.copy_expert(
+            f'COPY {table.name} ({", ".join(columns)}) FROM STDIN WITH (FORMAT csv, HEADER true)',
+            source
+        )
+        return cursor.rowcount
+
+
+def insert_csv(conn, table, path, chunk_size):
+    '''Inserts a CSV file into a table one executemany chunk at a time'''
+
+    rows = 0
+    with open(path, newline='') as source:
+        reader = csv.DictReader(source)
+        columns = reader.fieldnames
+        statement = text(
+            f'INSERT INTO {table.name} ({", ".join(columns)}) '
+            f'VALUES ({", ".join(":" + column for column in columns)})'
+        )
+        while True:
+            chunk = list(islice(reader, chunk_size))
+            if not chunk:
+                return rows
+            conn.execute(statement, chunk)
+            conn.commit()
+            rows += len(chunk)
+
+
+def bulk_load(sources=SOURCES, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''Recreates the schema and bulk loads the given (model, csv path) sources'''
+
+    engine = db.engine
+    postgres = engine.dialect.name == 'postgresql'
+    tables = [model.__table__ for model, path in sources]
+
+    db.drop_all()
+    db.create_all()
+
+    restore_fks = []
+    with engine.connect() as conn:
+        for table in tables:
+            for index in table.indexes:
+                index.drop(conn, checkfirst=True)
+            if postgres:
+                restore_fks += drop_foreign_keys(conn, table)
+        conn.commit()
+
+        for model, path in sources:
+            started = time.perf_counter()
+            if postgres:
+                rows = copy_csv(conn, model.__table__, path)
+                conn.commit()
+            else:
+                rows = insert_csv(conn, model.__table__, path, chunk_size)
+            report(model.__tablename__, rows, started)
+
+        started = time.perf_counter()
+        for table in tables:
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+        for statement in restore_fks:
+            conn.execute(text(statement))
+        conn.execute(text('ANALYZE'))
+        conn.commit()
+        print(f'indexes and constraints rebuilt in {time.perf_counter() - started:.1f}s')
+
+    started = time.perf_counter()
+    recount_all()
+    rebuild_timelines()
+    db.session.commit()
+    print(f'counters and timelines rebuilt in {time.perf_counter() - started:.1f}s')
@@ -0,0 +1,137 @@
+'''Configuration profiles for create_app.
+
+``dev`` keeps SQL echo and the debug toolbar, ``test`` is fast and quiet, and
+``prod`` turns off everything that costs time per request or per worker boot
+and tunes the connection pool. Settings read from the environment are read when
+the app is created, not when this module is imported.
+'''
+
+import os
+
+# gunicorn worker classes that serve a held-open stream without tying up a worker
+ASYNC_WORKER_CLASSES = ('gevent', 'eventlet')
+
+
+class Config:
+    '''Settings shared by every profile'''
+
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ECHO = False
+    DEBUG_TB_ENABLED = False
+    DEBUG_TB_INTERCEPT_REDIRECTS = False
+
+    TIMELINE_FANOUT_CAP = 5000
+    TIMELINE_BACKFILL_LIMIT = 100
+    FEED_PAGE_SIZE = 100
+    USERS_PAGE_SIZE = 60
+    STREAM_BATCH_SIZE = 500
+    API_MAX_IDS = 100
+    STREAM_BUFFER_SIZE = 16 * 1024
+    QUERY_BUDGET = 30
+    PASSWORD_HASH_TARGET_MS = 250
+    PASSWORD_HASH_TIMEOUT = 5
+    REPLICA_READ_YOUR_WRITES = 5
+
+    # Engine tuning, turned into SQLALCHEMY_ENGINE_OPTIONS by create_app
+    DB_POOL_SIZE = 5
+    DB_MAX_OVERFLOW = 10
+    DB_POOL_TIMEOUT = 30
+    DB_POOL_RECYCLE = -1
+    DB_POOL_PRE_PING = False
+    DB_STATEMENT_TIMEOUT_MS = None
+
+    @staticmethod
+    def from_env():
+        return {
+            'SQLALCHEMY_DATABASE_URI': os.environ.get('DATABASE_URL', 'postgresql:///warbler_db'),
+            'SQLALCHEMY_REPLICA_URIS': [url for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url],
+            'SECRET_KEY': os.environ.get('SECRET_KEY', 'dassa324'),
+        }
+
+
+class DevConfig(Config):
+    DEBUG = True
+    SQLALCHEMY_TRACK_MODIFICATIONS = True
+    SQLALCHEMY_ECHO = True
+    DEBUG_TB_ENABLED = True
+    USER_CACHE_TTL = 5
+    ASSETS_ENABLED = False
+    METRICS_ENDPOINT = '/_metrics'
+    LIVE_ENABLED = True
+
+
+class TestConfig(Config):
+    TESTING = True
+    WTF_CSRF_ENABLED = False
+    INSTRUMENTATION_ENABLED = False
+    DELETION_WORKER = False
+    TIMELINE_SETTLE_WORKER = False
+    LIVE_ENABLED = True
+    BCRYPT_LOG_ROUNDS = 4
+    PASSWORD_HASH_WORKERS = 2
+    DB_POOL_SIZE = 2
+    DB_MAX_OVERFLOW = 2
+    DB_STATEMENT_TIMEOUT_MS = 10000
+
+    @staticmethod
+    def from_env():
+        return {
+            'SQLALCHEMY_DATABASE_URI': os.environ.get('TEST_DATABASE_URL', 'postgresql:///warbler_test'),
+            'SECRET_KEY': 'test',
+        }
+
+
+class ProdConfig(Config):
+    SERVER_TIMING = False
+    INSTRUMENTATION_LOG = False
+    PROFILE_SAMPLE_RATE = 0.001
+    # Pick it with `flask calibrate-passwords` on the production hardware
+    BCRYPT_LOG_ROUNDS = 12
+    DB_POOL_SIZE = 10
+    DB_MAX_OVERFLOW = 20
+    DB_POOL_TIMEOUT = 10
+    DB_POOL_RECYCLE = 1800
+    DB_POOL_PRE_PING = True
+    DB_STATEMENT_TIMEOUT_MS = 5000
+    # Built once per deploy with `flask build-assets`, not by every worker at boot
+    ASSETS_BUILD_ON_STARTUP = False
+
+    @staticmethod
+    def from_env():
+        settings = Config.from_env()
+        settings['SECRET_KEY'] = os.environ.get('SECRET_KEY')
+        settings['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', ProdConfig.BCRYPT_LOG_ROUNDS))
+        # Off unless asked for; without a token, serve it on an internal bind only
+        settings['METRICS_ENDPOINT'] = os.environ.get('METRICS_ENDPOINT')
+        settings['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+        # Live streams hold their worker; set WORKER_CLASS to the class gunicorn runs with (-k)
+        settings['LIVE_ENABLED'] = os.environ.get('WORKER_CLASS', 'sync') in ASYNC_WORKER_CLASSES
+        return settings
+
+
+PROFILES = {
+    'dev': DevConfig,
+    'test': TestConfig,
+    'prod': ProdConfig,
+}
+
+
+def engine_options(config):
+    '''SQLAlchemy engine options for a configured database URI'''
+
+    uri = config['SQLALCHEMY_DATABASE_URI']
+    if uri.startswith('sqlite'):
+        # SQLite uses a single-connection pool; the pool settings do not apply
+        return {}
+
+    options = {
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+        'pool_pre_ping': config['DB_POOL_PRE_PING'],
+    }
+    timeout = config['DB_STATEMENT_TIMEOUT_MS']
+    if timeout and uri.startswith('postgresql'):
+        options['connect_args'] = {'options': f'-c statement_timeout={int(timeout)}'}
+    return options
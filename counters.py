@@ -0,0 +1,77 @@
+'''Denormalized counters on users and messages.
+
+Profile stats are read from counter columns instead of loading whole
+relationships just to count them. Every write path bumps the counters inside
+its own transaction with ``col = col + n`` updates, and ``recount_all`` rebuilds
+them in bulk from the follows, likes and messages tables.
+'''
+
+from sqlalchemy import func, select, update
+from models import db, Follows, Likes, Message, User
+from usercache import mark_changed
+
+
+def bump(model, row_id, **deltas):
+    '''Atomically adds deltas to counter columns of one row'''
+
+    values = {name: getattr(model, name) + delta for name, delta in deltas.items()}
+    db.session.execute(update(model).where(model.id == row_id).values(**values))
+    if model is User:
+        mark_changed(row_id)
+
+
+def followed(follower_id, followed_id, delta=1):
+    '''Counts a new follow (or an unfollow with delta=-1)'''
+
+    bump(User, follower_id, following_count=delta)
+    bump(User, followed_id, followers_count=delta)
+
+
+def message_posted(user_id, delta=1):
+    '''Counts a new message (or a deleted one with delta=-1)'''
+
+    bump(User, user_id, messages_count=delta)
+
+
+def liked(user_id, message_id, delta=1):
+    '''Counts a new like (or an unlike with delta=-1)'''
+
+    bump(User, user_id, likes_count=delta)
+    bump(Message, message_id, likes_count=delta)
+
+
+def message_deleted(message):
+    '''Uncounts a message and every like it had, before it is deleted'''
+
+    message_posted(message.user_id, -1)
+
+    likers = select(Likes.user_id).where(Likes.message_id == message.id)
+    db.session.execute(
+        update(User)
+        .where(User.id.in_(likers))
+        .values(likes_count=User.likes_count - 1),
+        execution_options={'synchronize_session': False}
+    )
+
+
+def recount_all():
+    '''Rebuilds every counter in bulk from the underlying tables'''
+
+    def count(column, where):
+        return select(func.count()).select_from(column.table).where(where).scalar_subquery()
+
+    db.session.execute(
+        update(User).values(
+            messages_count=count(Message.id, Message.user_id == User.id),
+            following_count=count(Follows.user_following_id, Follows.user_following_id == User.id),
+            followers_count=count(Follows.user_being_followed_id, Follows.user_being_followed_id == User.id),
+            likes_count=count(Likes.user_id, Likes.user_id == User.id),
+        ),
+        execution_options={'synchronize_session': False}
+    )
+    db.session.execute(
+        update(Message).values(
+            likes_count=count(Likes.message_id, Likes.message_id == Message.id),
+        ),
+        execution_options={'synchronize_session': False}
+    )
@@ -0,0 +1,267 @@
+'''Background account deletion.
+
+Deleting an account only marks the user deleted (``hide_user``), which hides
+them from feeds, lists, search and login straight away, and records a
+``DeletionJob``. The rows are then purged in stages by a worker, at most
+``DELETION_BATCH_SIZE`` rows per transaction:
+
+* ``likes``: likes the user gave
+* ``follows``: follow edges in either direction
+* ``message_likes``: likes on the user's messages
+* ``message_timelines``: timeline entries of the user's messages
+* ``messages``: the user's messages
+* ``timeline``: the user's own home timeline
+* ``user``: the user row itself
+
+Each batch fixes the affected counters, deletes its rows and saves the job's
+progress in one transaction, holding a lock on the job row, so a crash loses
+at most one uncommitted batch and the job picks up where it stopped. Unfinished
+jobs are picked up again when a worker starts.
+
+The worker is a thread in the app process (see jobs.py), fed by an in-memory
+queue, and started on the first request when ``DELETION_WORKER`` is on.
+``flask purge-deleted`` runs every pending job in the foreground instead.
+'''
+
+import logging
+from collections import Counter
+from datetime import datetime
+import click
+from flask import current_app
+from sqlalchemy import delete, or_, select, tuple_, update
+from werkzeug.local import LocalProxy
+from models import db, DeletionJob, Follows, Likes, Message, TimelineEntry, User
+from usercache import mark_changed
+from jobs import FAILED, FINISHED, SKIPPED, JobWorker
+from search import search_engine
+from followgraph import follow_graph
+import timeline
+
+logger = logging.getLogger(__name__)
+
+STAGES = ('likes', 'follows', 'message_likes', 'message_timelines', 'messages', 'timeline', 'user')
+
+def hide_user(user):
+    '''Marks a user deleted and queues the purge of their rows; the caller commits'''
+
+    user.deleted_at = datetime.utcnow()
+    user.profile_version += 1
+    mark_changed(user.id)
+    # merge, not add: SQLite can hand a purged user's id to a new account
+    db.session.merge(DeletionJob(
+        user_id=user.id,
+        stage=STAGES[0],
+        rows_deleted=0,
+        attempts=0,
+        last_error=None,
+        created_at=user.deleted_at,
+        finished_at=None
+    ))
+
+
+def decrement(model, column, ids):
+    '''Subtracts from a counter once per occurrence of each id'''
+
+    by_count = {}
+    for row_id, count in Counter(ids).items():
+        by_count.setdefault(count, []).append(row_id)
+
+    counter = getattr(model, column)
+    for count, row_ids in by_count.items():
+        db.session.execute(
+            update(model).where(model.id.in_(row_ids)).values({column: counter - count}),
+            execution_options={'synchronize_session': False}
+        )
+        if model is User:
+            for row_id in row_ids:
+                mark_changed(row_id)
+
+
+def purge_likes(user_id, limit):
+    message_ids = db.session.scalars(select(Likes.message_id).where(Likes.user_id == user_id).limit(limit)).all()
+    if message_ids:
+        decrement(Message, 'likes_count', message_ids)
+        db.session.execute(delete(Likes).where(Likes.user_id == user_id, Likes.message_id.in_(message_ids)))
+    return len(message_ids), []
+
+
+def purge_follows(user_id, limit):
+    rows = db.session.execute(
+        select(Follows.user_following_id, Follows.user_being_followed_id)
+        .where(or_(Follows.user_following_id == user_id, Follows.user_being_followed_id == user_id))
+        .limit(limit)
+    ).all()
+    if rows:
+        followed = [row.user_being_followed_id for row in rows if row.user_following_id == user_id]
+        decrement(User, 'followers_count', followed)
+        decrement(User, 'following_count',
+                  [row.user_following_id for row in rows if row.user_being_followed_id == user_id])
+        db.session.execute(
+            delete(Follows).where(
+                tuple_(Follows.user_following_id, Follows.user_being_followed_id).in_([tuple(row) for row in rows])
+            )
+        )
+        timeline.settle_authors(followed)
+    return len(rows), []
+
+
+def purge_message_likes(user_id, limit):
+    rows = db.session.execute(
+        select(Likes.user_id, Likes.message_id)
+        .join(Message, Message.id == Likes.message_id)
+        .where(Message.user_id == user_id)
+        .limit(limit)
+    ).all()
+    if rows:
+        decrement(User, 'likes_count', [row.user_id for row in rows if row.user_id != user_id])
+        db.session.execute(
+            delete(Likes).where(tuple_(Likes.user_id, Likes.message_id).in_([tuple(row) for row in rows]))
+        )
+    return len(rows), []
+
+
+def purge_message_timelines(user_id, limit):
+    rows = db.session.execute(
+        select(TimelineEntry.user_id, TimelineEntry.message_id)
+        .join(Message, Message.id == TimelineEntry.message_id)
+        .where(Message.user_id == user_id)
+        .limit(limit)
+    ).all()
+    if rows:
+        db.session.execute(
+            delete(TimelineEntry).where(
+                tuple_(TimelineEntry.user_id, TimelineEntry.message_id).in_([tuple(row) for row in rows])
+            )
+        )
+    return len(rows), []
+
+
+def purge_messages(user_id, limit):
+    message_ids = db.session.scalars(select(Message.id).where(Message.user_id == user_id).limit(limit)).all()
+    if message_ids:
+        db.session.execute(delete(Message).where(Message.id.in_(message_ids)))
+    return len(message_ids), message_ids
+
+
+def purge_timeline(user_id, limit):
+    batch = select(TimelineEntry.message_id).where(TimelineEntry.user_id == user_id).limit(limit)
+    result = db.session.execute(
+        delete(TimelineEntry).where(TimelineEntry.user_id == user_id, TimelineEntry.message_id.in_(batch))
+    )
+    return result.rowcount, []
+
+
+def purge_user(user_id, limit):
+    db.session.execute(delete(User).where(User.id == user_id))
+    mark_changed(user_id)
+    return 0, []
+
+
+PURGES = {
+    'likes': purge_likes,
+    'follows': purge_follows,
+    'message_likes': purge_message_likes,
+    'message_timelines': purge_message_timelines,
+    'messages': purge_messages,
+    'timeline': purge_timeline,
+    'user': purge_user,
+}
+
+
+def purge_batch(user_id, limit):
+    '''Runs one batch of a user's deletion job; returns True while there is more to do.
+
+    Returns False once the job is finished, and None when another worker holds it.
+    '''
+
+    job = (DeletionJob
+           .query
+           .filter_by(user_id=user_id, finished_at=None)
+           .with_for_update(skip_locked=True)
+           .first())
+    if job is None:
+        pending = db.session.scalar(
+            select(DeletionJob.user_id).where(DeletionJob.user_id == user_id, DeletionJob.finished_at.is_(None))
+        )
+        db.session.rollback()
+        return None if pending is not None else False
+
+    deleted, message_ids = PURGES[job.stage](user_id, limit)
+    job.rows_deleted += deleted
+    job.updated_at = datetime.utcnow()
+    if deleted < limit:
+        if job.stage == STAGES[-1]:
+            job.finished_at = job.updated_at
+        else:
+            job.stage = STAGES[STAGES.index(job.stage) + 1]
+    finished = job.finished_at is not None
+    if finished:
+        follow_graph.remove_user(user_id)
+    db.session.commit()
+
+    for message_id in message_ids:
+        search_engine.remove_message(message_id)
+    if finished:
+        search_engine.remove_user(user_id)
+    return not finished
+
+
+def run_job(user_id, limit=None):
+    '''Purges a deleted user's rows batch by batch, recording failures on the job.
+
+    Returns FINISHED, SKIPPED when another worker holds the job, or FAILED.
+    '''
+
+    limit = limit or current_app.config['DELETION_BATCH_SIZE']
+    try:
+        more = True
+        while more:
+            more = purge_batch(user_id, limit)
+    except Exception as error:
+        db.session.rollback()
+        logger.exception('Deleting user %s failed', user_id)
+        db.session.execute(
+            update(DeletionJob)
+            .where(DeletionJob.user_id == user_id)
+            .values(attempts=DeletionJob.attempts + 1, last_error=str(error)[:1000])
+        )
+        db.session.commit()
+        return FAILED
+    return SKIPPED if more is None else FINISHED
+
+
+def pending_jobs():
+    return db.session.scalars(
+        select(DeletionJob.user_id).where(DeletionJob.finished_at.is_(None)).order_by(DeletionJob.created_at)
+    ).all()
+
+
+class AccountDeleter(JobWorker):
+    '''Flask extension running deletion jobs on a background thread'''
+
+    settings = 'DELETION'
+    extension = 'account_deleter'
+    thread_name = 'account-deleter'
+
+    def init_app(self, app):
+        app.config.setdefault('DELETION_BATCH_SIZE', 1000)
+        super().init_app(app)
+        app.cli.add_command(purge_deleted_command)
+
+    def pending_jobs(self):
+        return pending_jobs()
+
+    def run_job(self, user_id):
+        return run_job(user_id)
+
+
+@click.command('purge-deleted')
+def purge_deleted_command():
+    '''Purges the rows of every deleted account that is still pending'''
+
+    finished = current_app.extensions['account_deleter'].run_pending()
+    click.echo(f'{finished} deletion jobs finished')
+
+
+# The current app's AccountDeleter; create_app makes one per app
+account_deleter = LocalProxy(lambda: current_app.extensions['account_deleter'])
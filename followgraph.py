@@ -0,0 +1,358 @@
+'''In-memory follow graph.
+
+Answers "does a follow b", follower/followee sets and mutual follows without
+loading ORM relationships. Each user's neighbours are kept as a sorted array of
+uint32 ids (4 bytes per edge, binary-search lookups); once a neighbour list is
+dense enough that a bitset over all user ids is smaller, it switches to a
+bitset (1 bit per possible neighbour, constant-time lookups).
+
+The graph is loaded from the follows table on first use. After
+``FOLLOW_GRAPH_TTL`` seconds one request starts a reload on a background thread
+while every request, that one included, keeps reading the old graph; the new
+one is swapped in whole once it is built, with any follows and unfollows made
+during the load replayed onto it.
+
+Follows, unfollows and deleted users are also written to ``follow_edits`` in
+the transaction that makes them (``add_edge``, ``remove_edge``,
+``remove_user``; the caller commits), and applied to this process's graph when
+it commits. Every request first applies the edits other processes wrote since
+its process last looked, one primary key range read, so follow buttons, ETags
+and live feed authors agree with the follows table in every worker. Ids that
+were skipped are looked for again for ``FOLLOW_EDIT_GRACE`` seconds, in case a
+transaction that took a lower id commits later. Reloads delete edits older than
+``FOLLOW_EDIT_RETENTION`` seconds; a graph older than that is reloaded before
+it is used.
+'''
+
+import threading
+import time
+from array import array
+from bisect import bisect_left, insort
+from datetime import datetime, timedelta
+from flask import current_app, g, has_request_context
+from sqlalchemy import delete, event, func, or_, select
+from sqlalchemy.orm import Session
+from werkzeug.local import LocalProxy
+from models import db, FollowEdit, Follows
+
+PENDING_EDITS = 'follow_graph_edits'
+
+# Most ids between two syncs that are watched for a late commit
+MAX_GAPS = 10000
+
+
+class NeighborSet:
+    '''A set of user ids stored as a sorted uint32 array or a bitset'''
+
+    __slots__ = ('ids', 'bits', 'size')
+
+    def __init__(self, ids=()):
+        self.ids = array('I', sorted(ids))
+        self.bits = None
+        self.size = len(self.ids)
+
+    def __contains__(self, user_id):
+        if self.bits is not None:
+            byte = user_id >> 3
+            return byte < len(self.bits) and bool(self.bits[byte] & (1 << (user_id & 7)))
+        position = bisect_left(self.ids, user_id)
+        return position < len(self.ids) and self.ids[position] == user_id
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        if self.bits is None:
+            return iter(self.ids)
+        return (byte << 3 | bit
+                for byte, value in enumerate(self.bits) if value
+                for bit in range(8) if value & (1 << bit))
+
+    def add(self, user_id):
+        if user_id in self:
+            return
+        self.size += 1
+        if self.bits is not None:
+            self._grow(user_id)
+            self.bits[user_id >> 3] |= 1 << (user_id & 7)
+        else:
+            insort(self.ids, user_id)
+
+    def discard(self, user_id):
+        if user_id not in self:
+            return
+        self.size -= 1
+        if self.bits is not None:
+            self.bits[user_id >> 3] &= ~(1 << (user_id & 7)) & 0xFF
+        else:
+            self.ids.pop(bisect_left(self.ids, user_id))
+
+    def compact(self, max_user_id):
+        '''Switches to a bitset when it takes less memory than the id array'''
+
+        if self.bits is None and self.size * self.ids.itemsize * 8 > max_user_id:
+            self.bits = bytearray()
+            self._grow(max_user_id)
+            for user_id in self.ids:
+                self.bits[user_id >> 3] |= 1 << (user_id & 7)
+            self.ids = array('I')
+
+    def _grow(self, user_id):
+        needed = (user_id >> 3) + 1
+        if needed > len(self.bits):
+            self.bits.extend(bytes(needed - len(self.bits)))
+
+    def nbytes(self):
+        return len(self.bits) if self.bits is not None else self.ids.itemsize * len(self.ids)
+
+
+EMPTY = NeighborSet()
+
+
+class Graph:
+    '''Follower and followee adjacency for every user'''
+
+    def __init__(self, edges=()):
+        self.following = {}
+        self.followers = {}
+        self.max_user_id = 0
+
+        # uint32 arrays rather than lists: 4 bytes per edge while loading, not ~36
+        following, followers = {}, {}
+        for follower_id, followed_id in edges:
+            following.setdefault(follower_id, array('I')).append(followed_id)
+            followers.setdefault(followed_id, array('I')).append(follower_id)
+            self.max_user_id = max(self.max_user_id, follower_id, followed_id)
+
+        for source, target in ((following, self.following), (followers, self.followers)):
+            for user_id, ids in source.items():
+                neighbors = NeighborSet(ids)
+                neighbors.compact(self.max_user_id)
+                target[user_id] = neighbors
+
+    def is_following(self, follower_id, followed_id):
+        return followed_id in self.following.get(follower_id, EMPTY)
+
+    def following_of(self, user_id):
+        return self.following.get(user_id, EMPTY)
+
+    def followers_of(self, user_id):
+        return self.followers.get(user_id, EMPTY)
+
+    def mutuals(self, user_id):
+        '''Ids of users that both follow and are followed by user_id'''
+
+        following, followers = self.following_of(user_id), self.followers_of(user_id)
+        if len(followers) < len(following):
+            following, followers = followers, following
+        return {other for other in following if other in followers}
+
+    def add_edge(self, follower_id, followed_id):
+        self.max_user_id = max(self.max_user_id, follower_id, followed_id)
+        self.following.setdefault(follower_id, NeighborSet()).add(followed_id)
+        self.followers.setdefault(followed_id, NeighborSet()).add(follower_id)
+
+    def remove_edge(self, follower_id, followed_id):
+        self.following_of(follower_id).discard(followed_id)
+        self.followers_of(followed_id).discard(follower_id)
+
+    def remove_user(self, user_id):
+        for followed_id in list(self.following.pop(user_id, ())):
+            self.followers_of(followed_id).discard(user_id)
+        for follower_id in list(self.followers.pop(user_id, ())):
+            self.following_of(follower_id).discard(user_id)
+
+    def nbytes(self):
+        return sum(n.nbytes() for adjacency in (self.following, self.followers) for n in adjacency.values())
+
+
+class FollowGraph:
+    '''Flask extension holding a Graph loaded from the follows table'''
+
+    def __init__(self, app=None):
+        self.graph = None
+        self.loaded_at = 0
+        # Edits made while a load runs, replayed onto the new graph; None when idle
+        self.edits = None
+        self.lock = threading.Lock()
+        # Held by whichever thread is loading, so only one load runs at a time
+        self.loading = threading.Lock()
+        # Newest follow_edits id applied, and lower ids not yet seen (id -> when first missed)
+        self.seen = 0
+        self.gaps = {}
+        self.syncing = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('FOLLOW_GRAPH_TTL', 300)
+        app.config.setdefault('FOLLOW_EDIT_GRACE', 10)
+        app.config.setdefault('FOLLOW_EDIT_RETENTION', 3600)
+        app.extensions['follow_graph'] = self
+        with self.lock:
+            self.graph = None
+
+        if not event.contains(Session, 'after_commit', _apply_edits):
+            event.listen(Session, 'after_rollback', _discard_edits)
+            event.listen(Session, 'after_commit', _apply_edits)
+
+    def edges(self):
+        return (db.session
+                .query(Follows.user_following_id, Follows.user_being_followed_id)
+                .execution_options(yield_per=10000))
+
+    def replay_from(self):
+        '''The follow_edits id a new graph is synced from: edits of the last FOLLOW_EDIT_GRACE seconds are replayed'''
+
+        grace = timedelta(seconds=current_app.config['FOLLOW_EDIT_GRACE'])
+        return db.session.scalar(
+            select(func.max(FollowEdit.id)).where(FollowEdit.created_at < datetime.utcnow() - grace)
+        ) or 0
+
+    def load(self):
+        '''Reads every follow edge into a fresh graph and swaps it in'''
+
+        with self.lock:
+            self.edits = []
+        try:
+            seen = self.replay_from()
+            graph = Graph(self.edges())
+        except Exception:
+            with self.lock:
+                self.edits = None
+            raise
+        with self.syncing, self.lock:
+            for name, args in self.edits:
+                getattr(graph, name)(*args)
+            self.edits = None
+            self.graph = graph
+            self.loaded_at = time.monotonic()
+            self.seen, self.gaps = seen, {}
+        return graph
+
+    def prune(self):
+        '''Deletes follow_edits older than FOLLOW_EDIT_RETENTION; every graph loaded since has them'''
+
+        retention = timedelta(seconds=current_app.config['FOLLOW_EDIT_RETENTION'])
+        db.session.execute(delete(FollowEdit).where(FollowEdit.created_at < datetime.utcnow() - retention))
+        db.session.commit()
+
+    def reload(self, app):
+        '''Background reload; the caller holds self.loading'''
+
+        try:
+            with app.app_context():
+                try:
+                    self.load()
+                    self.prune()
+                finally:
+                    db.session.remove()
+        except Exception:
+            app.logger.exception('Reloading the follow graph failed')
+        finally:
+            self.loading.release()
+
+    def sync(self):
+        '''Applies the follow_edits written since the last sync, by this process or any other'''
+
+        with self.syncing:
+            if self.graph is None:
+                return
+            newer = FollowEdit.id > self.seen
+            rows = db.session.execute(
+                select(FollowEdit.id, FollowEdit.action, FollowEdit.follower_id, FollowEdit.followed_id)
+                .where(or_(newer, FollowEdit.id.in_(list(self.gaps))) if self.gaps else newer)
+                .order_by(FollowEdit.id)
+            ).all()
+
+            now = time.monotonic()
+            fetched = set()
+            for row in rows:
+                fetched.add(row.id)
+                self.gaps.pop(row.id, None)
+                args = (row.follower_id,) if row.action == 'remove_user' else (row.follower_id, row.followed_id)
+                self.edit(row.action, *args)
+
+            # A lower id can commit after a higher one; look for it again until the grace period ends
+            newest = max(fetched, default=0)
+            if newest > self.seen:
+                for missing in range(max(self.seen + 1, newest - MAX_GAPS), newest):
+                    if missing not in fetched:
+                        self.gaps[missing] = now
+                self.seen = newest
+            grace = current_app.config['FOLLOW_EDIT_GRACE']
+            self.gaps = {edit_id: missed for edit_id, missed in self.gaps.items() if now - missed < grace}
+
+    def current(self):
+        '''The graph, loaded if missing; a stale one is returned while a reload runs.
+
+        Within a request, edits from other processes are applied first, once per request.
+        '''
+
+        loaded_at = self.loaded_at
+        age = time.monotonic() - loaded_at
+        if self.graph is None or age > current_app.config['FOLLOW_EDIT_RETENTION']:
+            # Older than the edit log: syncing could miss edits, so load before answering
+            with self.loading:
+                if self.graph is None or self.loaded_at == loaded_at:
+                    self.load()
+        elif age > current_app.config['FOLLOW_GRAPH_TTL'] and self.loading.acquire(blocking=False):
+            app = current_app._get_current_object()
+            threading.Thread(target=self.reload, args=(app,), name='follow-graph-reload', daemon=True).start()
+
+        if has_request_context() and not g.get('follow_graph_synced'):
+            g.follow_graph_synced = True
+            self.sync()
+        return self.graph
+
+    def is_following(self, follower_id, followed_id):
+        return self.current().is_following(follower_id, followed_id)
+
+    def following_of(self, user_id):
+        return self.current().following_of(user_id)
+
+    def followers_of(self, user_id):
+        return self.current().followers_of(user_id)
+
+    def mutuals(self, user_id):
+        return self.current().mutuals(user_id)
+
+    def edit(self, name, *args):
+        '''Applies an edit to the loaded graph and to any graph being loaded'''
+
+        with self.lock:
+            if self.graph is not None:
+                getattr(self.graph, name)(*args)
+            if self.edits is not None:
+                self.edits.append((name, args))
+
+    def record(self, name, *args):
+        '''Logs an edit in the current transaction; it is applied here when that commits'''
+
+        db.session.add(FollowEdit(action=name, follower_id=args[0], followed_id=args[1] if len(args) > 1 else None))
+        db.session.info.setdefault(PENDING_EDITS, []).append((self, name, args))
+
+    def add_edge(self, follower_id, followed_id):
+        '''Records a follow; the caller commits'''
+        self.record('add_edge', follower_id, followed_id)
+
+    def remove_edge(self, follower_id, followed_id):
+        '''Records an unfollow; the caller commits'''
+        self.record('remove_edge', follower_id, followed_id)
+
+    def remove_user(self, user_id):
+        '''Records a deleted user, dropping their edges; the caller commits'''
+        self.record('remove_user', user_id)
+
+
+def _discard_edits(session):
+    session.info.pop(PENDING_EDITS, None)
+
+
+def _apply_edits(session):
+    for graph, name, args in session.info.pop(PENDING_EDITS, ()):
+        graph.edit(name, *args)
+
+
+# The current app's FollowGraph; create_app makes one per app
+follow_graph = LocalProxy(lambda: current_app.extensions['follow_graph'])
@@ -0,0 +1,191 @@
+'''Cache of rendered message cards.
+
+Message lists render each message as a card (``messages/card.html``): the
+author's avatar and name, the date and the text. A card only changes when the
+author edits their profile, so rendered cards are cached under the message id,
+author id and author ``profile_version``. Cards contain nothing that depends on
+the viewer; pages draw the like button next to the card themselves.
+
+Templates fetch the cards for a whole list at once with ``message_cards``, so a
+shared backend needs one round trip per page. The default backend is an
+in-process LRU capped at ``FRAGMENT_CACHE_MAX_BYTES`` of HTML; set
+``FRAGMENT_CACHE_URL`` to a ``redis://`` URL to share cards between processes
+(needs the ``redis`` package).
+
+Hits, misses and an estimate of the rendering time saved (hits times the mean
+time to render a missed card) are at ``/_stats/fragments`` in debug mode.
+'''
+
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app, jsonify
+from markupsafe import Markup
+from werkzeug.local import LocalProxy
+
+CARD_TEMPLATE = 'messages/card.html'
+
+# Bump when messages/card.html changes, so cards rendered from the old template are not served
+CARD_VERSION = 2
+
+
+def card_key(message):
+    return f'card:{CARD_VERSION}:{message.id}:{message.user_id}:{message.user.profile_version}'
+
+
+class LocalBackend:
+    '''In-process LRU of rendered fragments, bounded by the total size of the HTML'''
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.evictions = 0
+
+    def get_many(self, keys):
+        found = {}
+        with self.lock:
+            for key in keys:
+                value = self.entries.get(key)
+                if value is not None:
+                    self.entries.move_to_end(key)
+                    found[key] = value
+        return found
+
+    def set_many(self, mapping):
+        with self.lock:
+            for key, value in mapping.items():
+                old = self.entries.pop(key, None)
+                if old is not None:
+                    self.size -= len(old)
+                self.entries[key] = value
+                self.size += len(value)
+            while self.size > self.max_bytes and self.entries:
+                key, value = self.entries.popitem(last=False)
+                self.size -= len(value)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.size, 'max_bytes': self.max_bytes,
+                    'evictions': self.evictions}
+
+
+class RedisBackend:
+    '''Fragments shared between processes in Redis, expiring after ttl seconds'''
+
+    def __init__(self, url, ttl):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def get_many(self, keys):
+        values = self.client.mget(keys) if keys else []
+        return {key: value.decode('utf-8') for key, value in zip(keys, values) if value is not None}
+
+    def set_many(self, mapping):
+        pipeline = self.client.pipeline(transaction=False)
+        for key, value in mapping.items():
+            pipeline.set(key, value.encode('utf-8'), ex=self.ttl)
+        pipeline.execute()
+
+    def clear(self):
+        for key in self.client.scan_iter(f'card:{CARD_VERSION}:*'):
+            self.client.delete(key)
+
+    def stats(self):
+        return {'backend': 'redis'}
+
+
+class FragmentCache:
+    '''Flask extension caching rendered message cards'''
+
+    def __init__(self, app=None):
+        self.backend = None
+        self.lock = threading.Lock()
+        self.reset_stats()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('FRAGMENT_CACHE_ENABLED', True)
+        app.config.setdefault('FRAGMENT_CACHE_MAX_BYTES', 16 * 1024 * 1024)
+        app.config.setdefault('FRAGMENT_CACHE_URL', None)
+        app.config.setdefault('FRAGMENT_CACHE_TTL', 24 * 60 * 60)
+
+        if app.config['FRAGMENT_CACHE_URL']:
+            self.backend = RedisBackend(app.config['FRAGMENT_CACHE_URL'], app.config['FRAGMENT_CACHE_TTL'])
+        else:
+            self.backend = LocalBackend(app.config['FRAGMENT_CACHE_MAX_BYTES'])
+        app.extensions['fragment_cache'] = self
+
+        app.add_template_global(self.message_cards)
+        app.add_url_rule('/_stats/fragments', 'fragment_cache_stats', self.stats_view)
+
+    def reset_stats(self):
+        with self.lock:
+            self.hits = self.misses = 0
+            self.render_seconds = 0.0
+
+    def render(self, message):
+        template = current_app.jinja_env.get_template(CARD_TEMPLATE)
+        return template.render(message=message)
+
+    def message_cards(self, messages):
+        '''Rendered cards for a list of messages, as a dict keyed by message id'''
+
+        if not current_app.config['FRAGMENT_CACHE_ENABLED']:
+            return {message.id: Markup(self.render(message)) for message in messages}
+
+        keys = {message.id: card_key(message) for message in messages}
+        found = self.backend.get_many(list(keys.values()))
+
+        cards, rendered = {}, {}
+        render_seconds = 0.0
+        for message in messages:
+            html = found.get(keys[message.id])
+            if html is None:
+                start = time.perf_counter()
+                html = rendered[keys[message.id]] = self.render(message)
+                render_seconds += time.perf_counter() - start
+            cards[message.id] = Markup(html)
+
+        if rendered:
+            self.backend.set_many(rendered)
+        with self.lock:
+            self.hits += len(messages) - len(rendered)
+            self.misses += len(rendered)
+            self.render_seconds += render_seconds
+        return cards
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            per_render = self.render_seconds / self.misses if self.misses else 0.0
+            stats = {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'render_ms_per_miss': per_render * 1000,
+                'render_ms_saved': self.hits * per_render * 1000,
+            }
+        stats.update(self.backend.stats())
+        return stats
+
+    def stats_view(self):
+        '''Exposes cache counters in debug mode for sizing the cache'''
+
+        if not current_app.debug:
+            return ('', 404)
+        return jsonify(self.stats())
+
+
+# The current app's FragmentCache; create_app makes one per app
+fragment_cache = LocalProxy(lambda: current_app.extensions['fragment_cache'])
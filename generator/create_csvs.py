@@ -3,75 +3,263 @@
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
 tweak the CSV formats or generate fewer/more rows.
+
+    python generator/create_csvs.py
+    python generator/create_csvs.py --users 1000000 --messages 100000000 \\
+        --follows 50000000 --processes 16 --seed 7
+
+Output is reproducible: the same sizes, --seed and --end give byte-identical
+files whatever --processes is. Work is split into fixed-size shards that are
+generated in parallel and concatenated in order. Nothing is fetched from the
+network: text comes from pools built once, in the parent process, with a
+seeded Faker and handed to every worker; images come from the URL pools in
+helpers.py.
+
+Message ids are time-ordered like the app's (see messageids.py): each shard
+sorts its timestamps and uses its index as the worker number, so ids are
+unique for up to 1024 message shards.
+
+Follower counts and posting activity follow a power law: user popularity is
+proportional to rank ** -alpha over a random ranking of users. Follow edges
+are sampled with NumPy directly from that distribution, without listing every
+possible pair.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import numpy as np
 from faker import Faker
-from helpers import get_random_datetime
+from helpers import HEADER_IMAGE_URLS, IMAGE_URLS
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from messageids import EPOCH_MS, MAX_SEQUENCE, MAX_WORKER, TIMESTAMP_SHIFT, WORKER_SHIFT
 
 MAX_WARBLER_LENGTH = 140
 
 USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
-MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
+MESSAGES_CSV_HEADERS = ['id', 'text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
 
 NUM_USERS = 300
 NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
-
-fake = Faker()
-
-# Generate random profile image URLs to use for users
-
-image_urls = [
-    f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
-    for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
-    for i in range(count)
-]
-
-# Generate random header image URLs to use for users
-
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
-
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
+NUM_FOLLOWS = 5000
+
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+SHARD_ROWS = 1000000
+POOL_SIZE = 20000
+YEAR_GAP = 2
+
+# Per-process state, set up once by init_worker
+pools = None
+popularity = None
+activity = None
+
+
+def build_pools(seed):
+    """Builds the text pools rows are drawn from."""
+
+    fake = Faker()
+    fake.seed_instance(seed)
+    return dict(
+        names=np.array([fake.user_name() for _ in range(POOL_SIZE)], dtype=object),
+        domains=np.array([fake.free_email_domain() for _ in range(50)], dtype=object),
+        bios=np.array([fake.sentence() for _ in range(POOL_SIZE)], dtype=object),
+        cities=np.array([fake.city() for _ in range(2000)], dtype=object),
+        texts=np.array([fake.paragraph()[:MAX_WARBLER_LENGTH] for _ in range(POOL_SIZE)], dtype=object),
+        images=np.array(IMAGE_URLS, dtype=object),
+        headers=np.array(HEADER_IMAGE_URLS, dtype=object),
+    )
+
+
+def power_law_cdf(num_users, alpha, rng):
+    """CDF over user ids 1..num_users where a user's weight is rank ** -alpha."""
+
+    weights = np.empty(num_users)
+    weights[rng.permutation(num_users)] = np.arange(1, num_users + 1, dtype=np.float64) ** -alpha
+    cdf = np.cumsum(weights)
+    return cdf / cdf[-1]
+
+
+def sample_users(cdf, rng, count):
+    """Draws count user ids (1-based) from a CDF."""
+
+    return np.minimum(np.searchsorted(cdf, rng.random(count), side='right'), len(cdf) - 1) + 1
+
+
+def init_worker(text_pools, seed, num_users, follow_alpha, message_alpha):
+    global pools, popularity, activity
+    pools = text_pools
+    popularity = power_law_cdf(num_users, follow_alpha, np.random.default_rng([seed, 1]))
+    activity = power_law_cdf(num_users, message_alpha, np.random.default_rng([seed, 2]))
+
+
+def pick(pool, rng, count):
+    return pool[rng.integers(0, len(pool), count)]
+
+
+def write_users(path, rng, start, stop):
+    count = stop - start
+    ids = np.arange(start + 1, stop + 1).astype(str).astype(object)
+    usernames = pick(pools['names'], rng, count) + ids
+    emails = usernames + '@' + pick(pools['domains'], rng, count)
+
+    with open(path, 'w', newline='') as out:
+        csv.writer(out).writerows(zip(
+            emails,
+            usernames,
+            pick(pools['images'], rng, count),
+            [PASSWORD] * count,
+            pick(pools['bios'], rng, count),
+            pick(pools['headers'], rng, count),
+            pick(pools['cities'], rng, count),
         ))
+    return count
+
+
+def message_ids(times, worker):
+    """Time-ordered ids for sorted timestamps, numbering messages within each millisecond."""
 
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
+    ms = times.astype('datetime64[ms]').astype(np.int64)
+    sequence = np.arange(len(ms)) - np.searchsorted(ms, ms)
+    if len(ms) and sequence.max() > MAX_SEQUENCE:
+        raise ValueError('more messages in one millisecond than a worker can number')
+    return ((ms - EPOCH_MS) << TIMESTAMP_SHIFT) | (worker << WORKER_SHIFT) | sequence
 
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
+
+def write_messages(path, rng, index, start, stop, end):
+    if index > MAX_WORKER:
+        raise ValueError(f'at most {MAX_WORKER + 1} message shards are supported; raise --shard-rows')
+    count = stop - start
+    span = np.timedelta64(YEAR_GAP * 365 * 24 * 60 * 60 * 1000000, 'us')
+    offsets = rng.integers(0, span.astype(np.int64), count).astype('timedelta64[us]')
+    times = np.sort(np.datetime64(end, 'us') - offsets)
+    timestamps = np.char.replace(np.datetime_as_string(times, unit='us'), 'T', ' ')
+
+    with open(path, 'w', newline='') as out:
+        csv.writer(out).writerows(zip(
+            message_ids(times, index),
+            pick(pools['texts'], rng, count),
+            timestamps,
+            sample_users(activity, rng, count),
         ))
+    return count
+
+
+def write_follows(path, rng, low, high, count):
+    """Writes count distinct follows whose follower id is in [low, high)."""
+
+    num_users = len(popularity)
+    count = min(count, (high - low) * (num_users - 1))
+    edges = np.empty(0, dtype=np.int64)
+
+    while len(edges) < count:
+        need = count - len(edges)
+        followers = rng.integers(low, high, need + need // 10 + 16)
+        followed = sample_users(popularity, rng, len(followers))
+        keep = followers != followed
+        keys = followers[keep].astype(np.int64) * (num_users + 1) + followed[keep]
+        edges = np.unique(np.concatenate([edges, keys]))
+
+    edges = rng.permutation(edges)[:count]
+    with open(path, 'w', newline='') as out:
+        csv.writer(out).writerows(zip(edges % (num_users + 1), edges // (num_users + 1)))
+    return count
+
+
+def run_shard(task):
+    table, index, seed, path, args = task
+    rng = np.random.default_rng([seed, ord(table[0]), index])
+    if table == 'users':
+        return write_users(path, rng, *args)
+    if table == 'messages':
+        return write_messages(path, rng, *args)
+    return write_follows(path, rng, *args)
+
+
+def plan(out_dir, seed, num_users, num_messages, num_follows, shard_rows, end):
+    """Splits every table into fixed-size shards."""
+
+    parts = os.path.join(out_dir, '.parts')
+    tasks = {'users': [], 'messages': [], 'follows': []}
+
+    for start in range(0, num_users, shard_rows):
+        index = len(tasks['users'])
+        path = os.path.join(parts, f'users-{index:05d}.csv')
+        tasks['users'].append(('users', index, seed, path, (start, min(start + shard_rows, num_users))))
+
+    for start in range(0, num_messages, shard_rows):
+        index = len(tasks['messages'])
+        path = os.path.join(parts, f'messages-{index:05d}.csv')
+        tasks['messages'].append(
+            ('messages', index, seed, path, (index, start, min(start + shard_rows, num_messages), end))
+        )
+
+    # Follows are sharded by follower id range so duplicate edges can only
+    # occur, and be removed, within a shard.
+    shards = max(1, -(-num_follows // shard_rows))
+    bounds = np.linspace(1, num_users + 1, shards + 1).astype(int)
+    for index in range(shards):
+        low, high = bounds[index], bounds[index + 1]
+        count = num_follows * (high - low) // num_users
+        if index == shards - 1:
+            count = num_follows - sum(task[4][2] for task in tasks['follows'])
+        path = os.path.join(parts, f'follows-{index:05d}.csv')
+        tasks['follows'].append(('follows', index, seed, path, (low, high, count)))
+
+    return tasks
+
+
+def concatenate(path, headers, parts):
+    with open(path, 'w', newline='') as out:
+        csv.writer(out).writerow(headers)
+        for part in parts:
+            with open(part, newline='') as source:
+                shutil.copyfileobj(source, out, 1 << 20)
+            os.remove(part)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLOWS)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--end', default=None, help='newest message timestamp, YYYY-MM-DD (default: now)')
+    parser.add_argument('--follow-alpha', type=float, default=1.0, help='power-law exponent for follower counts')
+    parser.add_argument('--message-alpha', type=float, default=0.8, help='power-law exponent for posting activity')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--shard-rows', type=int, default=SHARD_ROWS)
+    parser.add_argument('--out', default='generator')
+    args = parser.parse_args()
+
+    end = datetime.fromisoformat(args.end) if args.end else datetime.now().replace(microsecond=0)
+    tasks = plan(args.out, args.seed, args.users, args.messages, args.follows, args.shard_rows, end)
+    os.makedirs(os.path.join(args.out, '.parts'), exist_ok=True)
 
-# Generate follows.csv from random pairings of users
+    headers = {'users': USERS_CSV_HEADERS, 'messages': MESSAGES_CSV_HEADERS, 'follows': FOLLOWS_CSV_HEADERS}
+    with ProcessPoolExecutor(
+        max_workers=args.processes,
+        initializer=init_worker,
+        # Faker is slow; build the pools once rather than in every worker
+        initargs=(build_pools(args.seed), args.seed, args.users, args.follow_alpha, args.message_alpha)
+    ) as pool:
+        for table, shards in tasks.items():
+            started = time.perf_counter()
+            rows = sum(pool.map(run_shard, shards))
+            concatenate(os.path.join(args.out, f'{table}.csv'), headers[table], [task[3] for task in shards])
+            elapsed = time.perf_counter() - started
+            print(f'{table:<10}{rows:>14,} rows {elapsed:>8.1f}s {rows / max(elapsed, 1e-9):>12,.0f} rows/s')
 
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
+    os.rmdir(os.path.join(args.out, '.parts'))
 
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
 
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+if __name__ == '__main__':
+    main()
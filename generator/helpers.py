@@ -1,14 +1,61 @@
 """Support functions for CSV generation."""
 
-from datetime import datetime
-from random import uniform
+# Profile images served by randomuser.me; built from its URL scheme, no lookups needed.
 
+IMAGE_URLS = [
+    f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
+    for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
+    for i in range(count)
+]
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+# Header images previously fetched from the splashbase API, kept here so
+# generation works offline.
 
-    now = datetime.now()
-    then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+HEADER_IMAGE_URLS = [
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mnh0n9pHJW1st5lhmo1_1280.jpg",
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mnh0uemhCk1st5lhmo1_1280.jpg",
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mnh121HEWa1st5lhmo1_1280.jpg",
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mnh17lfd9R1st5lhmo1_1280.jpg",
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mnh1d7s3UD1st5lhmo1_1280.jpg",
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mnh1jdFvHR1st5lhmo1_1280.jpg",
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mnh1uhYnog1st5lhmo1_1280.jpg",
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mnh25vNOvI1st5lhmo1_1280.jpg",
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mnh29fxz111st5lhmo1_1280.jpg",
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mnh2m1hnS81st5lhmo1_1280.jpg",
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mo1h6tGOZf1st5lhmo1_1280.jpg",
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mo2wz2LTCs1st5lhmo1_1280.jpg",
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mo2x3aAnRH1st5lhmo1_1280.jpg",
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mo2x80NkDu1st5lhmo1_1280.jpg",
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mo2x9xqeef1st5lhmo1_1280.jpg",
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mo2xbk8JUK1st5lhmo1_1280.jpg",
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mo2xdqmle51st5lhmo1_1280.jpg",
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mo2xfarCvW1st5lhmo1_1280.jpg",
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mo2xgqdEFn1st5lhmo1_1280.jpg",
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mo2xijE2nr1st5lhmo1_1280.jpg",
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mopq4kHmAg1st5lhmo1_1280.jpg",
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mopq69jlcS1st5lhmo1_1280.jpg",
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mopq8fyQwI1st5lhmo1_1280.jpg",
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mopqamedKu1st5lhmo1_1280.jpg",
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mopqc3ZZcz1st5lhmo1_1280.jpg",
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mopqdfx05t1st5lhmo1_1280.jpg",
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mopqfpSTPN1st5lhmo1_1280.jpg",
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mopqhxFulr1st5lhmo1_1280.jpg",
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mopqj9QUeq1st5lhmo1_1280.jpg",
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mopqkkwK2M1st5lhmo1_1280.jpg",
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mp6rzyNlAN1st5lhmo1_1280.jpg",
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mp6s1hAudo1st5lhmo1_1280.jpg",
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mp6s32zb6l1st5lhmo1_1280.jpg",
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mp6s4dzqHA1st5lhmo1_1280.jpg",
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mp6s661UgK1st5lhmo1_1280.jpg",
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mp6s7lR1lS1st5lhmo1_1280.jpg",
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mp6s995bvI1st5lhmo1_1280.jpg",
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mp6sasSvPZ1st5lhmo1_1280.jpg",
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mp6scv2xrZ1st5lhmo1_1280.jpg",
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mpp6f50W261st5lhmo1_1280.jpg",
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mpp6gwrYvm1st5lhmo1_1280.jpg",
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mpp6l06zXi1st5lhmo1_1280.jpg",
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mpp6poZxE51st5lhmo1_1280.jpg",
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mpp6tjdFhf1st5lhmo1_1280.jpg",
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mpp6w0dxAm1st5lhmo1_1280.jpg",
+]
 
-    return datetime.fromtimestamp(random_timestamp)
@@ -0,0 +1,100 @@
+'''HTTP caching policy.
+
+Pages built from database rows get a weak ETag hashed from exactly the values
+the template shows. Views call ``not_modified`` with those values before
+rendering; if the client's ``If-None-Match`` matches, a 304 goes out without
+the template being rendered. Pages for logged-in users are ``private`` and
+pages for anonymous visitors are ``public``. Both use ``no-cache``, so caches
+store the page but revalidate it every time.
+
+Fingerprinted assets (assets.py) and other views that call ``cache_for`` with
+``immutable=True`` are cached for a year without revalidation, since their
+URLs change with their content. Plain ``/static/`` URLs do not, so they are
+``public, no-cache`` and revalidated against their ETag. Every other response
+is ``no-store``.
+'''
+
+import hashlib
+from datetime import timezone
+from flask import g, make_response, request, session
+
+# Lifetime for responses whose URL changes with their content
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+
+
+def make_etag(*parts):
+    '''Hashes the values a page is rendered from into an ETag'''
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+def viewer_key():
+    '''The parts of a page that depend on who is looking at it'''
+
+    user = g.get('user')
+    if user is None:
+        return None
+    return (user.id, user.profile_version)
+
+
+def not_modified(*parts, last_modified=None):
+    '''Registers validators for this response; returns a 304 if the client is up to date.
+
+    Pending flash messages are rendered into the page, so a page with flashes
+    waiting is never answered with a 304 and gets no validators.
+    '''
+
+    if '_flashes' in session:
+        return None
+
+    etag = make_etag(viewer_key(), *parts)
+    if last_modified is not None and last_modified.tzinfo is None:
+        last_modified = last_modified.replace(tzinfo=timezone.utc)
+    if last_modified is not None:
+        last_modified = last_modified.replace(microsecond=0)
+    g.cache_validators = (etag, last_modified)
+
+    if request.if_none_match:
+        fresh = request.if_none_match.contains_weak(etag)
+    elif last_modified is not None and request.if_modified_since is not None:
+        fresh = last_modified <= request.if_modified_since
+    else:
+        fresh = False
+
+    if not fresh:
+        return None
+    return make_response('', 304)
+
+
+def cache_for(max_age, immutable=False):
+    '''Marks this response as public and cacheable for max_age seconds'''
+
+    g.cache_lifetime = (max_age, immutable)
+
+
+def apply_policy(response):
+    '''Sets Cache-Control and validators on a response'''
+
+    if request.endpoint == 'static' and response.status_code in (200, 304):
+        response.headers['Cache-Control'] = 'public, no-cache'
+        return response
+
+    lifetime = g.pop('cache_lifetime', None)
+    if lifetime is not None and response.status_code in (200, 304):
+        max_age, immutable = lifetime
+        response.headers['Cache-Control'] = f'public, max-age={max_age}' + (', immutable' if immutable else '')
+        return response
+
+    validators = g.pop('cache_validators', None)
+    if validators is None or response.status_code not in (200, 304):
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+
+    etag, last_modified = validators
+    response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = last_modified
+
+    scope = 'public' if g.get('user') is None else 'private'
+    response.headers['Cache-Control'] = f'{scope}, no-cache'
+    response.vary.add('Cookie')
+    return response
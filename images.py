@@ -0,0 +1,482 @@
+'''Avatar and header image proxy.
+
+``User.image_url`` and ``header_image_url`` point anywhere on the web, at any
+size. Templates link to ``/img/<user_id>/<kind>/<size>?v=<profile_version>``
+instead (built by the ``image_src`` template global), where kind is ``avatar``
+or ``header`` and size is one of ``IMAGE_SIZES[kind]``:
+
+* The source is fetched once and stored under the SHA-256 of its bytes, with a
+  small entry mapping the URL to that hash, so users sharing a picture (the
+  default avatar) share one copy and every variant made from it.
+* Avatars are cropped to a square of size pixels and headers scaled to fit in
+  size pixels, then saved as WebP for browsers that accept it and JPEG (PNG
+  when the image has transparency) for the rest.
+* Originals, variants and URL entries live in an on-disk LRU under
+  ``IMAGE_CACHE_DIR`` holding at most ``IMAGE_CACHE_MAX_BYTES``.
+* The URL changes whenever the profile does, so responses are ``immutable``
+  for a year. A request with an old ``v`` is redirected to the current URL.
+
+Sources are fetched only from public addresses: each hop of a redirect chain
+is resolved and checked before it is requested, and the whole download must
+finish within ``IMAGE_SOURCE_DEADLINE`` seconds. A source that cannot be
+fetched or is not an image is replaced by the default picture for its kind,
+cached for ``IMAGE_RETRY_AFTER`` seconds only, and not fetched again until
+then. Source URLs can carry tokens, so they are never logged.
+'''
+
+import hashlib
+import io
+import ipaddress
+import os
+import socket
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urljoin, urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from flask import abort, current_app, redirect, request, send_file, url_for
+from sqlalchemy import select
+from werkzeug.local import LocalProxy
+from werkzeug.security import safe_join
+from httpcache import cache_for, STATIC_MAX_AGE
+from models import db, User
+from PIL import Image, ImageOps
+
+KINDS = {'avatar': User.image_url, 'header': User.header_image_url}
+
+# Bump when resizing or encoding changes, so variants made the old way are not served
+VARIANT_VERSION = 1
+
+MAX_REDIRECTS = 5
+
+SIGNATURES = [
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+]
+
+
+class ImageError(Exception):
+    '''A source could not be fetched or is not an image'''
+
+
+def sniff(data):
+    '''The image type of some bytes from their signature, or None'''
+
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    for signature, mimetype in SIGNATURES:
+        if data.startswith(signature):
+            return mimetype
+    return None
+
+
+def source_key(url):
+    '''The store name of the entry mapping a source URL to its hash'''
+    return 'url-' + hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+
+def public_address(address):
+    '''Whether an IP address is on the public internet: not private, loopback, link-local or reserved'''
+
+    address = ipaddress.ip_address(address)
+    if address.version == 6 and address.ipv4_mapped:
+        address = address.ipv4_mapped
+    return address.is_global and not address.is_multicast
+
+
+def shut(sock):
+    '''Ends a connection, so a read blocked on it returns'''
+
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+class PublicOnly:
+    '''Connection mixin refusing a non-public peer before anything is sent to it.
+
+    Checked on the connected socket, so a host that resolves differently than it
+    did for HttpSource.check_host is caught too. Keeps the socket as raw_sock.
+    '''
+
+    def _new_conn(self):
+        sock = super()._new_conn()
+        if not public_address(sock.getpeername()[0]):
+            sock.close()
+            raise OSError('not a public address')
+        self.raw_sock = sock
+        return sock
+
+
+class PublicHTTPConnection(PublicOnly, HTTPConnection):
+    pass
+
+
+class PublicHTTPSConnection(PublicOnly, HTTPSConnection):
+    pass
+
+
+class PublicHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = PublicHTTPConnection
+
+
+class PublicHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = PublicHTTPSConnection
+
+
+class PublicAdapter(HTTPAdapter):
+    '''requests adapter whose connections only reach public addresses'''
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': PublicHTTPConnectionPool,
+            'https': PublicHTTPSConnectionPool,
+        }
+
+
+class HttpSource:
+    '''Fetches http(s) sources from public addresses, and reads /static/ ones from the static folder'''
+
+    def __init__(self, static_folder, timeout, max_bytes, deadline):
+        self.static_folder = static_folder
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.deadline = deadline
+        self.session = requests.Session()
+        # An environment proxy would be the peer instead of the source host
+        self.session.trust_env = False
+        self.session.mount('http://', PublicAdapter())
+        self.session.mount('https://', PublicAdapter())
+
+    def check_host(self, url):
+        '''Resolves the host of a URL; raises ImageError unless every address it has is public'''
+
+        parts = urlparse(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ImageError('not an http(s) URL')
+        try:
+            port = parts.port or (443 if parts.scheme == 'https' else 80)
+            addresses = socket.getaddrinfo(parts.hostname, port, proto=socket.IPPROTO_TCP)
+        except (OSError, ValueError) as error:
+            raise ImageError('host does not resolve') from error
+        for family, kind, proto, name, address in addresses:
+            if not public_address(address[0]):
+                raise ImageError('host is not on a public address')
+
+    def remaining(self, deadline):
+        '''The timeout for the next request, or ImageError once the deadline has passed'''
+
+        left = deadline - time.monotonic()
+        if left <= 0:
+            raise ImageError('download took too long')
+        return min(self.timeout, left)
+
+    def fetch(self, url):
+        if url.startswith('/static/'):
+            path = safe_join(self.static_folder, url[len('/static/'):])
+            if path is None or not os.path.isfile(path):
+                raise ImageError('no such static file')
+            with open(path, 'rb') as source:
+                return source.read(self.max_bytes + 1)
+
+        deadline = time.monotonic() + self.deadline
+        try:
+            # Redirects are followed here, so every hop is checked before it is requested
+            for hop in range(MAX_REDIRECTS + 1):
+                self.check_host(url)
+                with self.session.get(url, stream=True, allow_redirects=False,
+                                      timeout=self.remaining(deadline)) as response:
+                    if response.is_redirect:
+                        url = urljoin(url, response.headers['Location'])
+                        continue
+                    response.raise_for_status()
+                    return self.read(response, deadline)
+        except requests.RequestException as error:
+            if time.monotonic() >= deadline:
+                raise ImageError('download took too long') from error
+            # Not str(error): it holds the URL
+            raise ImageError(f'fetch failed ({type(error).__name__})') from error
+        raise ImageError('too many redirects')
+
+    def read(self, response, deadline):
+        '''Reads a body of at most max_bytes (plus one chunk), cutting the connection at the deadline'''
+
+        # Each read waits for a whole chunk, which a slow sender can stretch far past the deadline
+        watchdog = threading.Timer(self.remaining(deadline), shut, args=(response.raw.connection.raw_sock,))
+        watchdog.start()
+        try:
+            data = bytearray()
+            for chunk in response.iter_content(64 * 1024):
+                data += chunk
+                if len(data) > self.max_bytes:
+                    break
+                self.remaining(deadline)
+        finally:
+            watchdog.cancel()
+        self.remaining(deadline)
+        return bytes(data)
+
+
+class FileSource:
+    '''Reads every source from one directory by the last part of its URL; a stand-in for HttpSource'''
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def fetch(self, url):
+        path = safe_join(self.directory, url.rstrip('/').rsplit('/', 1)[-1])
+        if path is None or not os.path.isfile(path):
+            raise ImageError(f'no file for {url}')
+        with open(path, 'rb') as source:
+            return source.read()
+
+
+class DiskLRU:
+    '''Files in a directory, least recently used removed first once they pass max_bytes.
+
+    Each process tracks the files it knows of, starting from what is on disk.
+    Writes go through a temporary file, so readers never see part of a file.
+    '''
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+        found = []
+        for root, dirs, files in os.walk(directory):
+            for name in files:
+                if not name.startswith('.'):
+                    stat = os.stat(os.path.join(root, name))
+                    found.append((stat.st_mtime, name, stat.st_size))
+        for mtime, name, size in sorted(found):
+            self.entries[name] = size
+            self.size += size
+
+    def path(self, name):
+        return os.path.join(self.directory, name[:2], name)
+
+    def get(self, name):
+        '''The path of a stored file, or None'''
+
+        path = self.path(name)
+        with self.lock:
+            if name not in self.entries:
+                return None
+            self.entries.move_to_end(name)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # Evicted by another process
+            with self.lock:
+                self.size -= self.entries.pop(name, 0)
+            return None
+        return path
+
+    def put(self, name, data):
+        path = self.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.')
+        with os.fdopen(descriptor, 'wb') as out:
+            out.write(data)
+        os.replace(temporary, path)
+
+        with self.lock:
+            self.size += len(data) - self.entries.pop(name, 0)
+            self.entries[name] = len(data)
+            evicted = []
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                old, size = self.entries.popitem(last=False)
+                self.size -= size
+                self.evictions += 1
+                evicted.append(old)
+        for old in evicted:
+            try:
+                os.remove(self.path(old))
+            except FileNotFoundError:
+                pass
+        return path
+
+    def read(self, name):
+        path = self.get(name)
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as stored:
+                return stored.read()
+        except FileNotFoundError:
+            return None
+
+    def stats(self):
+        with self.lock:
+            return {'files': len(self.entries), 'bytes': self.size, 'max_bytes': self.max_bytes,
+                    'evictions': self.evictions}
+
+
+def render(data, kind, size, webp):
+    '''Resizes an original for kind and size; returns the encoded bytes'''
+
+    image = ImageOps.exif_transpose(Image.open(io.BytesIO(data)))
+    if kind == 'avatar':
+        image = ImageOps.fit(image, (size, size), Image.LANCZOS)
+    else:
+        image.thumbnail((size, size), Image.LANCZOS)
+
+    out = io.BytesIO()
+    transparent = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+    if webp:
+        image.save(out, 'WEBP', quality=80, method=4)
+    elif transparent:
+        image.save(out, 'PNG', optimize=True)
+    else:
+        image.convert('RGB').save(out, 'JPEG', quality=82, optimize=True, progressive=True)
+    return out.getvalue()
+
+
+class ImageProxy:
+    '''Flask extension serving resized user images from a disk cache'''
+
+    def __init__(self, app=None):
+        self.store = None
+        self.source = None
+        # Hashed URL -> when it failed, oldest first
+        self.failed = OrderedDict()
+        self.lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app, source=None):
+        app.config.setdefault('IMAGE_CACHE_DIR', os.path.join(app.instance_path, 'images'))
+        app.config.setdefault('IMAGE_CACHE_MAX_BYTES', 512 * 1024 * 1024)
+        app.config.setdefault('IMAGE_SIZES', {'avatar': (64, 96, 140, 400), 'header': (400, 1200)})
+        app.config.setdefault('IMAGE_SOURCE_TIMEOUT', 5)
+        app.config.setdefault('IMAGE_SOURCE_DEADLINE', 10)
+        app.config.setdefault('IMAGE_SOURCE_MAX_BYTES', 10 * 1024 * 1024)
+        app.config.setdefault('IMAGE_RETRY_AFTER', 300)
+        app.config.setdefault('IMAGE_FAILED_MAX', 10000)
+
+        self.store = DiskLRU(app.config['IMAGE_CACHE_DIR'], app.config['IMAGE_CACHE_MAX_BYTES'])
+        self.source = source or HttpSource(app.static_folder, app.config['IMAGE_SOURCE_TIMEOUT'],
+                                           app.config['IMAGE_SOURCE_MAX_BYTES'],
+                                           app.config['IMAGE_SOURCE_DEADLINE'])
+        with self.lock:
+            self.failed = OrderedDict()
+        app.extensions['images'] = self
+
+        app.add_template_global(self.image_src)
+        app.add_url_rule('/img/<int:user_id>/<kind>/<int:size>', 'image_proxy', self.view)
+
+    def image_src(self, user, kind, size):
+        '''The proxied URL of a user's avatar or header at a size from IMAGE_SIZES'''
+        return url_for('image_proxy', user_id=user.id, kind=kind, size=size, v=user.profile_version)
+
+    def mark_failed(self, key):
+        '''Records a failed source, dropping expired records and the oldest past IMAGE_FAILED_MAX'''
+
+        config = current_app.config
+        now = time.monotonic()
+        with self.lock:
+            self.failed.pop(key, None)
+            self.failed[key] = now
+            while self.failed:
+                oldest = next(iter(self.failed.values()))
+                if len(self.failed) <= config['IMAGE_FAILED_MAX'] and now - oldest < config['IMAGE_RETRY_AFTER']:
+                    break
+                self.failed.popitem(last=False)
+
+    def failed_recently(self, key):
+        with self.lock:
+            failed_at = self.failed.get(key)
+        return failed_at is not None and time.monotonic() - failed_at < current_app.config['IMAGE_RETRY_AFTER']
+
+    def original(self, url):
+        '''(hash, bytes) of a source, fetched unless it is already stored'''
+
+        key = source_key(url)
+        digest = self.store.read(key)
+        if digest is not None:
+            data = self.store.read(digest.decode())
+            if data is not None:
+                return digest.decode(), data
+
+        if self.failed_recently(key):
+            raise ImageError('source failed recently')
+        try:
+            data = self.source.fetch(url)
+            if len(data) > current_app.config['IMAGE_SOURCE_MAX_BYTES']:
+                raise ImageError('source is too large')
+            if sniff(data) is None:
+                raise ImageError('source is not an image')
+        except ImageError:
+            self.mark_failed(key)
+            raise
+
+        digest = hashlib.sha256(data).hexdigest()
+        self.store.put(digest, data)
+        self.store.put(key, digest.encode())
+        return digest, data
+
+    def variant(self, url, kind, size, webp):
+        '''The path of a resized copy of a source, made if it is not stored yet'''
+
+        digest, data = self.original(url)
+        name = f'{digest}-{VARIANT_VERSION}-{kind}-{size}-{"webp" if webp else "compat"}'
+        path = self.store.get(name)
+        if path is None:
+            try:
+                path = self.store.put(name, render(data, kind, size, webp))
+            except (OSError, ValueError, Image.DecompressionBombError) as error:
+                self.mark_failed(source_key(url))
+                raise ImageError(str(error)) from error
+        return path
+
+    def view(self, user_id, kind, size):
+        '''Serves a user's avatar or header, resized'''
+
+        config = current_app.config
+        if kind not in KINDS or size not in config['IMAGE_SIZES'][kind]:
+            abort(404)
+        user = db.session.execute(
+            select(KINDS[kind], User.profile_version).where(User.id == user_id, User.deleted_at.is_(None))
+        ).first()
+        if user is None:
+            abort(404)
+        url, version = user
+        if request.args.get('v', type=int) != version:
+            return redirect(url_for('image_proxy', user_id=user_id, kind=kind, size=size, v=version))
+
+        webp = request.accept_mimetypes['image/webp'] > 0
+        try:
+            path = self.variant(url, kind, size, webp)
+            cache_for(config.get('STATIC_MAX_AGE', STATIC_MAX_AGE), immutable=True)
+        except ImageError as error:
+            current_app.logger.info('image %s for user %s: %s', kind, user_id, error)
+            try:
+                path = self.variant(KINDS[kind].default.arg, kind, size, webp)
+            except ImageError:
+                abort(404)
+            cache_for(config['IMAGE_RETRY_AFTER'])
+
+        with open(path, 'rb') as stored:
+            mimetype = sniff(stored.read(16))
+        response = send_file(path, mimetype=mimetype, etag=os.path.basename(path), conditional=True)
+        response.vary.add('Accept')
+        return response
+
+    def stats(self):
+        return self.store.stats()
+
+
+# The current app's ImageProxy; create_app makes one per app
+image_proxy = LocalProxy(lambda: current_app.extensions['images'])
@@ -0,0 +1,266 @@
+'''Lightweight per-request instrumentation.
+
+For every request it records:
+
+* total database time, from engine events, and the SQL statement count kept
+  by QueryBudget (querybudget.py), so statements are counted once
+* template render time, from Flask's template signals
+* time spent waiting for password hashing
+* total handler time
+
+These go out as a ``Server-Timing`` header, as one structured log line per
+request on the ``instrumentation`` logger, and, when ``METRICS_ENDPOINT`` is
+set, as Prometheus text at that path (per process). Only the dev profile sets
+it by default; with ``METRICS_TOKEN`` set, the endpoint also requires an
+``Authorization: Bearer <token>`` header. For pages streamed with
+``stream_page`` the log line and metrics are recorded once the body is sent;
+the header, sent first, covers only the work before the body.
+
+``PROFILE_ENDPOINT`` names one endpoint to profile: a ``PROFILE_SAMPLE_RATE``
+fraction of its requests run under cProfile and the stats are written to
+``PROFILE_DIR``.
+
+With ``INSTRUMENTATION_ENABLED`` off no hooks, signals or engine listeners are
+installed, so requests pay nothing.
+'''
+
+import cProfile
+import hmac
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from flask import Response, abort, before_render_template, current_app, g, has_request_context, request, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from werkzeug.local import LocalProxy
+from streaming import after_stream, streaming
+
+logger = logging.getLogger(__name__)
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+PHASES = ('db', 'template', 'bcrypt')
+
+
+def _active():
+    return has_request_context() and 'timings' in g
+
+
+def record(phase, seconds, count=1):
+    '''Adds time spent in a phase to the current request'''
+
+    if _active():
+        g.timings[phase] += seconds
+        g.timing_counts[phase] += count
+
+
+@contextmanager
+def timed(phase):
+    '''Times a block of code as a phase of the current request'''
+
+    if not _active():
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(phase, time.perf_counter() - start)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _active():
+        conn.info.setdefault('instrumentation_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('instrumentation_start')
+    if starts and _active():
+        # Time only: QueryBudget already counts the statement
+        g.timings['db'] += time.perf_counter() - starts.pop()
+
+
+def _before_render(sender, template, context, **extra):
+    if _active():
+        g.template_start = time.perf_counter()
+
+
+def _rendered(sender, template, context, **extra):
+    if _active() and 'template_start' in g:
+        record('template', time.perf_counter() - g.pop('template_start'))
+
+
+class Metrics:
+    '''Per-endpoint counters and latency histograms, rendered as Prometheus text'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self.buckets = defaultdict(lambda: [0] * len(BUCKETS))
+        self.phase_seconds = defaultdict(float)
+        self.statements = defaultdict(int)
+
+    def observe(self, endpoint, method, status, total, timings, counts):
+        key = (endpoint, method, status)
+        with self.lock:
+            self.requests[key] += 1
+            self.seconds[(endpoint, method)] += total
+            buckets = self.buckets[(endpoint, method)]
+            for i, bound in enumerate(BUCKETS):
+                if total <= bound:
+                    buckets[i] += 1
+            for phase in PHASES:
+                self.phase_seconds[(endpoint, phase)] += timings[phase]
+            self.statements[endpoint] += counts['db']
+
+    def render(self):
+        lines = []
+        with self.lock:
+            lines.append('# TYPE warbler_requests_total counter')
+            for (endpoint, method, status), value in sorted(self.requests.items()):
+                lines.append(f'warbler_requests_total{{endpoint="{endpoint}",method="{method}",status="{status}"}} {value}')
+
+            lines.append('# TYPE warbler_request_duration_seconds histogram')
+            for (endpoint, method), buckets in sorted(self.buckets.items()):
+                labels = f'endpoint="{endpoint}",method="{method}"'
+                total = sum(value for (e, m, s), value in self.requests.items() if (e, m) == (endpoint, method))
+                for bound, value in zip(BUCKETS, buckets):
+                    lines.append(f'warbler_request_duration_seconds_bucket{{{labels},le="{bound}"}} {value}')
+                lines.append(f'warbler_request_duration_seconds_bucket{{{labels},le="+Inf"}} {total}')
+                lines.append(f'warbler_request_duration_seconds_sum{{{labels}}} {self.seconds[(endpoint, method)]:.6f}')
+                lines.append(f'warbler_request_duration_seconds_count{{{labels}}} {total}')
+
+            lines.append('# TYPE warbler_phase_seconds_total counter')
+            for (endpoint, phase), value in sorted(self.phase_seconds.items()):
+                lines.append(f'warbler_phase_seconds_total{{endpoint="{endpoint}",phase="{phase}"}} {value:.6f}')
+
+            lines.append('# TYPE warbler_sql_statements_total counter')
+            for endpoint, value in sorted(self.statements.items()):
+                lines.append(f'warbler_sql_statements_total{{endpoint="{endpoint}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+class Instrumentation:
+    '''Flask extension recording where each request spends its time'''
+
+    def __init__(self, app=None):
+        self.metrics = Metrics()
+        self.profiling = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('INSTRUMENTATION_ENABLED', True)
+        app.config.setdefault('SERVER_TIMING', True)
+        app.config.setdefault('INSTRUMENTATION_LOG', True)
+        app.config.setdefault('METRICS_ENDPOINT', None)
+        app.config.setdefault('METRICS_TOKEN', None)
+        app.config.setdefault('PROFILE_ENDPOINT', None)
+        app.config.setdefault('PROFILE_SAMPLE_RATE', 0.01)
+        app.config.setdefault('PROFILE_DIR', os.path.join(app.instance_path, 'profiles'))
+        app.extensions['instrumentation'] = self
+
+        if not app.config['INSTRUMENTATION_ENABLED']:
+            return
+
+        if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        before_render_template.connect(_before_render, app)
+        template_rendered.connect(_rendered, app)
+
+        app.before_request(self.start)
+        app.after_request(self.finish)
+        app.teardown_request(self.stop_profile)
+
+        if app.config['METRICS_ENDPOINT']:
+            app.add_url_rule(app.config['METRICS_ENDPOINT'], 'metrics', self.metrics_view)
+
+    def start(self):
+        g.request_start = time.perf_counter()
+        g.timings = defaultdict(float)
+        g.timing_counts = defaultdict(int)
+
+        config = current_app.config
+        if (request.endpoint == config['PROFILE_ENDPOINT']
+                and random.random() < config['PROFILE_SAMPLE_RATE']
+                and self.profiling.acquire(blocking=False)):
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+    def totals(self):
+        '''Time so far, and time and counts per phase, for the current request'''
+
+        counts = g.timing_counts
+        counts['db'] = g.get('query_count', 0)
+        return time.perf_counter() - g.request_start, g.timings, counts
+
+    def finish(self, response):
+        if 'timings' not in g:
+            return response
+
+        if current_app.config['SERVER_TIMING']:
+            total, timings, counts = self.totals()
+            entries = [f'db;dur={timings["db"] * 1000:.1f};desc="{counts["db"]} queries"']
+            for phase in ('template', 'bcrypt'):
+                if counts[phase]:
+                    entries.append(f'{phase};dur={timings[phase] * 1000:.1f}')
+            entries.append(f'app;dur={total * 1000:.1f}')
+            response.headers.add('Server-Timing', ', '.join(entries))
+
+        # The header is sent before a streamed body; the log and metrics wait for it
+        if streaming():
+            after_stream(lambda: self.observe(response))
+        else:
+            self.observe(response)
+        return response
+
+    def observe(self, response):
+        '''Logs the request and adds it to the metrics'''
+
+        total, timings, counts = self.totals()
+        for name in ('request_start', 'timings', 'timing_counts'):
+            g.pop(name)
+
+        if current_app.config['INSTRUMENTATION_LOG'] and logger.isEnabledFor(logging.INFO):
+            logger.info(json.dumps({
+                'method': request.method,
+                'path': request.path,
+                'endpoint': request.endpoint,
+                'status': response.status_code,
+                'total_ms': round(total * 1000, 2),
+                'db_ms': round(timings['db'] * 1000, 2),
+                'db_statements': counts['db'],
+                'template_ms': round(timings['template'] * 1000, 2),
+                'bcrypt_ms': round(timings['bcrypt'] * 1000, 2),
+            }))
+
+        self.metrics.observe(request.endpoint, request.method, response.status_code, total, timings, counts)
+
+    def stop_profile(self, exc):
+        profiler = g.pop('profiler', None)
+        if profiler is None:
+            return
+        try:
+            profiler.disable()
+            directory = current_app.config['PROFILE_DIR']
+            os.makedirs(directory, exist_ok=True)
+            name = f'{request.endpoint}-{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}-{threading.get_ident()}.prof'
+            profiler.dump_stats(os.path.join(directory, name))
+        finally:
+            self.profiling.release()
+
+    def metrics_view(self):
+        token = current_app.config['METRICS_TOKEN']
+        if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+            abort(404)
+        return Response(self.metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+# The current app's Instrumentation; create_app makes one per app
+instrumentation = LocalProxy(lambda: current_app.extensions['instrumentation'])
@@ -0,0 +1,103 @@
+'''Background job workers.
+
+A worker is a thread in the app process, fed by an in-memory queue of job
+keys, and started on the first request when its ``<SETTINGS>_WORKER`` setting
+is on. When the queue stays empty for ``<SETTINGS>_POLL_INTERVAL`` seconds it
+rescans its jobs table, so unfinished jobs, left by a crash or queued by
+another process, are picked up too. Subclasses say which jobs are pending and
+how to run one; see deletion.py and timeline.py.
+'''
+
+import logging
+import queue
+import threading
+from flask import current_app
+from models import db
+
+logger = logging.getLogger(__name__)
+
+# What run_job did with a job
+FINISHED = 'finished'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+
+
+class JobWorker:
+    '''Flask extension running jobs on a background thread'''
+
+    # Prefix of the worker's config keys, its app.extensions key and thread name
+    settings = None
+    extension = None
+    thread_name = None
+
+    def __init__(self, app=None):
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault(f'{self.settings}_WORKER', True)
+        app.config.setdefault(f'{self.settings}_POLL_INTERVAL', 60)
+        app.extensions[self.extension] = self
+        if app.config[f'{self.settings}_WORKER']:
+            app.before_request(self.start)
+
+    def pending_jobs(self):
+        '''Keys of every unfinished job, oldest first'''
+        raise NotImplementedError
+
+    def run_job(self, key):
+        '''Runs a job to the end; returns FINISHED, SKIPPED or FAILED'''
+        raise NotImplementedError
+
+    def enqueue(self, key):
+        self.queue.put(key)
+        if current_app.config[f'{self.settings}_WORKER']:
+            self.start()
+
+    def start(self):
+        '''Starts the worker thread if it is not running'''
+
+        if self.thread is not None and self.thread.is_alive():
+            return
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            app = current_app._get_current_object()
+            self.thread = threading.Thread(target=self.work, args=(app,), name=self.thread_name, daemon=True)
+            self.thread.start()
+
+    def work(self, app):
+        '''Worker loop: runs queued jobs and rescans for unfinished ones when idle'''
+
+        rescan = True
+        while True:
+            if rescan:
+                with app.app_context():
+                    try:
+                        for key in self.pending_jobs():
+                            self.queue.put(key)
+                    except Exception:
+                        logger.exception('Scanning for %s jobs failed', self.thread_name)
+                    finally:
+                        db.session.remove()
+
+            try:
+                key = self.queue.get(timeout=app.config[f'{self.settings}_POLL_INTERVAL'])
+            except queue.Empty:
+                rescan = True
+                continue
+
+            rescan = False
+            with app.app_context():
+                try:
+                    self.run_job(key)
+                finally:
+                    db.session.remove()
+
+    def run_pending(self):
+        '''Runs every unfinished job in the foreground; returns how many finished'''
+
+        return sum(self.run_job(key) == FINISHED for key in self.pending_jobs())
@@ -0,0 +1,85 @@
+'''Likes.
+
+A like is one ``(user_id, message_id)`` row, keyed on that pair, and is
+counted in ``Message.likes_count`` and ``User.likes_count`` (see counters.py).
+The message to like is looked up with ``likeable_message``, which locks its
+author ``FOR SHARE`` so the deletion worker cannot purge them meanwhile.
+Pages never load a viewer's likes: they ask ``liked_ids`` which of the message
+ids on the page the viewer has liked, one primary key lookup for the whole
+page.
+
+Liking is an ``INSERT ... ON CONFLICT DO NOTHING`` and unliking a ``DELETE``;
+the counters are bumped only when a row was actually inserted or deleted, in
+the same transaction, so repeated or racing requests cannot double count. The
+caller commits.
+
+Databases created before this key still have the surrogate ``id`` and a
+unique ``message_id``; ``flask migrate`` moves them over
+(``migrations/v0001_likes_key.py``).
+'''
+
+from sqlalchemy import delete, select
+from sqlalchemy.dialects import postgresql, sqlite
+from models import db, Likes, Message, User
+import counters
+
+INSERTS = {
+    'postgresql': postgresql.insert,
+    'sqlite': sqlite.insert,
+}
+
+
+def liked_ids(user_id, message_ids):
+    '''The set of message_ids the user has liked'''
+
+    if not message_ids:
+        return set()
+    return set(db.session.scalars(
+        select(Likes.message_id).where(Likes.user_id == user_id, Likes.message_id.in_(message_ids))
+    ))
+
+
+def likeable_message(message_id):
+    '''The message, or None if it or its author is gone; locks the author FOR SHARE until the caller commits'''
+
+    return db.session.scalar(
+        select(Message)
+        .join(Message.user)
+        .where(Message.id == message_id, User.deleted_at.is_(None))
+        .with_for_update(read=True, of=User)
+    )
+
+
+def like_message(user_id, message_id):
+    '''Likes a message; returns False if it was already liked'''
+
+    insert = INSERTS[db.engine.dialect.name]
+    result = db.session.execute(
+        insert(Likes).values(user_id=user_id, message_id=message_id).on_conflict_do_nothing()
+    )
+    if not result.rowcount:
+        return False
+    counters.liked(user_id, message_id)
+    return True
+
+
+def unlike_message(user_id, message_id):
+    '''Removes a like; returns False if there was none'''
+
+    result = db.session.execute(
+        delete(Likes).where(Likes.user_id == user_id, Likes.message_id == message_id),
+        execution_options={'synchronize_session': False}
+    )
+    if not result.rowcount:
+        return False
+    counters.liked(user_id, message_id, -1)
+    return True
+
+
+def toggle_like(user_id, message_id):
+    '''Unlikes a liked message and likes any other; returns whether it ends up liked'''
+
+    if unlike_message(user_id, message_id):
+        return False
+    like_message(user_id, message_id)
+    return True
@@ -0,0 +1,346 @@
+'''Live home timeline over server-sent events.
+
+``GET /stream/timeline`` keeps a response open and pushes each new message from
+the accounts the logged-in user follows (and their own) as a ``message`` event
+carrying the rendered feed item (``messages/item.html``, card and like form),
+so an open home page grows by deltas instead of being reloaded.
+
+Messages go through a publish/subscribe broker. Every node's broker keeps a
+bounded queue per open stream and routes events by author to the streams that
+follow them; ``new_message`` publishes, and the follow views publish ``follow``
+and ``unfollow`` events so open streams start or stop receiving an author.
+
+* Queues hold at most ``LIVE_QUEUE_SIZE`` events. A client that cannot keep up
+  has its whole backlog coalesced into a single ``gap`` event with a count,
+  after which the client refetches its feed instead of replaying the backlog.
+  A stream also starts with a ``gap`` when the feed has messages newer than
+  ``Last-Event-ID`` on a reconnect, or than ``?since=`` (the newest message
+  the page was rendered with).
+* A comment line is sent after ``LIVE_HEARTBEAT`` quiet seconds, so proxies
+  keep the connection open and dead clients are noticed on the next write.
+* Streams end after ``LIVE_MAX_AGE`` seconds and the browser reconnects, so
+  long-lived connections move to fresh workers.
+
+The broker fans events out over a pluggable bus. The default ``LocalBus``
+delivers within the process, which is all a single node needs. ``Hub`` is an
+in-process stand-in for a shared bus between nodes: each attached broker gets
+every event serialized and on its own thread, as it would over the network.
+Set ``LIVE_BUS_URL`` to a ``redis://`` URL to use Redis pub/sub between
+processes (needs the ``redis`` package).
+
+Each open stream holds a worker for up to ``LIVE_MAX_AGE`` seconds, which would
+starve a pool of sync workers, so ``LIVE_ENABLED`` is off unless the profile
+turns it on: the dev and test profiles do, and prod does only when
+``WORKER_CLASS`` names a cooperative gunicorn worker (see config.py).
+'''
+
+import json
+import queue
+import threading
+import time
+from collections import deque
+from flask import Response, current_app, g, render_template, request
+from werkzeug.local import LocalProxy
+from followgraph import follow_graph
+from fragments import fragment_cache
+import timeline
+
+CHANNEL = 'warbler:live'
+
+
+def sse(event, data, event_id=None):
+    '''One server-sent event'''
+
+    lines = f'id: {event_id}\n' if event_id is not None else ''
+    return f'{lines}event: {event}\ndata: {json.dumps(data)}\n\n'
+
+
+class Subscription:
+    '''One open stream: the authors it receives and a bounded queue of events'''
+
+    def __init__(self, user_id, authors, size):
+        self.user_id = user_id
+        self.authors = set(authors)
+        self.events = deque()
+        self.size = size
+        self.dropped = 0
+        self.closed = False
+        self.ready = threading.Condition()
+
+    def put(self, event):
+        with self.ready:
+            if len(self.events) >= self.size:
+                # The client refetches its feed after a gap, which covers everything queued
+                self.dropped += len(self.events)
+                self.events.clear()
+            self.events.append(event)
+            self.ready.notify()
+
+    def get(self, timeout):
+        '''Waits up to timeout for events; returns (events, dropped) and empties the queue'''
+
+        with self.ready:
+            if not self.events and not self.dropped and not self.closed:
+                self.ready.wait(timeout)
+            events, dropped = list(self.events), self.dropped
+            self.events.clear()
+            self.dropped = 0
+            return events, dropped
+
+    def close(self):
+        with self.ready:
+            self.closed = True
+            self.ready.notify()
+
+
+class Broker:
+    '''Routes published events to the open streams of this node'''
+
+    def __init__(self, bus, queue_size=100):
+        self.queue_size = queue_size
+        self.by_author = {}
+        self.by_user = {}
+        self.lock = threading.Lock()
+        self.bus = bus
+        bus.start(self.deliver)
+
+    def subscribe(self, user_id, authors):
+        subscription = Subscription(user_id, authors, self.queue_size)
+        with self.lock:
+            self.by_user.setdefault(user_id, set()).add(subscription)
+            for author_id in subscription.authors:
+                self.by_author.setdefault(author_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscription.close()
+        with self.lock:
+            self._discard(self.by_user, subscription.user_id, subscription)
+            for author_id in subscription.authors:
+                self._discard(self.by_author, author_id, subscription)
+
+    def publish(self, event):
+        self.bus.publish(event)
+
+    def deliver(self, event):
+        '''Handles an event from the bus'''
+
+        kind = event['type']
+        with self.lock:
+            if kind == 'message':
+                subscriptions = list(self.by_author.get(event['user_id'], ()))
+            else:
+                self._refollow(kind, event['user_id'], event['followed_id'])
+                return
+        for subscription in subscriptions:
+            subscription.put(event)
+
+    def _refollow(self, kind, user_id, followed_id):
+        for subscription in self.by_user.get(user_id, ()):
+            if kind == 'follow':
+                subscription.authors.add(followed_id)
+                self.by_author.setdefault(followed_id, set()).add(subscription)
+            else:
+                subscription.authors.discard(followed_id)
+                self._discard(self.by_author, followed_id, subscription)
+
+    @staticmethod
+    def _discard(index, key, subscription):
+        subscriptions = index.get(key)
+        if subscriptions is not None:
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del index[key]
+
+    def stats(self):
+        with self.lock:
+            return {'streams': sum(len(subscriptions) for subscriptions in self.by_user.values()),
+                    'authors': len(self.by_author)}
+
+    def close(self):
+        self.bus.close()
+
+
+class LocalBus:
+    '''Delivers events in the publishing thread, within this process'''
+
+    def start(self, deliver):
+        self.deliver = deliver
+
+    def publish(self, event):
+        self.deliver(event)
+
+    def close(self):
+        pass
+
+
+class Hub:
+    '''Stand-in for a bus shared by several nodes, for running them in one process'''
+
+    def __init__(self):
+        self.nodes = []
+        self.lock = threading.Lock()
+
+    def bus(self):
+        '''A bus for one more node attached to the hub'''
+        return HubBus(self)
+
+    def broadcast(self, payload):
+        with self.lock:
+            nodes = list(self.nodes)
+        for node in nodes:
+            node.inbox.put(payload)
+
+
+class HubBus:
+    '''A node's connection to a Hub: events arrive serialized, on a listener thread'''
+
+    def __init__(self, hub):
+        self.hub = hub
+        self.inbox = queue.Queue()
+
+    def start(self, deliver):
+        self.deliver = deliver
+        with self.hub.lock:
+            self.hub.nodes.append(self)
+        self.thread = threading.Thread(target=self.listen, daemon=True)
+        self.thread.start()
+
+    def listen(self):
+        while True:
+            payload = self.inbox.get()
+            if payload is None:
+                return
+            self.deliver(json.loads(payload))
+
+    def publish(self, event):
+        self.hub.broadcast(json.dumps(event))
+
+    def close(self):
+        with self.hub.lock:
+            self.hub.nodes.remove(self)
+        self.inbox.put(None)
+        self.thread.join()
+
+
+class RedisBus:
+    '''Events shared between processes over a Redis pub/sub channel'''
+
+    def __init__(self, url):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+
+    def start(self, deliver):
+        self.pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(**{CHANNEL: lambda message: deliver(json.loads(message['data']))})
+        self.thread = self.pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    def publish(self, event):
+        self.client.publish(CHANNEL, json.dumps(event))
+
+    def close(self):
+        self.thread.stop()
+        self.pubsub.close()
+
+
+class LiveFeed:
+    '''Flask extension serving /stream/timeline from a broker'''
+
+    def __init__(self, app=None):
+        self.broker = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app, bus=None):
+        app.config.setdefault('LIVE_ENABLED', False)
+        app.config.setdefault('LIVE_BUS_URL', None)
+        app.config.setdefault('LIVE_QUEUE_SIZE', 100)
+        app.config.setdefault('LIVE_HEARTBEAT', 15)
+        app.config.setdefault('LIVE_MAX_AGE', 300)
+        app.config.setdefault('LIVE_RETRY_MS', 3000)
+
+        if self.broker is not None:
+            self.broker.close()
+        if bus is None:
+            bus = RedisBus(app.config['LIVE_BUS_URL']) if app.config['LIVE_BUS_URL'] else LocalBus()
+        self.broker = Broker(bus, app.config['LIVE_QUEUE_SIZE'])
+        app.extensions['live_feed'] = self
+
+        app.add_url_rule('/stream/timeline', 'live_timeline', self.stream_view)
+
+    def publish_message(self, message):
+        '''Pushes a new, committed message to the streams following its author'''
+
+        if not current_app.config['LIVE_ENABLED']:
+            return
+        card = fragment_cache.message_cards([message])[message.id]
+        # Nobody has liked a new message yet, so the item is the same for every follower
+        html = render_template('messages/item.html', msg=message, card=card, liked=False)
+        self.broker.publish({'type': 'message', 'id': str(message.id), 'user_id': message.user_id,
+                             'html': html})
+
+    def followed(self, user_id, followed_id):
+        if current_app.config['LIVE_ENABLED']:
+            self.broker.publish({'type': 'follow', 'user_id': user_id, 'followed_id': followed_id})
+
+    def unfollowed(self, user_id, followed_id):
+        if current_app.config['LIVE_ENABLED']:
+            self.broker.publish({'type': 'unfollow', 'user_id': user_id, 'followed_id': followed_id})
+
+    def stream_view(self):
+        '''The logged-in user's timeline as server-sent events'''
+
+        if not current_app.config['LIVE_ENABLED']:
+            return ('', 404)
+        if not g.user:
+            return ('', 401)
+
+        config = current_app.config
+        authors = set(follow_graph.following_of(g.user.id))
+        authors.add(g.user.id)
+        subscription = self.broker.subscribe(g.user.id, authors)
+
+        # Messages posted since the page was rendered or the last stream ended
+        newest = next(iter(timeline.home_ids(g.user.id, 1)), None)
+        since = request.headers.get('Last-Event-ID') or request.args.get('since')
+        missed = bool(since and since.isdigit() and newest and newest > int(since))
+
+        response = Response(
+            self.events(subscription, newest, missed, config['LIVE_HEARTBEAT'], config['LIVE_MAX_AGE'],
+                        config['LIVE_RETRY_MS']),
+            mimetype='text/event-stream'
+        )
+        response.headers['Cache-Control'] = 'no-store'
+        # Tell nginx not to buffer the stream
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
+    def events(self, subscription, newest, missed, heartbeat, max_age, retry_ms):
+        '''The body of a stream; runs after the request has ended, so it touches no app state'''
+
+        deadline = time.monotonic() + max_age
+        try:
+            # Sets the id the browser sends back as Last-Event-ID when it reconnects
+            yield f'retry: {retry_ms}\n' + (f'id: {newest}\n\n' if newest else '\n')
+            if missed:
+                yield sse('gap', {'dropped': None})
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                events, dropped = subscription.get(min(heartbeat, remaining))
+                if dropped:
+                    yield sse('gap', {'dropped': dropped})
+                for event in events:
+                    yield sse('message', {'id': event['id'], 'html': event['html']}, event['id'])
+                if not events and not dropped:
+                    if subscription.closed:
+                        return
+                    yield ': heartbeat\n\n'
+        finally:
+            self.broker.unsubscribe(subscription)
+
+
+# The current app's LiveFeed; create_app makes one per app
+live_feed = LocalProxy(lambda: current_app.extensions['live_feed'])
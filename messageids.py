@@ -0,0 +1,202 @@
+'''Time-ordered 64-bit message ids.
+
+A message id packs, from the high bits down:
+
+* 41 bits: milliseconds since ``EPOCH_MS`` (2010-01-01 UTC), good until 2079
+* 10 bits: the id of the worker process that made it
+* 12 bits: a per-worker sequence within the millisecond
+
+so ids sort by creation time, and feeds and profiles order and paginate on the
+``messages.id`` primary key alone. A worker never repeats or goes back: within
+one millisecond, or if the clock steps backwards, it keeps counting from the
+last millisecond it used, moving on to the next one when the sequence runs out.
+
+Each process takes its worker id on its first message: from the
+``MESSAGE_ID_WORKER`` setting if set, else, on PostgreSQL, by leasing one of
+the 1024 rows of ``message_id_leases``, else from the process id. A forked
+child takes a new one. A lease lasts ``MESSAGE_ID_LEASE_TTL`` seconds (by the
+database's clock) and is renewed on the first message after half of that has
+passed; a process whose lease was taken over while it was idle leases another
+id before making more. When all 1024 ids are leased, making a message fails
+with ``WorkerIdsExhausted`` rather than sharing an id. ``Message.timestamp`` is
+taken from the id, so it follows the same clock as the ordering.
+'''
+
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from flask import current_app, has_app_context
+from sqlalchemy import text
+
+EPOCH_MS = 1262304000000
+SEQUENCE_BITS = 12
+WORKER_BITS = 10
+WORKER_SHIFT = SEQUENCE_BITS
+TIMESTAMP_SHIFT = SEQUENCE_BITS + WORKER_BITS
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+MAX_WORKER = (1 << WORKER_BITS) - 1
+
+LEASE_TABLE = 'message_id_leases'
+DEFAULT_LEASE_TTL = 600
+
+CLAIM_EXPIRED = f'''
+    UPDATE {LEASE_TABLE} SET holder = :holder, expires_at = now() + make_interval(secs => :ttl)
+    WHERE worker = (
+        SELECT worker FROM {LEASE_TABLE} WHERE expires_at < now() ORDER BY worker LIMIT 1 FOR UPDATE SKIP LOCKED
+    )
+    AND expires_at < now()
+    RETURNING worker'''
+
+CLAIM_NEW = f'''
+    INSERT INTO {LEASE_TABLE} (worker, holder, expires_at)
+    SELECT candidate, :holder, now() + make_interval(secs => :ttl)
+    FROM generate_series(0, :max_worker) AS candidate
+    WHERE candidate NOT IN (SELECT worker FROM {LEASE_TABLE})
+    ORDER BY candidate LIMIT 1
+    ON CONFLICT (worker) DO NOTHING
+    RETURNING worker'''
+
+RENEW = f'''
+    UPDATE {LEASE_TABLE} SET expires_at = now() + make_interval(secs => :ttl)
+    WHERE worker = :worker AND holder = :holder
+    RETURNING worker'''
+
+# Tries at a free id when other processes take the same ones first
+CLAIM_ATTEMPTS = 5
+
+
+class WorkerIdsExhausted(RuntimeError):
+    '''Raised when every worker id is leased by a live process'''
+
+
+def make_id(ms, worker, sequence=0):
+    '''Packs a Unix time in milliseconds, a worker and a sequence number into an id'''
+
+    return ((ms - EPOCH_MS) << TIMESTAMP_SHIFT) | (worker << WORKER_SHIFT) | sequence
+
+
+def timestamp_of(message_id):
+    '''The UTC creation time encoded in an id, as a naive datetime like the timestamp column'''
+
+    ms = (message_id >> TIMESTAMP_SHIFT) + EPOCH_MS
+    return datetime(1970, 1, 1) + timedelta(milliseconds=ms)
+
+
+class IdGenerator:
+    '''Makes increasing ids for one worker'''
+
+    def __init__(self, worker, clock=time.time):
+        if not 0 <= worker <= MAX_WORKER:
+            raise ValueError(f'worker must be between 0 and {MAX_WORKER}')
+        self.worker = worker
+        self.clock = clock
+        self.last_ms = -1
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+    def next_id(self):
+        with self.lock:
+            ms = int(self.clock() * 1000)
+            if ms > self.last_ms:
+                self.last_ms, self.sequence = ms, 0
+            elif self.sequence < MAX_SEQUENCE:
+                self.sequence += 1
+            else:
+                self.last_ms, self.sequence = self.last_ms + 1, 0
+            return make_id(self.last_ms, self.worker, self.sequence)
+
+
+class Lease:
+    '''A worker id leased from message_id_leases'''
+
+    def __init__(self, worker, holder, ttl, started):
+        self.worker = worker
+        self.holder = holder
+        self.ttl = ttl
+        # Counted from before the database set expires_at, so never later than it
+        self.renew_at = started + ttl / 2
+
+    def due(self):
+        return time.monotonic() >= self.renew_at
+
+    def renew(self, engine):
+        '''Extends the lease; returns False if another process has taken it over'''
+
+        started = time.monotonic()
+        with engine.begin() as conn:
+            renewed = conn.execute(text(RENEW), dict(worker=self.worker, holder=self.holder, ttl=self.ttl)).scalar()
+        if renewed is None:
+            return False
+        self.renew_at = started + self.ttl / 2
+        return True
+
+
+def lease_ttl():
+    return current_app.config.get('MESSAGE_ID_LEASE_TTL', DEFAULT_LEASE_TTL) if has_app_context() else DEFAULT_LEASE_TTL
+
+
+def claim_worker(engine, ttl, workers=MAX_WORKER + 1):
+    '''Leases a free or expired worker id, in its own transaction'''
+
+    holder = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+    for _ in range(CLAIM_ATTEMPTS):
+        started = time.monotonic()
+        with engine.begin() as conn:
+            params = dict(holder=holder, ttl=ttl, max_worker=workers - 1)
+            worker = conn.execute(text(CLAIM_EXPIRED), params).scalar()
+            if worker is None:
+                worker = conn.execute(text(CLAIM_NEW), params).scalar()
+            if worker is None:
+                free = conn.scalar(text(f'SELECT count(*) < :workers FROM {LEASE_TABLE}'), dict(workers=workers))
+        if worker is not None:
+            return Lease(worker, holder, ttl, started)
+        if not free:
+            break
+    raise WorkerIdsExhausted(f'all {workers} message id workers are leased')
+
+
+_generator = None
+_generator_pid = None
+_lease = None
+_generator_lock = threading.Lock()
+
+
+def allocate_worker(connection):
+    '''Picks this process's worker id; on PostgreSQL, leases it'''
+
+    global _lease
+
+    configured = current_app.config.get('MESSAGE_ID_WORKER') if has_app_context() else None
+    if configured is not None:
+        _lease = None
+        return configured
+    if connection.dialect.name == 'postgresql':
+        # A connection of its own: the lease must commit whatever the message's transaction does
+        _lease = claim_worker(connection.engine, lease_ttl())
+        return _lease.worker
+    _lease = None
+    return os.getpid() & MAX_WORKER
+
+
+def next_message_id(context):
+    '''Column default for messages.id'''
+
+    global _generator, _generator_pid
+
+    if _generator is None or _generator_pid != os.getpid() or (_lease is not None and _lease.due()):
+        with _generator_lock:
+            if _generator is None or _generator_pid != os.getpid():
+                _generator = IdGenerator(allocate_worker(context.connection))
+                _generator_pid = os.getpid()
+            elif _lease is not None and _lease.due() and not _lease.renew(context.connection.engine):
+                _generator = IdGenerator(allocate_worker(context.connection))
+    return _generator.next_id()
+
+
+def message_timestamp(context):
+    '''Column default for messages.timestamp: the time in the message's id'''
+
+    return timestamp_of(context.get_current_parameters()['id'])
@@ -0,0 +1,162 @@
+'''Versioned schema migrations.
+
+Every module here named ``v<NNNN>_<name>.py`` is one migration, applied in
+name order by ``flask migrate``. A migration has an ``upgrade(conn)`` function,
+runs in its own transaction, and is recorded by name in ``schema_migrations``.
+``DIALECTS`` limits it to the databases it was written for.
+
+A migration with ``TRANSACTIONAL = False`` runs in autocommit mode instead, so
+it can build indexes with ``create_index``, which uses ``CREATE INDEX
+CONCURRENTLY`` on PostgreSQL and does not block writes to the table. Such a
+migration must be safe to re-run after a failure part way through.
+
+New databases are built from the models by ``db.create_all()`` and then
+stamped as fully migrated (``seed.py`` does this), so migrations only run
+against databases that were created before them. ``v0000_baseline`` covers a
+database made by the original app, before there were migrations: it adds what
+the models gained outside the later migrations, so ``flask migrate`` brings
+such a database to the current schema.
+
+    flask migrate            # applies pending migrations
+    flask migrate --status   # lists applied and pending migrations
+    flask migrate --stamp    # records every migration as applied
+'''
+
+import importlib
+import pkgutil
+from datetime import datetime
+import click
+from sqlalchemy import Column, DateTime, MetaData, Table, Text, insert, select, text
+from models import db
+
+metadata = MetaData()
+
+schema_migrations = Table(
+    'schema_migrations',
+    metadata,
+    Column('version', Text, primary_key=True),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+
+class MigrationError(Exception):
+    '''Raised when a migration cannot run against this database'''
+
+
+def available():
+    '''(version, module) pairs for every migration, oldest first'''
+
+    return sorted(
+        (info.name, importlib.import_module(f'{__name__}.{info.name}'))
+        for info in pkgutil.iter_modules(__path__)
+        if info.name.startswith('v')
+    )
+
+
+def applied(conn):
+    '''Versions already recorded, creating the bookkeeping table if needed'''
+
+    metadata.create_all(conn)
+    return set(conn.scalars(select(schema_migrations.c.version)))
+
+
+def pending(engine):
+    with engine.begin() as conn:
+        done = applied(conn)
+    return [(version, module) for version, module in available() if version not in done]
+
+
+def record(conn, version):
+    '''Marks a migration as applied'''
+
+    conn.execute(insert(schema_migrations).values(version=version, applied_at=datetime.utcnow()))
+
+
+def create_index(conn, name, table, columns, unique=False):
+    '''Builds an index without locking out writes; for TRANSACTIONAL = False migrations.
+
+    On PostgreSQL an index left invalid by an earlier failed build is dropped
+    and built again.
+    '''
+
+    unique = 'UNIQUE ' if unique else ''
+    columns = ', '.join(columns)
+    if conn.dialect.name != 'postgresql':
+        conn.execute(text(f'CREATE {unique}INDEX IF NOT EXISTS {name} ON {table} ({columns})'))
+        return
+
+    invalid = conn.scalar(text(
+        'SELECT NOT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = :name'
+    ), {'name': name})
+    if invalid:
+        conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS {name}'))
+    conn.execute(text(f'CREATE {unique}INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({columns})'))
+
+
+def upgrade(engine):
+    '''Applies every pending migration in order; returns the versions applied'''
+
+    ran = []
+    for version, module in pending(engine):
+        dialects = getattr(module, 'DIALECTS', None)
+        if dialects and engine.dialect.name not in dialects:
+            raise MigrationError(
+                f'{version} only runs on {", ".join(dialects)}; recreate this database with seed.py'
+            )
+        if getattr(module, 'TRANSACTIONAL', True):
+            with engine.begin() as conn:
+                if conn.dialect.name == 'postgresql':
+                    # Rewrites of large tables must not hit the app's statement_timeout
+                    conn.execute(text('SET LOCAL statement_timeout = 0'))
+                module.upgrade(conn)
+                record(conn, version)
+        else:
+            with engine.connect() as conn:
+                conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+                postgres = conn.dialect.name == 'postgresql'
+                if postgres:
+                    conn.execute(text('SET statement_timeout = 0'))
+                try:
+                    module.upgrade(conn)
+                    record(conn, version)
+                finally:
+                    if postgres:
+                        # The connection goes back to the pool; restore the app's timeout
+                        conn.execute(text('RESET statement_timeout'))
+        ran.append(version)
+    return ran
+
+
+def stamp(engine):
+    '''Records every migration as applied, for a database created from the models'''
+
+    with engine.begin() as conn:
+        done = applied(conn)
+        rows = [dict(version=version, applied_at=datetime.utcnow())
+                for version, module in available() if version not in done]
+        if rows:
+            conn.execute(insert(schema_migrations), rows)
+
+
+@click.command('migrate')
+@click.option('--status', is_flag=True, help='list applied and pending migrations')
+@click.option('--stamp', 'stamp_only', is_flag=True, help='record every migration as applied')
+def migrate_command(status, stamp_only):
+    '''Applies pending schema migrations'''
+
+    if status:
+        waiting = {version for version, module in pending(db.engine)}
+        for version, module in available():
+            click.echo(f'{"pending" if version in waiting else "applied"}  {version}')
+    elif stamp_only:
+        stamp(db.engine)
+        click.echo('all migrations recorded as applied')
+    else:
+        try:
+            ran = upgrade(db.engine)
+        except MigrationError as error:
+            raise click.ClickException(str(error))
+        for version in ran:
+            click.echo(f'applied {version}')
+        if not ran:
+            click.echo('nothing to migrate')
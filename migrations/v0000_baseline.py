@@ -0,0 +1,119 @@
+'''Brings a database made by the original app up to the schema v0001 starts from.
+
+The original app built its tables with ``db.create_all()`` and recorded no
+migrations. Since then the models gained, outside any migration:
+
+* ``users``: ``profile_version``, the ``messages_count``, ``following_count``,
+  ``followers_count`` and ``likes_count`` counters, and ``deleted_at``
+* ``messages.likes_count``
+* ``timeline_entries``, created here as it was before v0002, with a
+  ``timestamp`` column that v0002 drops
+* ``deletion_jobs``
+* the trigram indexes for search, on PostgreSQL
+
+Each is added only when missing, so a database created from the models at any
+later point, and stamped then, is a no-op or is completed. Counters and
+timelines added here are filled from the existing rows; timelines with each
+followed author's ``TIMELINE_BACKFILL_LIMIT`` newest messages.
+'''
+
+from flask import has_app_context
+from sqlalchemy import inspect, text
+from models import DeletionJob
+import timeline
+
+USER_COLUMNS = [
+    ('profile_version', 'INTEGER NOT NULL DEFAULT 1'),
+    ('messages_count', 'INTEGER NOT NULL DEFAULT 0'),
+    ('following_count', 'INTEGER NOT NULL DEFAULT 0'),
+    ('followers_count', 'INTEGER NOT NULL DEFAULT 0'),
+    ('likes_count', 'INTEGER NOT NULL DEFAULT 0'),
+    ('deleted_at', 'TIMESTAMP'),
+]
+
+COUNTERS = ('messages_count', 'following_count', 'followers_count', 'likes_count')
+
+RECOUNT = [
+    '''UPDATE users SET
+        messages_count = (SELECT count(*) FROM messages WHERE messages.user_id = users.id),
+        following_count = (SELECT count(*) FROM follows WHERE follows.user_following_id = users.id),
+        followers_count = (SELECT count(*) FROM follows WHERE follows.user_being_followed_id = users.id),
+        likes_count = (SELECT count(*) FROM likes WHERE likes.user_id = users.id AND likes.message_id IS NOT NULL)''',
+    '''UPDATE messages SET
+        likes_count = (SELECT count(*) FROM likes WHERE likes.message_id = messages.id AND likes.user_id IS NOT NULL)''',
+]
+
+TIMELINE = [
+    '''CREATE TABLE timeline_entries (
+        user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+        message_id INTEGER NOT NULL REFERENCES messages (id) ON DELETE CASCADE,
+        author_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+        timestamp TIMESTAMP NOT NULL,
+        PRIMARY KEY (user_id, message_id)
+    )''',
+    'CREATE INDEX ix_timeline_entries_user_timestamp ON timeline_entries (user_id, timestamp, message_id)',
+]
+
+FILL_TIMELINES = [
+    '''INSERT INTO timeline_entries (user_id, message_id, author_id, timestamp)
+        SELECT user_id, id, user_id, timestamp FROM messages WHERE user_id IS NOT NULL''',
+    # Each author's newest :limit messages, as a new follow gets; authors over
+    # the fan-out cap are pulled at read time instead
+    '''INSERT INTO timeline_entries (user_id, message_id, author_id, timestamp)
+        SELECT follows.user_following_id, recent.id, recent.user_id, recent.timestamp
+        FROM (
+            SELECT id, user_id, timestamp, row_number() OVER (PARTITION BY user_id ORDER BY id DESC) AS position
+            FROM messages WHERE user_id IS NOT NULL
+        ) AS recent
+        JOIN follows ON follows.user_being_followed_id = recent.user_id
+        JOIN users ON users.id = recent.user_id
+        WHERE recent.position <= :limit AND users.followers_count <= :cap
+            AND follows.user_following_id != recent.user_id''',
+]
+
+TRIGRAM_INDEXES = [
+    ('ix_users_username_trgm', 'users', 'username'),
+    ('ix_users_bio_trgm', 'users', 'bio'),
+    ('ix_users_location_trgm', 'users', 'location'),
+    ('ix_messages_text_trgm', 'messages', 'text'),
+]
+
+
+def fanout_cap():
+    return timeline.fanout_cap() if has_app_context() else timeline.DEFAULT_FANOUT_CAP
+
+
+def backfill_limit():
+    return timeline.backfill_limit() if has_app_context() else timeline.DEFAULT_BACKFILL_LIMIT
+
+
+def upgrade(conn):
+    inspector = inspect(conn)
+    tables = set(inspector.get_table_names())
+    user_columns = {column['name'] for column in inspector.get_columns('users')}
+    message_columns = {column['name'] for column in inspector.get_columns('messages')}
+
+    added = set()
+    for name, definition in USER_COLUMNS:
+        if name not in user_columns:
+            conn.execute(text(f'ALTER TABLE users ADD COLUMN {name} {definition}'))
+            added.add(name)
+    if 'likes_count' not in message_columns:
+        conn.execute(text('ALTER TABLE messages ADD COLUMN likes_count INTEGER NOT NULL DEFAULT 0'))
+        added.add('messages.likes_count')
+    if added & {*COUNTERS, 'messages.likes_count'}:
+        for statement in RECOUNT:
+            conn.execute(text(statement))
+
+    if 'timeline_entries' not in tables:
+        for statement in TIMELINE:
+            conn.execute(text(statement))
+        for statement in FILL_TIMELINES:
+            conn.execute(text(statement), {'cap': fanout_cap(), 'limit': backfill_limit()})
+
+    DeletionJob.__table__.create(conn, checkfirst=True)
+
+    if conn.dialect.name == 'postgresql':
+        conn.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+        for name, table, column in TRIGRAM_INDEXES:
+            conn.execute(text(f'CREATE INDEX IF NOT EXISTS {name} ON {table} USING gin ({column} gin_trgm_ops)'))
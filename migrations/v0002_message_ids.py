@@ -0,0 +1,33 @@
+'''Moves messages to time-ordered 64-bit ids made by the app (see messageids.py).
+
+Existing messages keep their serial ids. Those are in insertion order and far
+below the first time-ordered id, so ordering by id keeps old messages in the
+order they were posted, before every new one. Their timestamps, many of them
+identical because of the old import-time default, are left as they are; feeds
+no longer sort on them.
+
+Timelines order on message_id, so their timestamp copy and the timestamp
+indexes go, replaced by an index on messages (user_id, id).
+'''
+
+from sqlalchemy import text
+
+DIALECTS = ('postgresql',)
+
+STATEMENTS = [
+    'ALTER TABLE likes ALTER COLUMN message_id TYPE BIGINT',
+    'ALTER TABLE timeline_entries ALTER COLUMN message_id TYPE BIGINT',
+    'ALTER TABLE messages ALTER COLUMN id DROP DEFAULT',
+    'ALTER TABLE messages ALTER COLUMN id TYPE BIGINT',
+    'DROP SEQUENCE IF EXISTS messages_id_seq',
+    'CREATE SEQUENCE IF NOT EXISTS message_id_workers MINVALUE 0 MAXVALUE 1023 CYCLE',
+    'DROP INDEX IF EXISTS ix_messages_user_timestamp',
+    'CREATE INDEX ix_messages_user_id ON messages (user_id, id)',
+    'DROP INDEX IF EXISTS ix_timeline_entries_user_timestamp',
+    'ALTER TABLE timeline_entries DROP COLUMN timestamp',
+]
+
+
+def upgrade(conn):
+    for statement in STATEMENTS:
+        conn.execute(text(statement))
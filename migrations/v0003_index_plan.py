@@ -0,0 +1,29 @@
+'''Secondary indexes for the reverse side of follows and for timeline cleanup.
+
+* ``follows (user_following_id, user_being_followed_id)``: who a user follows.
+  The primary key leads with the followed user, so without it the
+  ``following`` list, follow checks and pull-author lookups scan the table.
+* ``timeline_entries (message_id)``: removing a deleted message from every
+  timeline it was delivered to.
+* ``timeline_entries (user_id, author_id)``: pruning an unfollowed author's
+  messages from one timeline.
+
+Built online, without blocking writes.
+'''
+
+from migrations import create_index
+
+TRANSACTIONAL = False
+
+INDEXES = [
+    ('ix_follows_following_followed', 'follows', ['user_following_id', 'user_being_followed_id']),
+    ('ix_timeline_entries_message_id', 'timeline_entries', ['message_id']),
+    ('ix_timeline_entries_user_author', 'timeline_entries', ['user_id', 'author_id']),
+]
+
+
+def upgrade(conn):
+    for name, table, columns in INDEXES:
+        create_index(conn, name, table, columns)
+    if conn.dialect.name == 'postgresql':
+        conn.exec_driver_sql('ANALYZE follows, timeline_entries')
@@ -0,0 +1,9 @@
+'''Adds ``follow_edits``, the log of follows, unfollows and deleted users that
+keeps every process's follow graph current (see followgraph.py).
+'''
+
+from models import FollowEdit
+
+
+def upgrade(conn):
+    FollowEdit.__table__.create(conn, checkfirst=True)
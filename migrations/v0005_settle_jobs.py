@@ -0,0 +1,9 @@
+'''Adds ``settle_jobs``, the queue of authors whose recent messages are fanned
+out in the background after they drop back to the fan-out cap (see timeline.py).
+'''
+
+from models import SettleJob
+
+
+def upgrade(conn):
+    SettleJob.__table__.create(conn, checkfirst=True)
@@ -0,0 +1,15 @@
+'''Replaces the ``message_id_workers`` sequence with ``message_id_leases``.
+
+The sequence cycled, so the 1025th process to start reused a worker number
+that might still be in use. Worker numbers are now leased from the table with
+an expiry and renewed while in use (see messageids.py).
+'''
+
+from sqlalchemy import text
+from models import MessageIdLease
+
+
+def upgrade(conn):
+    MessageIdLease.__table__.create(conn, checkfirst=True)
+    if conn.dialect.name == 'postgresql':
+        conn.execute(text('DROP SEQUENCE IF EXISTS message_id_workers'))
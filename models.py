@@ -1,16 +1,45 @@
+from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
-from flask_bcrypt import Bcrypt
 from datetime import datetime
+from sqlalchemy import DDL, event
+from passwords import password_hasher
+from replicas import RoutingSession
+from messageids import LEASE_TABLE, next_message_id, message_timestamp
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+# Trigram indexes back substring search on PostgreSQL; other databases skip them.
+event.listen(
+    db.metadata,
+    'before_create',
+    DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql')
+)
+
+def trigram_index(name, column):
+    '''A GIN trigram index for substring search, created only on PostgreSQL'''
+
+    return (db.Index(name, column, postgresql_using='gin', postgresql_ops={column: 'gin_trgm_ops'})
+            .ddl_if(dialect='postgresql'))
 
-db = SQLAlchemy()
-bcrypt = Bcrypt()
 
 def connect_db(app):
-    db.app = app
     db.init_app(app)
-    app.app_context().push()
 
 
+def follows_exists(follower_id, followed_id):
+    '''Checks a follow edge in the in-memory follow graph, or the follows table without it'''
+
+    graph = current_app.extensions.get('follow_graph')
+    if graph is not None:
+        return graph.is_following(follower_id, followed_id)
+
+    return db.session.query(
+        db.exists().where(
+            Follows.user_following_id == follower_id,
+            Follows.user_being_followed_id == followed_id
+        )
+    ).scalar()
+
 class Follows(db.Model):
     ''' Represents the association table for tracking user following relationships.'''
 
@@ -28,16 +57,117 @@ class Follows(db.Model):
         primary_key=True
     )
 
+    # The primary key leads with the followed user; this serves "who does X follow"
+    __table_args__ = (
+        db.Index('ix_follows_following_followed', 'user_following_id', 'user_being_followed_id'),
+    )
+
+class FollowEdit(db.Model):
+    '''A follow, unfollow or deleted user, logged so every process can apply it to its follow graph'''
+
+    __tablename__ = 'follow_edits'
+
+    id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True, autoincrement=True)
+
+    # add_edge, remove_edge or remove_user (which leaves followed_id empty)
+    action = db.Column(db.Text, nullable=False)
+
+    # No foreign keys: edits outlive the users they mention
+    follower_id = db.Column(db.Integer, nullable=False)
+
+    followed_id = db.Column(db.Integer)
+
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+class TimelineEntry(db.Model):
+    '''Materialized home timeline: one row per message delivered to a user's feed'''
+
+    __tablename__ = 'timeline_entries'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True
+    )
+
+    # Message ids are time-ordered, so the primary key also serves newest-first reads
+    message_id = db.Column(
+        db.BigInteger,
+        db.ForeignKey('messages.id', ondelete='CASCADE'),
+        primary_key=True
+    )
+
+    author_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_timeline_entries_message_id', 'message_id'),
+        db.Index('ix_timeline_entries_user_author', 'user_id', 'author_id'),
+    )
+
+class DeletionJob(db.Model):
+    '''Progress of purging a deleted account's rows'''
+
+    __tablename__ = 'deletion_jobs'
+
+    # No foreign key: the job outlives the user row it purges
+    user_id = db.Column(db.Integer, primary_key=True)
+
+    stage = db.Column(db.Text, nullable=False, default='likes')
+
+    rows_deleted = db.Column(db.Integer, nullable=False, default=0)
+
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+
+    last_error = db.Column(db.Text)
+
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    updated_at = db.Column(db.DateTime)
+
+    finished_at = db.Column(db.DateTime)
+
+class MessageIdLease(db.Model):
+    '''A message id worker number leased by a running process (see messageids.py); PostgreSQL only'''
+
+    __tablename__ = LEASE_TABLE
+
+    worker = db.Column(db.Integer, primary_key=True, autoincrement=False)
+
+    # host:pid:token of the process holding it
+    holder = db.Column(db.Text, nullable=False)
+
+    expires_at = db.Column(db.DateTime(timezone=True), nullable=False)
+
+class SettleJob(db.Model):
+    '''Progress of fanning out an author's recent messages after they drop back to the fan-out cap'''
+
+    __tablename__ = 'settle_jobs'
+
+    # No foreign key: a job for an author deleted meanwhile is dropped by the worker
+    author_id = db.Column(db.Integer, primary_key=True)
+
+    # Followers are done in id order; every follower up to this one is done
+    after_follower_id = db.Column(db.Integer, nullable=False, default=0)
+
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+
+    last_error = db.Column(db.Text)
+
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
 class Likes(db.Model):
     '''Shows the likes using the user_id and the message_id'''
 
     __tablename__ = 'likes'
 
-    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    # One row per (liker, message); the key also serves "which of these has the viewer liked"
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
 
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'))
+    message_id = db.Column(db.BigInteger, db.ForeignKey('messages.id', ondelete='CASCADE'), primary_key=True)
 
-    message_id = db.Column(db.Integer, db.ForeignKey('messages.id', ondelete='CASCADE'), unique=True)
+    __table_args__ = (
+        db.Index('ix_likes_message_id', 'message_id'),
+    )
 
 
 class User(db.Model):
@@ -61,49 +191,63 @@ class User(db.Model):
 
     password = db.Column(db.Text, nullable=False)
 
+    profile_version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+
+    messages_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    following_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    followers_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    likes_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    # Set when the account is deleted; the rows are purged in the background
+    deleted_at = db.Column(db.DateTime)
+
     messages = db.relationship('Message')
 
+    # Deleted accounts drop out of follower lists before their follows are purged
     followers = db.relationship(
         'User', 
         secondary='follows', 
         primaryjoin=(Follows.user_being_followed_id == id),
-        secondaryjoin=(Follows.user_following_id == id),
-        cascade='all,delete'
+        secondaryjoin=db.and_(Follows.user_following_id == id, deleted_at.is_(None)),
     )
 
     following = db.relationship(
         'User', 
         secondary='follows',
         primaryjoin=(Follows.user_following_id == id),
-        secondaryjoin=(Follows.user_being_followed_id == id),
+        secondaryjoin=db.and_(Follows.user_being_followed_id == id, deleted_at.is_(None)),
     )
 
     likes = db.relationship('Message', secondary='likes')
 
+    __table_args__ = (
+        trigram_index('ix_users_username_trgm', 'username'),
+        trigram_index('ix_users_bio_trgm', 'bio'),
+        trigram_index('ix_users_location_trgm', 'location'),
+    )
+
     def __repr__(self):
         return f'<User #{self.id}: {self.username}, {self.email}>'
     
     def is_followed_by(self, other_user):
         '''Checks to see if the user is getting followed'''
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return follows_exists(other_user.id, self.id)
     
     def is_following(self, other_user):
         '''Checks to see if the user is following another user'''
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return follows_exists(self.id, other_user.id)
     
     @classmethod
     def register(cls, username, email, password, image_url):
         '''Creates an encrypted password'''
 
-        hashed_password = bcrypt.generate_password_hash(password)
-        password_utf8 = hashed_password.decode('UTF-8')
-
         return cls(
             username=username,
             email=email,
-            password=password_utf8,
+            password=password_hasher.hash(password),
             image_url=image_url
         )
 
@@ -111,12 +255,25 @@ class User(db.Model):
     def authenticate(cls, username, password):
         '''Authenticates password coming from an input'''
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.query.filter_by(username=username, deleted_at=None).first()
 
-        if user and bcrypt.check_password_hash(user.password, password):
+        if user and user.check_password(password):
             return user
         else:
             return False
+
+    def check_password(self, password):
+        '''Checks a password, upgrading the stored hash if it was made at an old cost.
+
+        The caller commits the session to save an upgraded hash.
+        '''
+
+        if not password_hasher.verify(self.password, password):
+            return False
+
+        if password_hasher.needs_rehash(self.password):
+            self.password = password_hasher.hash(password)
+        return True
     
 
 class Message(db.Model):
@@ -124,12 +281,20 @@ class Message(db.Model):
 
     __tablename__ = 'messages'
 
-    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    # Time-ordered ids made by the app (see messageids.py); the timestamp is read from the id
+    id = db.Column(db.BigInteger, primary_key=True, autoincrement=False, default=next_message_id)
 
     text = db.Column(db.String(140), nullable=False)
 
-    timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow())
+    timestamp = db.Column(db.DateTime, nullable=False, default=message_timestamp)
 
     user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'))
 
-    user = db.relationship('User')
\ No newline at end of file
+    likes_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    user = db.relationship('User')
+
+    __table_args__ = (
+        db.Index('ix_messages_user_id', 'user_id', 'id'),
+        trigram_index('ix_messages_text_trgm', 'text'),
+    )
\ No newline at end of file
@@ -0,0 +1,105 @@
+'''Keyset (cursor) pagination.
+
+Pages are addressed by an opaque cursor holding the sort key of the last row
+seen, so every page is an index seek past that key instead of an OFFSET that
+grows with page depth. Messages are keyed by their time-ordered ``id`` newest
+first, users by ``id`` oldest first.
+'''
+
+import base64
+import json
+from collections import namedtuple
+from datetime import datetime
+from flask import abort
+
+Page = namedtuple('Page', ['items', 'next_cursor'])
+
+
+def encode_cursor(*values):
+    '''Packs a sort key into an opaque, URL-safe cursor'''
+
+    key = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    raw = json.dumps(key, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    '''Unpacks a cursor into its sort key, or None for the first page'''
+
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        key = json.loads(raw)
+    except ValueError:
+        abort(400)
+    if not isinstance(key, list):
+        abort(400)
+    return key
+
+
+def decode_message_cursor(cursor):
+    '''Unpacks a message cursor into a message id'''
+
+    key = decode_cursor(cursor)
+    if key is None:
+        return None
+    try:
+        (message_id,) = key
+        return int(message_id)
+    except (TypeError, ValueError):
+        abort(400)
+
+
+def decode_user_cursor(cursor):
+    '''Unpacks a user cursor into a user id'''
+
+    key = decode_cursor(cursor)
+    if key is None:
+        return None
+    try:
+        (user_id,) = key
+        return int(user_id)
+    except (TypeError, ValueError):
+        abort(400)
+
+
+def make_page(rows, per_page, key):
+    '''Builds a Page from up to per_page + 1 rows fetched past the cursor'''
+
+    items = rows[:per_page]
+    if len(rows) <= per_page:
+        return Page(items, None)
+    return Page(items, encode_cursor(*key(items[-1])))
+
+
+def message_key(message):
+    return (message.id,)
+
+
+def messages_before(query, id_col, before):
+    '''Filters a newest-first message query to rows older than the cursor'''
+
+    if before is not None:
+        query = query.filter(id_col < before)
+    return query.order_by(id_col.desc())
+
+
+def paginate_messages(query, model, cursor, per_page):
+    '''Returns one newest-first page of messages'''
+
+    before = decode_message_cursor(cursor)
+    rows = (messages_before(query, model.id, before)
+            .limit(per_page + 1)
+            .all())
+    return make_page(rows, per_page, message_key)
+
+
+def paginate_users(query, model, cursor, per_page):
+    '''Returns one page of users in id order'''
+
+    after = decode_user_cursor(cursor)
+    if after is not None:
+        query = query.filter(model.id > after)
+    rows = query.order_by(model.id).limit(per_page + 1).all()
+    return make_page(rows, per_page, lambda user: (user.id,))
@@ -0,0 +1,154 @@
+'''Password hashing off the request thread.
+
+bcrypt is deliberately slow CPU work. Hashes and checks run on a bounded
+thread pool (bcrypt releases the GIL while it works), so a burst of logins
+queues behind a fixed number of workers instead of stalling every request
+thread. When more than ``PASSWORD_HASH_QUEUE`` jobs are waiting, new ones fail
+fast with ``HasherBusy``; a job that takes longer than ``PASSWORD_HASH_TIMEOUT``
+seconds raises ``HashTimeout``.
+
+The bcrypt cost is pinned by ``BCRYPT_LOG_ROUNDS``, so every worker hashes at
+the same cost. ``flask calibrate-passwords`` run on the production hardware at
+deploy time suggests the cost at which one hash takes about
+``PASSWORD_HASH_TARGET_MS``. Stored hashes below the pinned cost are rehashed
+on the next successful login; stronger ones are left alone.
+'''
+
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import bcrypt
+import click
+from flask import current_app
+from werkzeug.local import LocalProxy
+from instrumentation import timed
+
+DEFAULT_ROUNDS = 12
+MIN_ROUNDS = 10
+MAX_ROUNDS = 16
+CALIBRATION_ROUNDS = 8
+
+
+class HasherBusy(Exception):
+    '''Raised when too many password hashing jobs are already queued'''
+
+
+class HashTimeout(Exception):
+    '''Raised when a password hashing job does not finish in time'''
+
+
+def cost_of(hashed):
+    '''Reads the log2 cost out of a bcrypt hash like $2b$12$...'''
+
+    try:
+        return int(hashed.split('$')[2])
+    except (IndexError, ValueError):
+        return None
+
+
+def calibrate(target_ms, min_rounds=MIN_ROUNDS, max_rounds=MAX_ROUNDS):
+    '''Picks the highest cost whose hash time stays within target_ms.
+
+    Each extra round doubles the work, so one cheap hash is timed and scaled.
+    '''
+
+    salt = bcrypt.gensalt(CALIBRATION_ROUNDS)
+    start = time.perf_counter()
+    bcrypt.hashpw(b'calibration', salt)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+
+    rounds = CALIBRATION_ROUNDS + math.floor(math.log2(target_ms / max(elapsed_ms, 1e-3)))
+    return max(min_rounds, min(max_rounds, rounds))
+
+
+class PasswordHasher:
+    '''Flask extension running bcrypt on a bounded worker pool'''
+
+    def __init__(self, app=None):
+        self.rounds = DEFAULT_ROUNDS
+        self.timeout = 5
+        self.executor = None
+        self.slots = None
+        self.lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('BCRYPT_LOG_ROUNDS', DEFAULT_ROUNDS)
+        app.config.setdefault('PASSWORD_HASH_TARGET_MS', 250)
+        app.config.setdefault('PASSWORD_HASH_WORKERS', os.cpu_count() or 1)
+        app.config.setdefault('PASSWORD_HASH_QUEUE', 4 * app.config['PASSWORD_HASH_WORKERS'])
+        app.config.setdefault('PASSWORD_HASH_TIMEOUT', 5)
+
+        self.rounds = app.config['BCRYPT_LOG_ROUNDS']
+        self.timeout = app.config['PASSWORD_HASH_TIMEOUT']
+        self.start(app.config['PASSWORD_HASH_WORKERS'], app.config['PASSWORD_HASH_QUEUE'])
+        app.extensions['password_hasher'] = self
+        app.cli.add_command(calibrate_passwords_command)
+
+    def start(self, workers, queue):
+        '''(Re)creates the worker pool'''
+
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False)
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bcrypt')
+            self.slots = threading.BoundedSemaphore(workers + queue)
+
+    def run(self, fn, *args):
+        '''Runs fn on the pool and waits for it, within the queue and time limits'''
+
+        if self.executor is None:
+            with timed('bcrypt'):
+                return fn(*args)
+
+        if not self.slots.acquire(blocking=False):
+            raise HasherBusy('Password hashing queue is full')
+        try:
+            future = self.executor.submit(fn, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda f: self.slots.release())
+
+        try:
+            with timed('bcrypt'):
+                return future.result(timeout=self.timeout)
+        except TimeoutError:
+            raise HashTimeout(f'Password hashing took longer than {self.timeout}s')
+
+    def hash(self, password):
+        '''Hashes a password at the current cost'''
+
+        salt = bcrypt.gensalt(self.rounds)
+        return self.run(bcrypt.hashpw, password.encode('utf-8'), salt).decode('utf-8')
+
+    def verify(self, hashed, password):
+        '''Checks a password against a stored hash'''
+
+        try:
+            return self.run(bcrypt.checkpw, password.encode('utf-8'), hashed.encode('utf-8'))
+        except ValueError:
+            return False
+
+    def needs_rehash(self, hashed):
+        '''True when a stored hash was made at a lower cost than the current one'''
+
+        cost = cost_of(hashed)
+        return cost is None or cost < self.rounds
+
+
+@click.command('calibrate-passwords')
+def calibrate_passwords_command():
+    '''Suggests a BCRYPT_LOG_ROUNDS for PASSWORD_HASH_TARGET_MS on this machine'''
+
+    config = current_app.config
+    rounds = calibrate(config['PASSWORD_HASH_TARGET_MS'])
+    click.echo(f'BCRYPT_LOG_ROUNDS={rounds} (currently {config["BCRYPT_LOG_ROUNDS"]}, '
+               f'target {config["PASSWORD_HASH_TARGET_MS"]}ms per hash)')
+
+
+# The current app's PasswordHasher; create_app makes one per app
+password_hasher = LocalProxy(lambda: current_app.extensions['password_hasher'])
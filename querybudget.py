@@ -0,0 +1,87 @@
+'''Per-request SQL statement budget.
+
+Counts the statements each request sends to the database. When a request goes
+over its budget the request fails in debug/test mode, so N+1 regressions show
+up in development, and is logged in production.
+
+The default budget comes from ``QUERY_BUDGET``; a view can override it with the
+``query_budget`` decorator.
+'''
+
+import logging
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from streaming import after_stream, streaming
+
+logger = logging.getLogger(__name__)
+
+
+class QueryBudgetExceeded(Exception):
+    '''Raised when a request runs more SQL statements than its budget allows'''
+
+
+def query_budget(limit):
+    '''Overrides the statement budget for a single view'''
+
+    def decorator(view):
+        view.query_budget = limit
+        return view
+    return decorator
+
+
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'query_count' in g:
+        g.query_count += 1
+        g.query_statements.append(statement)
+
+
+class QueryBudget:
+    '''Flask extension enforcing a per-request SQL statement budget'''
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('QUERY_BUDGET', 30)
+        app.config.setdefault('QUERY_BUDGET_ENFORCE', None)
+
+        if not event.contains(Engine, 'before_cursor_execute', _count_statement):
+            event.listen(Engine, 'before_cursor_execute', _count_statement)
+
+        app.before_request(self.start)
+        app.after_request(self.check)
+
+    def start(self):
+        g.query_count = 0
+        g.query_statements = []
+
+    def check(self, response):
+        if request.endpoint == 'static' or 'query_count' not in g:
+            return response
+
+        # A streamed page runs most of its statements while the body is sent
+        if streaming():
+            after_stream(self.enforce)
+        else:
+            self.enforce()
+        return response
+
+    def enforce(self):
+        '''Fails or logs the request if it went over its budget'''
+
+        view = current_app.view_functions.get(request.endpoint)
+        limit = getattr(view, 'query_budget', current_app.config['QUERY_BUDGET'])
+        if g.query_count <= limit:
+            return
+
+        summary = f'{request.method} {request.path} ran {g.query_count} SQL statements (budget {limit})'
+
+        enforce = current_app.config['QUERY_BUDGET_ENFORCE']
+        if enforce is None:
+            enforce = current_app.debug or current_app.testing
+        if enforce:
+            raise QueryBudgetExceeded(summary + ':\n' + '\n'.join(g.query_statements))
+
+        logger.warning(summary)
@@ -0,0 +1,214 @@
+'''Query plan checks for the hot pages.
+
+Drives the busiest routes through the test client as a real user, records
+every SQL statement they send, and asks the database to ``EXPLAIN`` each one
+with the same parameters. A statement whose plan reads a whole table
+(``Seq Scan`` on PostgreSQL, a ``SCAN`` without an index on SQLite) is a
+regression: it gets slower as the table grows.
+
+Plans only mean something on a database with realistic data, so point it at a
+seeded copy (``python seed.py --bulk`` with large generator CSVs). By default
+only the read-only pages are checked; ``--writes`` adds the like and follow
+requests, which change rows (they are sent in pairs that undo each other, but
+a failure part way leaves them changed), so use it on a throwaway copy only:
+
+    flask check-plans              # prints every plan, exits 1 on a full scan
+    flask check-plans --quiet
+    flask check-plans --writes     # throwaway databases only
+
+tests/test_query_plans.py runs the same check against a generated dataset.
+'''
+
+import json
+import re
+import click
+from flask import current_app
+from sqlalchemy import event, select
+from models import db, Follows, Message, User
+
+# Full scans that are expected: tables that stay tiny, and SQLite walking a
+# rowid table in key order for an ORDER BY id ... LIMIT page
+ALLOWED_SCANS = {'deletion_jobs', 'schema_migrations'}
+SQLITE_KEY_ORDER = re.compile(r'^SCAN (\w+)$')
+SQLITE_DERIVED = re.compile(r'^(?:MATERIALIZE|CO-ROUTINE) (\w+)$')
+
+# The trigram indexes need at least three characters to look anything up; a
+# word outside the generated text keeps the pattern selective on any dataset
+SEARCH_TERM = 'wizard'
+
+
+def sample_ids():
+    '''Picks the ids the checked pages are drawn for: the busiest accounts and their messages'''
+
+    viewer = db.session.scalar(select(User.id).order_by(User.following_count.desc()).limit(1))
+    popular = db.session.scalar(select(User.id).order_by(User.followers_count.desc()).limit(1))
+    author = db.session.scalar(select(User.id).order_by(User.messages_count.desc()).limit(1))
+    message = db.session.scalar(select(Message.id).where(Message.user_id != viewer).order_by(Message.id.desc()).limit(1))
+    stranger = db.session.scalar(
+        select(User.id)
+        .where(User.id != viewer, User.id.not_in(select(Follows.user_being_followed_id)
+                                                  .where(Follows.user_following_id == viewer)))
+        .limit(1)
+    )
+    return dict(viewer=viewer, popular=popular, author=author, message=message, stranger=stranger)
+
+
+def hot_requests(ids, writes=False):
+    '''(method, path) of the pages checked; writes come in an order that leaves the data as it found it'''
+
+    reads = [
+        ('GET', '/'),
+        ('GET', f'/users/{ids["author"]}'),
+        ('GET', f'/users/{ids["popular"]}/followers'),
+        ('GET', f'/users/{ids["viewer"]}/following'),
+        ('GET', '/users/likes'),
+        ('GET', '/users'),
+        ('GET', f'/users?q={SEARCH_TERM}'),
+        ('GET', f'/messages/{ids["message"]}'),
+        ('GET', f'/messages/search?q={SEARCH_TERM}'),
+        ('GET', '/api/v1/timeline'),
+        ('GET', f'/api/v1/users/{ids["author"]}/messages'),
+        ('GET', f'/api/v1/users?ids={ids["popular"]},{ids["author"]}'),
+        ('GET', f'/api/v1/messages?ids={ids["message"]}'),
+    ]
+    if not writes:
+        return reads
+    return reads + [
+        ('POST', f'/users/add_like/{ids["message"]}'),
+        ('POST', f'/users/add_like/{ids["message"]}'),
+        ('POST', f'/users/follow/{ids["stranger"]}'),
+        ('POST', f'/users/stop-following/{ids["stranger"]}'),
+    ]
+
+
+def capture(app, viewer, requests):
+    '''Runs the requests as viewer; returns (method, path, statement, parameters) for each SQL statement'''
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['current_user'] = viewer
+
+    current = [None]
+    captured = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if current[0] is not None and not executemany:
+            captured.append((*current[0], statement, parameters))
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        # The first pass warms the caches that load lazily (follow graph, search index)
+        for method, path in requests:
+            client.open(path, method=method).close()
+        for method, path in requests:
+            current[0] = (method, path)
+            client.open(path, method=method).close()
+            current[0] = None
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+    return captured
+
+
+def explain(conn, statement, parameters):
+    '''The plan of a statement as text, and the tables it reads in full'''
+
+    if conn.dialect.name == 'postgresql':
+        rows = conn.exec_driver_sql('EXPLAIN (FORMAT JSON) ' + statement, parameters).scalar()
+        plan = rows if isinstance(rows, list) else json.loads(rows)
+        scans = set()
+
+        def walk(node):
+            if node.get('Node Type') == 'Seq Scan':
+                scans.add(node['Relation Name'])
+            for child in node.get('Plans', []):
+                walk(child)
+
+        walk(plan[0]['Plan'])
+        return json.dumps(plan, indent=2), scans
+
+    rows = conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).all()
+    lines = [row[-1] for row in rows]
+    # A subquery in FROM is read as a whole, but it is bounded by its own plan
+    derived = {match.group(1) for match in map(SQLITE_DERIVED.match, lines) if match}
+    scans = set()
+    for line in lines:
+        match = SQLITE_KEY_ORDER.match(line)
+        if match and match.group(1) not in derived and not scan_is_keyset(statement, match.group(1)):
+            scans.add(match.group(1))
+    return '\n'.join(lines), scans
+
+
+def query_blocks(statement):
+    '''The SELECTs of a statement, each with the subqueries inside it cut out'''
+
+    blocks = []
+    stack = ['']
+    for char in statement:
+        if char == '(':
+            stack.append('')
+        elif char == ')' and len(stack) > 1:
+            inner = stack.pop()
+            if inner.lstrip().upper().startswith('SELECT'):
+                blocks.append(inner)
+                stack[-1] += '()'
+            else:
+                stack[-1] += f'({inner})'
+        else:
+            stack[-1] += char
+    return blocks + stack
+
+
+def scan_is_keyset(statement, table):
+    '''True when the SELECT that scans table pages it in primary key order, which SQLite plans as a bounded SCAN.
+
+    table is the name on the plan line (the alias, if the statement gives one); the ORDER BY ... LIMIT has to
+    belong to the same SELECT, so a subquery's page does not excuse a full scan in the query around it.
+    '''
+
+    reads = re.compile(rf'\b(FROM|JOIN|,)\s*(\w+\s+(AS\s+)?)?{re.escape(table)}\b', re.IGNORECASE)
+    pages = re.compile(rf'ORDER BY {re.escape(table)}\.id( ASC| DESC)?\s+LIMIT\b', re.IGNORECASE)
+    return any(reads.search(block) and pages.search(block) for block in query_blocks(statement))
+
+
+def check(app, verbose=False, writes=False):
+    '''Explains every statement of the hot pages; returns the findings for those with full scans.
+
+    With writes the like and follow requests are checked too; only for a throwaway database.
+    '''
+
+    with app.app_context():
+        ids = sample_ids()
+    statements = capture(app, ids['viewer'], hot_requests(ids, writes))
+
+    findings = []
+    with app.app_context():
+        with db.engine.connect() as conn:
+            for method, path, statement, parameters in statements:
+                if not statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE', 'INSERT', 'WITH')):
+                    continue
+                plan, scans = explain(conn, statement, parameters)
+                scans -= ALLOWED_SCANS
+                if verbose:
+                    click.echo(f'== {method} {path}\n{statement}\n{plan}\n')
+                if scans:
+                    findings.append(dict(method=method, path=path, statement=statement, plan=plan,
+                                         tables=sorted(scans)))
+            conn.rollback()
+    return findings
+
+
+@click.command('check-plans')
+@click.option('--quiet', is_flag=True, help='only report full table scans')
+@click.option('--writes', is_flag=True, help='also check the like and follow requests (throwaway databases only)')
+def check_plans_command(quiet, writes):
+    '''Explains the SQL of the hot pages and fails on full table scans'''
+
+    findings = check(current_app._get_current_object(), verbose=not quiet, writes=writes)
+    for finding in findings:
+        click.echo(f'full scan of {", ".join(finding["tables"])} in {finding["method"]} {finding["path"]}:\n'
+                   f'{finding["statement"]}\n{finding["plan"]}\n')
+    if findings:
+        raise SystemExit(1)
+    click.echo('no full table scans')
@@ -0,0 +1,113 @@
+'''Read replica routing.
+
+``SQLALCHEMY_REPLICA_URIS`` lists read replicas of the primary database. During
+a request, plain SELECTs go to a replica (round robin) and everything else
+(flushes, INSERT/UPDATE/DELETE, SELECT ... FOR UPDATE, raw SQL) goes to the
+primary. Once a transaction has written, the rest of it reads from the primary
+too, so it sees its own changes.
+
+A request that commits a write stamps the user's session cookie; for the next
+``REPLICA_READ_YOUR_WRITES`` seconds that user's requests read from the
+primary, so the redirect after posting a message or following someone never
+shows a replica that has not caught up yet.
+
+Code running outside a request (CLI commands, seeding) always uses the primary.
+With no replicas configured, nothing changes.
+'''
+
+import itertools
+import time
+from flask import current_app, g, has_request_context, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, event
+from sqlalchemy.sql import Select
+from config import engine_options
+
+WROTE_AT_KEY = 'wrote_at'
+
+
+class RoutingSession(Session):
+    '''Session sending reads to a replica and writes to the primary'''
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None:
+            replica = self.replica_for(clause)
+            if replica is not None:
+                return replica
+            if not isinstance(clause, Select) or clause._for_update_arg is not None:
+                self.info['primary'] = self.info['wrote'] = True
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def replica_for(self, clause):
+        '''The replica engine for a statement, or None when it must use the primary'''
+
+        if (not isinstance(clause, Select)
+                or clause._for_update_arg is not None
+                or self._flushing
+                or self.info.get('primary')
+                or not has_request_context()
+                or g.get('read_primary')):
+            return None
+
+        replicas = current_app.extensions.get('replicas')
+        if replicas is None:
+            return None
+        return next(replicas.cycle)
+
+
+def _end_transaction(db_session):
+    db_session.info.pop('primary', None)
+    return db_session.info.pop('wrote', False)
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _stamp_write(db_session):
+    if _end_transaction(db_session) and has_request_context() and 'replicas' in current_app.extensions:
+        session[WROTE_AT_KEY] = time.time()
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def _discard(db_session):
+    _end_transaction(db_session)
+
+
+class ReplicaSet:
+    '''The replica engines, handed out round robin'''
+
+    def __init__(self, engines):
+        self.engines = engines
+        self.cycle = itertools.cycle(engines)
+
+
+class ReadReplicas:
+    '''Flask extension creating the replica engines'''
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SQLALCHEMY_REPLICA_URIS', [])
+        app.config.setdefault('REPLICA_READ_YOUR_WRITES', 5)
+
+        urls = app.config['SQLALCHEMY_REPLICA_URIS']
+        if not urls:
+            return
+
+        engines = [
+            create_engine(url, echo=app.config.get('SQLALCHEMY_ECHO', False),
+                          **engine_options(dict(app.config, SQLALCHEMY_DATABASE_URI=url)))
+            for url in urls
+        ]
+        app.extensions['replicas'] = ReplicaSet(engines)
+        app.before_request(self.check_recent_write)
+
+    def check_recent_write(self):
+        '''Reads from the primary for a while after this user's last write'''
+
+        wrote_at = session.get(WROTE_AT_KEY)
+        window = current_app.config['REPLICA_READ_YOUR_WRITES']
+        g.read_primary = wrote_at is not None and time.time() - wrote_at < window
+
+
+read_replicas = ReadReplicas()
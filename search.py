@@ -0,0 +1,249 @@
+'''Search over users (username, bio, location) and message text.
+
+On PostgreSQL searches run as ILIKE queries served by the trigram GIN indexes
+declared in models.py and are ranked by trigram similarity. Other databases
+(SQLite in tests and local runs) use an in-process inverted index with prefix
+matching, built on first use and updated as users and messages change.
+'''
+
+import bisect
+import heapq
+import re
+import threading
+from collections import defaultdict
+from flask import current_app
+from sqlalchemy import func, or_
+from sqlalchemy.orm import joinedload
+from models import db, Message, User
+
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+USER_FIELDS = (('username', 3), ('bio', 1), ('location', 1))
+MESSAGE_FIELDS = (('text', 1),)
+
+
+def tokenize(text):
+    '''Splits text into lowercase alphanumeric tokens'''
+    return TOKEN_RE.findall((text or '').lower())
+
+
+def escape_like(term):
+    '''Escapes LIKE wildcards so user input matches literally'''
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+class InvertedIndex:
+    '''Token -> document postings with weighted exact and prefix matching'''
+
+    def __init__(self):
+        self.postings = defaultdict(dict)
+        self.documents = {}
+        self.vocabulary = []
+        self.lock = threading.Lock()
+
+    def add(self, doc_id, fields):
+        '''Indexes a document given (text, weight) pairs, replacing any earlier version'''
+
+        weights = {}
+        for text, weight in fields:
+            for token in tokenize(text):
+                weights[token] = max(weights.get(token, 0), weight)
+
+        with self.lock:
+            self._remove(doc_id)
+            for token, weight in weights.items():
+                if token not in self.postings:
+                    bisect.insort(self.vocabulary, token)
+                self.postings[token][doc_id] = weight
+            self.documents[doc_id] = tuple(weights)
+
+    def remove(self, doc_id):
+        with self.lock:
+            self._remove(doc_id)
+
+    def _remove(self, doc_id):
+        for token in self.documents.pop(doc_id, ()):
+            docs = self.postings[token]
+            docs.pop(doc_id, None)
+            if not docs:
+                del self.postings[token]
+                self.vocabulary.pop(bisect.bisect_left(self.vocabulary, token))
+
+    def _expand(self, term):
+        '''Yields every indexed token starting with term'''
+
+        vocabulary = self.vocabulary
+        for position in range(bisect.bisect_left(vocabulary, term), len(vocabulary)):
+            token = vocabulary[position]
+            if not token.startswith(term):
+                break
+            yield token
+
+    def search(self, query, limit):
+        '''Returns up to limit doc ids, best match first.
+
+        Each query term scores a document by its best field weight, doubled
+        for an exact token match; scores are summed across terms.
+        '''
+
+        scores = defaultdict(int)
+        with self.lock:
+            for term in set(tokenize(query)):
+                best = {}
+                for token in self._expand(term):
+                    boost = 2 if token == term else 1
+                    for doc_id, weight in self.postings[token].items():
+                        best[doc_id] = max(best.get(doc_id, 0), weight * boost)
+                for doc_id, score in best.items():
+                    scores[doc_id] += score
+
+        ranked = heapq.nsmallest(limit, scores.items(), key=lambda item: (-item[1], item[0]))
+        return [doc_id for doc_id, score in ranked]
+
+    def __len__(self):
+        return len(self.documents)
+
+
+def user_fields(user):
+    return [(getattr(user, name), weight) for name, weight in USER_FIELDS]
+
+
+def message_fields(message):
+    return [(getattr(message, name), weight) for name, weight in MESSAGE_FIELDS]
+
+
+def fetch_ranked(model, ids, *options):
+    '''Loads rows by id in one query, keeping the ranking order'''
+
+    if not ids:
+        return []
+    rows = {row.id: row for row in model.query.filter(model.id.in_(ids)).options(*options)}
+    return [rows[row_id] for row_id in ids if row_id in rows]
+
+
+class InProcessSearch:
+    '''Inverted-index search kept in this process'''
+
+    def __init__(self):
+        self.users = InvertedIndex()
+        self.messages = InvertedIndex()
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def load(self):
+        '''Builds both indexes from the database on first use'''
+
+        with self.lock:
+            if self.loaded:
+                return
+            columns = [getattr(User, name) for name, weight in USER_FIELDS]
+            for row in db.session.query(User.id, *columns).execution_options(yield_per=1000):
+                self.users.add(row.id, user_fields(row))
+            for row in db.session.query(Message.id, Message.text).execution_options(yield_per=1000):
+                self.messages.add(row.id, message_fields(row))
+            self.loaded = True
+
+    def index_user(self, user):
+        if self.loaded:
+            self.users.add(user.id, user_fields(user))
+
+    def remove_user(self, user_id):
+        if self.loaded:
+            self.users.remove(user_id)
+
+    def index_message(self, message):
+        if self.loaded:
+            self.messages.add(message.id, message_fields(message))
+
+    def remove_message(self, message_id):
+        if self.loaded:
+            self.messages.remove(message_id)
+
+    def search_users(self, query, limit):
+        self.load()
+        return fetch_ranked(User, self.users.search(query, limit))
+
+    def search_messages(self, query, limit):
+        self.load()
+        return fetch_ranked(Message, self.messages.search(query, limit), joinedload(Message.user))
+
+
+class PostgresSearch:
+    '''Trigram-indexed search; PostgreSQL maintains the indexes itself'''
+
+    def index_user(self, user):
+        pass
+
+    def remove_user(self, user_id):
+        pass
+
+    def index_message(self, message):
+        pass
+
+    def remove_message(self, message_id):
+        pass
+
+    def search_users(self, query, limit):
+        pattern = f'%{escape_like(query)}%'
+        return (User
+                .query
+                .filter(or_(*[getattr(User, name).ilike(pattern, escape='\\') for name, weight in USER_FIELDS]))
+                .order_by(func.similarity(User.username, query).desc(), User.id)
+                .limit(limit)
+                .all()
+            )
+
+    def search_messages(self, query, limit):
+        pattern = f'%{escape_like(query)}%'
+        return (Message
+                .query
+                .filter(Message.text.ilike(pattern, escape='\\'))
+                .options(joinedload(Message.user))
+                .order_by(func.similarity(Message.text, query).desc(), Message.id.desc())
+                .limit(limit)
+                .all()
+            )
+
+
+class SearchEngine:
+    '''Flask extension picking a search backend for the app's database'''
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SEARCH_BACKEND', None)
+        app.config.setdefault('SEARCH_LIMIT', 60)
+        app.extensions['search'] = None
+
+    @property
+    def backend(self):
+        app = current_app._get_current_object()
+        backend = app.extensions.get('search')
+        if backend is None:
+            name = app.config['SEARCH_BACKEND'] or db.engine.dialect.name
+            backend = PostgresSearch() if name == 'postgresql' else InProcessSearch()
+            app.extensions['search'] = backend
+        return backend
+
+    def index_user(self, user):
+        self.backend.index_user(user)
+
+    def remove_user(self, user_id):
+        self.backend.remove_user(user_id)
+
+    def index_message(self, message):
+        self.backend.index_message(message)
+
+    def remove_message(self, message_id):
+        self.backend.remove_message(message_id)
+
+    def search_users(self, query, limit=None):
+        return self.backend.search_users(query, limit or current_app.config['SEARCH_LIMIT'])
+
+    def search_messages(self, query, limit=None):
+        return self.backend.search_messages(query, limit or current_app.config['SEARCH_LIMIT'])
+
+
+search_engine = SearchEngine()
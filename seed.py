@@ -1,20 +1,65 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
 
+    python seed.py                      # ORM load, fine for the bundled CSVs
+    python seed.py --bulk               # streaming COPY/executemany load for large CSVs
+    python seed.py --bulk --chunk-size 50000
+
+The app is built with the WARBLER_PROFILE config profile (default dev).
+"""
+
+import argparse
+import os
 from csv import DictReader
-from app import db
+from datetime import datetime
+from app import create_app
+from models import db
 from models import User, Message, Follows
+from counters import recount_all
+from timeline import rebuild_timelines
+from bulkload import bulk_load, DEFAULT_CHUNK_SIZE
+from migrations import stamp
+
+
+def parse_message(row):
+    '''Turns the timestamp text into a datetime, which SQLite's DateTime type requires'''
+
+    row['timestamp'] = datetime.fromisoformat(row['timestamp'])
+    return row
+
+
+def orm_load(directory='generator'):
+    '''Loads the CSVs in directory through the session in one transaction'''
+
+    db.drop_all()
+    db.create_all()
+
+    with open(os.path.join(directory, 'users.csv')) as users:
+        db.session.bulk_insert_mappings(User, DictReader(users))
+
+    with open(os.path.join(directory, 'messages.csv')) as messages:
+        db.session.bulk_insert_mappings(Message, map(parse_message, DictReader(messages)))
 
+    with open(os.path.join(directory, 'follows.csv')) as follows:
+        db.session.bulk_insert_mappings(Follows, DictReader(follows))
 
-db.drop_all()
-db.create_all()
+    recount_all()
+    rebuild_timelines()
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+    db.session.commit()
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Seed the Warbler database from generator/*.csv')
+    parser.add_argument('--bulk', action='store_true', help='stream the CSVs with COPY/executemany')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    args = parser.parse_args()
 
-db.session.commit()
+    # Loading and reindexing can take longer than a request's statement timeout
+    app = create_app(os.environ.get('WARBLER_PROFILE', 'dev'), DB_STATEMENT_TIMEOUT_MS=None)
+    with app.app_context():
+        if args.bulk:
+            bulk_load(chunk_size=args.chunk_size)
+        else:
+            orm_load()
+        # The schema was just built from the models, so it is already fully migrated
+        stamp(db.engine)
@@ -0,0 +1,33 @@
+// Adds new messages to the top of the home feed as they are posted.
+// The stream URL comes from the data-stream attribute of the message list.
+(function () {
+  var list = document.getElementById('messages');
+  if (!list || !list.dataset.stream || !window.EventSource) {
+    return;
+  }
+
+  var stream = new EventSource(list.dataset.stream);
+
+  stream.addEventListener('message', function (event) {
+    var message = JSON.parse(event.data);
+    if (document.querySelector('[data-message-id="' + message.id + '"]')) {
+      return;
+    }
+    // The server renders the whole list item, like form included
+    var holder = document.createElement('template');
+    holder.innerHTML = message.html.trim();
+    list.insertBefore(holder.content.firstChild, list.firstChild);
+  });
+
+  // Events were missed; show the fresh feed rather than a partial one
+  stream.addEventListener('gap', function () {
+    if (!document.getElementById('live-gap')) {
+      var notice = document.createElement('a');
+      notice.id = 'live-gap';
+      notice.href = '/';
+      notice.className = 'btn btn-outline-primary btn-block mb-3';
+      notice.textContent = 'New messages';
+      list.parentNode.insertBefore(notice, list);
+    }
+  });
+})();
@@ -0,0 +1,64 @@
+'''Streamed HTML responses for long listing pages.
+
+Follower and following lists can run to hundreds of thousands of users. Those
+pages are rendered with ``stream_page``: the view hands the template a query
+iterated with ``yield_per`` (a server-side cursor on PostgreSQL), and the page
+is sent while it is rendered, so neither the rows nor the HTML are held in
+memory all at once. Jinja yields many tiny pieces, which are joined into writes
+of about ``STREAM_BUFFER_SIZE`` characters.
+
+The response headers go out before the body is rendered. Flash messages are
+read up front so the session cookie already has them removed. The body keeps
+the request context, and after-request work that needs the whole request
+registers with ``after_stream``: the query budget and the instrumentation log
+line and metrics run once the last chunk is sent. The Server-Timing header has
+already gone out by then, so it only covers the work done before the body.
+'''
+
+from flask import Response, current_app, g, get_flashed_messages, stream_template, stream_with_context
+
+
+def buffered(chunks, size):
+    '''Joins rendered pieces into chunks of at least size characters'''
+
+    buffer, length = [], 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield ''.join(buffer)
+            buffer, length = [], 0
+    if buffer:
+        yield ''.join(buffer)
+
+
+def streaming():
+    '''Whether the current response is a page from stream_page'''
+
+    return 'stream_callbacks' in g
+
+
+def after_stream(callback):
+    '''Calls callback once the streamed body of the current response is finished'''
+
+    g.stream_callbacks.append(callback)
+
+
+def finished(chunks, callbacks):
+    '''Passes the chunks through, then runs the after_stream callbacks'''
+
+    try:
+        yield from chunks
+    finally:
+        for callback in callbacks:
+            callback()
+
+
+def stream_page(template_name, **context):
+    '''Renders a template into a streamed response'''
+
+    get_flashed_messages(with_categories=True)
+    callbacks = g.stream_callbacks = []
+    chunks = stream_template(template_name, **context)
+    body = finished(buffered(chunks, current_app.config['STREAM_BUFFER_SIZE']), callbacks)
+    return Response(stream_with_context(body), mimetype='text/html')
@@ -0,0 +1,103 @@
+from unittest import TestCase
+from app import create_app, db, CURRENT_USER_KEY
+from deletion import hide_user
+from models import User, Message, Follows, Likes
+import counters
+import timeline
+
+app = create_app('test')
+
+class APITestCase(TestCase):
+    def setUp(self):
+        """Set up a reader following an author with three messages"""
+        self.context = app.app_context()
+        self.context.push()
+        db.drop_all()
+        db.create_all()
+
+        reader = User(username='reader', email='reader@example.com', password='password')
+        author = User(username='author', email='author@example.com', password='password')
+        db.session.add_all([reader, author])
+        db.session.commit()
+
+        db.session.add(Follows(user_being_followed_id=author.id, user_following_id=reader.id))
+        messages = [Message(text=f'Message {i}', user_id=author.id) for i in range(3)]
+        db.session.add_all(messages)
+        db.session.flush()
+        for message in messages:
+            timeline.fan_out_message(message)
+        counters.recount_all()
+        db.session.commit()
+
+        self.reader_id = reader.id
+        self.author_id = author.id
+        self.message_ids = [message.id for message in messages]
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as session:
+            session[CURRENT_USER_KEY] = self.reader_id
+
+    def tearDown(self):
+        """Clean up the test environment"""
+        db.session.rollback()
+        db.drop_all()
+        self.context.pop()
+
+    def test_timeline_pages(self):
+        """Test the feed comes back newest first, one cursor page at a time"""
+        first = self.client.get('/api/v1/timeline?limit=2').get_json()
+        self.assertEqual([m['text'] for m in first['messages']], ['Message 2', 'Message 1'])
+        self.assertEqual(first['messages'][0]['user']['username'], 'author')
+
+        second = self.client.get(f'/api/v1/timeline?limit=2&after={first["next_cursor"]}').get_json()
+        self.assertEqual([m['text'] for m in second['messages']], ['Message 0'])
+        self.assertIsNone(second['next_cursor'])
+
+    def test_user_messages(self):
+        """Test a user's messages page, and 404 for unknown users"""
+        response = self.client.get(f'/api/v1/users/{self.author_id}/messages?limit=1')
+        self.assertEqual(len(response.get_json()['messages']), 1)
+        self.assertEqual(self.client.get('/api/v1/users/9999/messages').status_code, 404)
+
+    def test_batches(self):
+        """Test batch lookups keep the requested order and skip missing ids"""
+        users = self.client.get(f'/api/v1/users?ids={self.author_id},9999,{self.reader_id}').get_json()['users']
+        self.assertEqual([u['username'] for u in users], ['author', 'reader'])
+        self.assertTrue(users[0]['following'])
+        self.assertNotIn('password', users[0])
+
+        ids = ','.join(str(i) for i in reversed(self.message_ids))
+        messages = self.client.get(f'/api/v1/messages?ids={ids}').get_json()['messages']
+        self.assertEqual([m['id'] for m in messages], [str(i) for i in reversed(self.message_ids)])
+
+        self.assertEqual(self.client.get('/api/v1/messages?ids=x').status_code, 400)
+
+    def test_like_is_idempotent(self):
+        """Test repeated likes and unlikes leave one like and a correct count"""
+        url = f'/api/v1/messages/{self.message_ids[0]}/like'
+        self.client.put(url)
+        response = self.client.put(url)
+        self.assertEqual(response.get_json(), {'id': str(self.message_ids[0]), 'liked': True, 'likes_count': 1})
+        self.assertEqual(Likes.query.count(), 1)
+
+        self.client.delete(url)
+        response = self.client.delete(url)
+        self.assertEqual(response.get_json()['likes_count'], 0)
+        self.assertFalse(response.get_json()['liked'])
+
+    def test_like_deleted_author(self):
+        """Test a message whose author is being deleted cannot be liked"""
+        hide_user(db.session.get(User, self.author_id))
+        db.session.commit()
+
+        response = self.client.put(f'/api/v1/messages/{self.message_ids[0]}/like')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(Likes.query.count(), 0)
+
+    def test_requires_login(self):
+        """Test the feed and likes answer 401 with a JSON error when logged out"""
+        client = app.test_client()
+        response = client.get('/api/v1/timeline')
+        self.assertEqual(response.status_code, 401)
+        self.assertIn('error', response.get_json())
+        self.assertEqual(client.put(f'/api/v1/messages/{self.message_ids[0]}/like').status_code, 401)
@@ -0,0 +1,75 @@
+import os
+import unittest
+from unittest import mock
+from app import create_app
+from config import engine_options
+from followgraph import follow_graph
+from models import db
+from passwords import password_hasher
+
+class AppFactoryTestCase(unittest.TestCase):
+
+    def test_profiles(self):
+        dev = create_app('dev', SQLALCHEMY_DATABASE_URI='sqlite://')
+        test = create_app('test', SQLALCHEMY_DATABASE_URI='sqlite://')
+
+        self.assertTrue(dev.debug)
+        self.assertTrue(dev.config['SQLALCHEMY_ECHO'])
+        self.assertTrue(test.testing)
+        self.assertFalse(test.config['SQLALCHEMY_ECHO'])
+        self.assertFalse(test.config['INSTRUMENTATION_ENABLED'])
+        self.assertIn('warbler.homepage', test.view_functions)
+
+    def test_prod_requires_secret_key(self):
+        with mock.patch.dict(os.environ, {}, clear=True):
+            with self.assertRaises(RuntimeError):
+                create_app('prod', SQLALCHEMY_DATABASE_URI='sqlite://')
+
+    def test_prod_skips_debug_toolbar(self):
+        app = create_app('prod', SQLALCHEMY_DATABASE_URI='sqlite://', SECRET_KEY='secret')
+
+        self.assertFalse(app.debug)
+        self.assertNotIn('debugtoolbar', app.blueprints)
+        self.assertNotIn('Server-Timing', app.test_client().get('/static/stylesheets/style.css').headers)
+
+    def test_live_feed_needs_async_worker(self):
+        with mock.patch.dict(os.environ, {'SECRET_KEY': 'secret'}, clear=True):
+            self.assertFalse(create_app('prod', SQLALCHEMY_DATABASE_URI='sqlite://').config['LIVE_ENABLED'])
+        with mock.patch.dict(os.environ, {'SECRET_KEY': 'secret', 'WORKER_CLASS': 'gevent'}, clear=True):
+            self.assertTrue(create_app('prod', SQLALCHEMY_DATABASE_URI='sqlite://').config['LIVE_ENABLED'])
+
+    def test_extension_state_is_per_app(self):
+        first = create_app('test', SQLALCHEMY_DATABASE_URI='sqlite://')
+        second = create_app('test', SQLALCHEMY_DATABASE_URI='sqlite://', BCRYPT_LOG_ROUNDS=5)
+
+        with first.app_context():
+            db.create_all()
+            follow_graph.current()
+            follow_graph.add_edge(1, 2)
+            db.session.commit()
+            self.assertEqual(password_hasher.rounds, 4)
+        with second.app_context():
+            db.create_all()
+            self.assertFalse(follow_graph.is_following(1, 2))
+            self.assertEqual(password_hasher.rounds, 5)
+        self.assertIsNot(first.extensions['follow_graph'], second.extensions['follow_graph'])
+
+    def test_engine_options(self):
+        config = dict(
+            SQLALCHEMY_DATABASE_URI='postgresql:///warbler',
+            DB_POOL_SIZE=10,
+            DB_MAX_OVERFLOW=20,
+            DB_POOL_TIMEOUT=10,
+            DB_POOL_RECYCLE=1800,
+            DB_POOL_PRE_PING=True,
+            DB_STATEMENT_TIMEOUT_MS=5000,
+        )
+        options = engine_options(config)
+
+        self.assertEqual(options['pool_size'], 10)
+        self.assertTrue(options['pool_pre_ping'])
+        self.assertEqual(options['connect_args'], {'options': '-c statement_timeout=5000'})
+        self.assertEqual(engine_options(dict(config, SQLALCHEMY_DATABASE_URI='sqlite://')), {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import gzip
+import os
+import tempfile
+import unittest
+from flask import Flask, render_template_string
+from assets import Assets, build, read_manifest
+from httpcache import apply_policy
+
+CSS = 'body { background: url("/static/images/dot.png"); }\n' + '.rule { color: red; }\n' * 200
+
+class AssetsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.static = os.path.join(self.directory.name, 'static')
+        self.output = os.path.join(self.directory.name, 'assets')
+        os.makedirs(os.path.join(self.static, 'images'))
+        os.makedirs(os.path.join(self.static, 'stylesheets'))
+        self.write('images/dot.png', b'\x89PNG\r\n\x1a\nfake')
+        self.write('stylesheets/style.css', CSS.encode())
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, name, data):
+        with open(os.path.join(self.static, name), 'wb') as out:
+            out.write(data)
+
+    def make_app(self, **config):
+        app = Flask(__name__, static_folder=self.static)
+        app.config['ASSETS_FOLDER'] = self.output
+        app.config.update(config)
+        Assets(app)
+        app.after_request(apply_policy)
+        return app
+
+    def test_build(self):
+        manifest = build(self.static, self.output)
+        image = manifest['files']['images/dot.png']
+        stylesheet = manifest['files']['stylesheets/style.css']
+
+        self.assertRegex(image, r'^images/dot\.[0-9a-f]{12}\.png$')
+        with open(os.path.join(self.output, stylesheet)) as built:
+            self.assertIn(f"url('/assets/{image}')", built.read())
+        self.assertIn('gzip', manifest['encodings'][stylesheet])
+        # Images are already compressed
+        self.assertNotIn(image, manifest['encodings'])
+        self.assertEqual(read_manifest(self.output), manifest)
+
+    def test_fingerprint_follows_content(self):
+        before = build(self.static, self.output)['files']
+        self.write('images/dot.png', b'\x89PNG\r\n\x1a\nchanged')
+        after = build(self.static, self.output)['files']
+
+        self.assertNotEqual(before['images/dot.png'], after['images/dot.png'])
+        # The stylesheet names the image, so its fingerprint changes with it
+        self.assertNotEqual(before['stylesheets/style.css'], after['stylesheets/style.css'])
+
+    def test_static_url(self):
+        app = self.make_app()
+        with app.test_request_context():
+            url = render_template_string("{{ static_url('stylesheets/style.css') }}")
+            missing = render_template_string("{{ static_url('missing.js') }}")
+        self.assertRegex(url, r'^/assets/stylesheets/style\.[0-9a-f]{12}\.css$')
+        self.assertEqual(missing, '/static/missing.js')
+
+    def test_serves_precompressed(self):
+        app = self.make_app()
+        client = app.test_client()
+        with app.test_request_context():
+            url = render_template_string("{{ static_url('stylesheets/style.css') }}")
+
+        response = client.get(url, headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.mimetype, 'text/css')
+        self.assertEqual(gzip.decompress(response.data).decode(), CSS.replace(
+            '"/static/images/dot.png"', f"'/assets/{read_manifest(self.output)['files']['images/dot.png']}'"
+        ))
+        self.assertEqual(response.headers['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+
+        plain = client.get(url, headers={'Accept-Encoding': 'identity'})
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertIn('.rule', plain.get_data(as_text=True))
+
+    def test_unknown_asset(self):
+        client = self.make_app().test_client()
+        self.assertEqual(client.get('/assets/manifest.json').status_code, 404)
+        self.assertEqual(client.get('/assets/../static/images/dot.png').status_code, 404)
+        self.assertEqual(client.get('/assets/images/dot.0123456789ab.png').status_code, 404)
+
+    def test_startup_skips_unchanged_build(self):
+        self.make_app()
+        manifest = os.path.join(self.output, 'manifest.json')
+        built_at = os.stat(manifest).st_mtime_ns
+        self.make_app()
+        self.assertEqual(os.stat(manifest).st_mtime_ns, built_at)
+
+    def test_no_build_on_startup(self):
+        # A stale build is logged; there is none here at all
+        with self.assertLogs(level='WARNING'):
+            app = self.make_app(ASSETS_BUILD_ON_STARTUP=False)
+        self.assertIsNone(read_manifest(self.output))
+        with app.test_request_context():
+            self.assertEqual(app.extensions['assets'].static_url('stylesheets/style.css'),
+                             '/static/stylesheets/style.css')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+from unittest import TestCase
+from app import create_app, db
+from models import User, Message, Follows, Likes
+import counters
+
+app = create_app('test')
+
+class CountersTestCase(TestCase):
+    def setUp(self):
+        """Set up two users, a follow, a message and a like"""
+        self.context = app.app_context()
+        self.context.push()
+        db.drop_all()
+        db.create_all()
+
+        author = User(username='author', email='author@example.com', password='password')
+        fan = User(username='fan', email='fan@example.com', password='password')
+        db.session.add_all([author, fan])
+        db.session.commit()
+
+        message = Message(text='Test message', user_id=author.id)
+        db.session.add(message)
+        db.session.add(Follows(user_being_followed_id=author.id, user_following_id=fan.id))
+        db.session.flush()
+        db.session.add(Likes(user_id=fan.id, message_id=message.id))
+        db.session.commit()
+
+        self.author = author
+        self.fan = fan
+        self.message = message
+
+    def tearDown(self):
+        """Clean up the test environment"""
+        db.session.rollback()
+        db.drop_all()
+        self.context.pop()
+
+    def test_incremental_counters(self):
+        """Test bumps are applied to the loaded rows"""
+        counters.followed(self.fan.id, self.author.id)
+        counters.message_posted(self.author.id)
+        counters.liked(self.fan.id, self.message.id)
+        db.session.commit()
+
+        self.assertEqual(self.author.followers_count, 1)
+        self.assertEqual(self.author.messages_count, 1)
+        self.assertEqual(self.fan.following_count, 1)
+        self.assertEqual(self.fan.likes_count, 1)
+        self.assertEqual(self.message.likes_count, 1)
+
+    def test_recount_all(self):
+        """Test recount rebuilds counters from the underlying tables"""
+        counters.recount_all()
+        db.session.commit()
+        db.session.expire_all()
+
+        self.assertEqual(self.author.followers_count, 1)
+        self.assertEqual(self.author.following_count, 0)
+        self.assertEqual(self.author.messages_count, 1)
+        self.assertEqual(self.fan.following_count, 1)
+        self.assertEqual(self.fan.likes_count, 1)
+        self.assertEqual(self.message.likes_count, 1)
+
+# Run the tests
+if __name__ == '__main__':
+    import unittest
+
+    unittest.main()
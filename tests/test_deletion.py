@@ -0,0 +1,126 @@
+from unittest import TestCase, mock
+from app import create_app, db, CURRENT_USER_KEY
+from models import DeletionJob, User, Message, Follows, Likes, TimelineEntry
+from deletion import FINISHED, SKIPPED, hide_user, purge_batch, run_job
+import counters
+import timeline
+
+app = create_app('test', DELETION_WORKER=False)
+
+class DeletionTestCase(TestCase):
+    def setUp(self):
+        """Set up a leaving user who follows and is followed by a friend, with likes both ways"""
+        self.context = app.app_context()
+        self.context.push()
+        db.drop_all()
+        db.create_all()
+
+        leaving = User(username='leaving', email='leaving@example.com', password='password')
+        friend = User(username='friend', email='friend@example.com', password='password')
+        db.session.add_all([leaving, friend])
+        db.session.commit()
+
+        db.session.add(Follows(user_being_followed_id=leaving.id, user_following_id=friend.id))
+        db.session.add(Follows(user_being_followed_id=friend.id, user_following_id=leaving.id))
+        own = [Message(text=f'Leaving {i}', user_id=leaving.id) for i in range(3)]
+        theirs = Message(text='Staying', user_id=friend.id)
+        db.session.add_all(own + [theirs])
+        db.session.flush()
+        for message in own:
+            timeline.fan_out_message(message)
+        db.session.add(Likes(user_id=friend.id, message_id=own[0].id))
+        db.session.add(Likes(user_id=leaving.id, message_id=theirs.id))
+        counters.recount_all()
+        db.session.commit()
+
+        self.leaving_id = leaving.id
+        self.friend_id = friend.id
+        self.theirs_id = theirs.id
+        self.own_ids = [message.id for message in own]
+
+    def tearDown(self):
+        """Clean up the test environment"""
+        db.session.rollback()
+        db.drop_all()
+        self.context.pop()
+
+    def test_hide_user(self):
+        """Test a deleted user disappears at once but their rows stay until purged"""
+        hide_user(db.session.get(User, self.leaving_id))
+        db.session.commit()
+
+        friend = db.session.get(User, self.friend_id)
+        self.assertEqual(friend.followers, [])
+        self.assertEqual(friend.following, [])
+        self.assertFalse(User.authenticate('leaving', 'password'))
+        self.assertEqual(Message.query.filter_by(user_id=self.leaving_id).count(), 3)
+        self.assertEqual(DeletionJob.query.get(self.leaving_id).stage, 'likes')
+
+    def test_run_job(self):
+        """Test the job purges every row and fixes the counters of the users left"""
+        hide_user(db.session.get(User, self.leaving_id))
+        db.session.commit()
+
+        self.assertEqual(run_job(self.leaving_id, limit=2), FINISHED)
+        db.session.expire_all()
+
+        self.assertIsNone(db.session.get(User, self.leaving_id))
+        self.assertEqual(Message.query.filter_by(user_id=self.leaving_id).count(), 0)
+        self.assertEqual(Follows.query.count(), 0)
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(TimelineEntry.query.count(), 0)
+
+        friend = db.session.get(User, self.friend_id)
+        self.assertEqual((friend.followers_count, friend.following_count, friend.likes_count), (0, 0, 0))
+        self.assertEqual(db.session.get(Message, self.theirs_id).likes_count, 0)
+
+        job = DeletionJob.query.get(self.leaving_id)
+        self.assertIsNotNone(job.finished_at)
+        # one like given, two follow edges, one like received, six timeline entries, three messages
+        self.assertEqual(job.rows_deleted, 1 + 2 + 1 + 6 + 3)
+
+    def test_resume(self):
+        """Test a job stopped part way through carries on from its last batch"""
+        hide_user(db.session.get(User, self.leaving_id))
+        db.session.commit()
+
+        purge_batch(self.leaving_id, 1)
+        purge_batch(self.leaving_id, 1)
+        purge_batch(self.leaving_id, 1)
+        job = DeletionJob.query.get(self.leaving_id)
+        self.assertEqual(job.stage, 'follows')
+        self.assertEqual(job.rows_deleted, 2)
+
+        self.assertEqual(run_job(self.leaving_id), FINISHED)
+        friend = db.session.get(User, self.friend_id)
+        self.assertEqual((friend.followers_count, friend.following_count), (0, 0))
+
+    def test_skipped_when_locked(self):
+        """Test a job held by another worker is reported as skipped, not finished"""
+        hide_user(db.session.get(User, self.leaving_id))
+        db.session.commit()
+
+        # SQLite has no row locks, so stand in for a job another worker holds
+        with mock.patch('deletion.DeletionJob.query') as query:
+            query.filter_by.return_value.with_for_update.return_value.first.return_value = None
+            self.assertIsNone(purge_batch(self.leaving_id, 1))
+            self.assertEqual(run_job(self.leaving_id), SKIPPED)
+        self.assertIsNone(DeletionJob.query.get(self.leaving_id).finished_at)
+
+    def test_no_new_follows_or_likes(self):
+        """Test a deleted user can no longer be followed or have their messages liked"""
+        other = User(username='other', email='other@example.com', password='password')
+        db.session.add(other)
+        db.session.commit()
+        other_id = other.id
+        hide_user(db.session.get(User, self.leaving_id))
+        db.session.commit()
+
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session[CURRENT_USER_KEY] = other_id
+        self.assertEqual(client.post(f'/users/follow/{self.leaving_id}').status_code, 404)
+        self.assertEqual(client.post(f'/users/add_like/{self.own_ids[1]}').status_code, 404)
+
+        self.assertEqual(Follows.query.filter_by(user_following_id=other_id).count(), 0)
+        self.assertEqual(Likes.query.filter_by(user_id=other_id).count(), 0)
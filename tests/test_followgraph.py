@@ -0,0 +1,139 @@
+import os
+import tempfile
+import unittest
+from sqlalchemy import create_engine, insert
+from app import create_app
+from followgraph import FollowGraph, Graph, NeighborSet
+from models import db, FollowEdit, Follows, User
+
+class NeighborSetTestCase(unittest.TestCase):
+
+    def test_sorted_array(self):
+        neighbors = NeighborSet([5, 1, 3])
+        self.assertIn(3, neighbors)
+        self.assertNotIn(4, neighbors)
+        neighbors.add(4)
+        neighbors.discard(1)
+        self.assertEqual(list(neighbors), [3, 4, 5])
+        self.assertEqual(len(neighbors), 3)
+
+    def test_compacts_to_bitset_when_dense(self):
+        # 50 of 100 possible ids: a bitset (13 bytes) beats 50 uint32s
+        neighbors = NeighborSet(range(0, 100, 2))
+        neighbors.compact(100)
+        self.assertIsNotNone(neighbors.bits)
+        self.assertLess(neighbors.nbytes(), 50)
+        self.assertIn(98, neighbors)
+        self.assertNotIn(99, neighbors)
+        self.assertNotIn(5000, neighbors)
+
+        neighbors.add(250)
+        neighbors.discard(0)
+        self.assertIn(250, neighbors)
+        self.assertNotIn(0, neighbors)
+        self.assertEqual(len(neighbors), 50)
+        self.assertEqual(list(neighbors)[:2], [2, 4])
+
+    def test_stays_array_when_sparse(self):
+        neighbors = NeighborSet([1, 2])
+        neighbors.compact(1000000)
+        self.assertIsNone(neighbors.bits)
+
+class GraphTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # (follower, followed)
+        self.graph = Graph([(1, 2), (2, 1), (1, 3), (3, 2)])
+
+    def test_is_following(self):
+        self.assertTrue(self.graph.is_following(1, 3))
+        self.assertFalse(self.graph.is_following(3, 1))
+        self.assertFalse(self.graph.is_following(9, 1))
+
+    def test_followers_and_mutuals(self):
+        self.assertEqual(set(self.graph.followers_of(2)), {1, 3})
+        self.assertEqual(set(self.graph.following_of(1)), {2, 3})
+        self.assertEqual(self.graph.mutuals(1), {2})
+
+    def test_edges_and_removal(self):
+        self.graph.add_edge(3, 1)
+        self.assertEqual(self.graph.mutuals(1), {2, 3})
+
+        self.graph.remove_edge(1, 2)
+        self.assertFalse(self.graph.is_following(1, 2))
+
+        self.graph.remove_user(3)
+        self.assertEqual(set(self.graph.following_of(1)), set())
+        self.assertEqual(set(self.graph.followers_of(2)), set())
+
+class EditDuringLoad(FollowGraph):
+    '''Follows someone while the edges are being read, as a concurrent request would'''
+
+    def edges(self):
+        edges = list(super().edges())
+        self.add_edge(3, 1)
+        db.session.commit()
+        return edges
+
+class FollowGraphTestCase(unittest.TestCase):
+    '''A SQLite file where 1 follows 2'''
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        url = 'sqlite:///' + os.path.join(self.directory.name, 'warbler.db')
+        engine = create_engine(url)
+        db.metadata.create_all(engine)
+        with engine.begin() as conn:
+            conn.execute(insert(User), [dict(email=f'{n}@example.com', username=f'user{n}', password='x')
+                                        for n in range(1, 4)])
+            conn.execute(insert(Follows), [dict(user_following_id=1, user_being_followed_id=2)])
+        engine.dispose()
+
+        self.app = create_app('test', SQLALCHEMY_DATABASE_URI=url)
+        self.context = self.app.app_context()
+        self.context.push()
+
+    def tearDown(self):
+        db.session.remove()
+        db.engine.dispose()
+        self.context.pop()
+        self.directory.cleanup()
+
+    def test_stale_graph_is_served_while_reloading(self):
+        graph = FollowGraph()
+        self.assertTrue(graph.is_following(1, 2))
+
+        db.session.add(Follows(user_following_id=2, user_being_followed_id=3))
+        db.session.commit()
+        self.app.config['FOLLOW_GRAPH_TTL'] = 0
+        self.assertFalse(graph.is_following(2, 3))
+
+        # Wait for the background reload to finish
+        self.assertTrue(graph.loading.acquire(timeout=5))
+        graph.loading.release()
+        self.assertTrue(graph.is_following(2, 3))
+
+    def test_edits_from_other_processes_are_synced(self):
+        graph = FollowGraph()
+        self.assertFalse(graph.is_following(2, 3))
+
+        # Another process follows, logging the edit with it
+        db.session.add_all([Follows(user_following_id=2, user_being_followed_id=3),
+                            FollowEdit(action='add_edge', follower_id=2, followed_id=3)])
+        db.session.commit()
+        self.assertFalse(graph.is_following(2, 3))
+        with self.app.test_request_context():
+            self.assertTrue(graph.is_following(2, 3))
+
+        graph.remove_edge(2, 3)
+        db.session.commit()
+        self.assertFalse(graph.is_following(2, 3))
+
+    def test_edit_during_load_is_kept(self):
+        graph = EditDuringLoad()
+        self.assertTrue(graph.is_following(3, 1))
+        self.assertTrue(graph.is_following(1, 2))
+        self.assertIsNone(graph.edits)
+
+if __name__ == '__main__':
+    unittest.main()
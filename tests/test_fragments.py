@@ -0,0 +1,75 @@
+import os
+import unittest
+from datetime import datetime
+from types import SimpleNamespace
+from flask import Flask, render_template_string
+from fragments import FragmentCache, LocalBackend
+from images import ImageProxy
+
+TEMPLATES = os.path.join(os.path.dirname(__file__), '..', 'templates')
+
+def make_message(message_id, username='author', profile_version=1):
+    user = SimpleNamespace(id=1, username=username, image_url='/static/images/default-pic.png',
+                           profile_version=profile_version)
+    return SimpleNamespace(id=message_id, user_id=1, user=user, text=f'Message {message_id}',
+                           timestamp=datetime(2023, 6, 1))
+
+class LocalBackendTestCase(unittest.TestCase):
+
+    def test_evicts_by_size(self):
+        backend = LocalBackend(max_bytes=10)
+        backend.set_many({'a': '12345', 'b': '12345'})
+        backend.get_many(['a'])
+        backend.set_many({'c': '123'})
+
+        self.assertEqual(set(backend.get_many(['a', 'b', 'c'])), {'a', 'c'})
+        self.assertEqual(backend.stats()['evictions'], 1)
+        self.assertLessEqual(backend.stats()['bytes'], 10)
+
+class FragmentCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__, template_folder=TEMPLATES)
+        self.cache = FragmentCache(self.app)
+        ImageProxy(self.app)
+
+    def render(self, messages):
+        with self.app.test_request_context():
+            return render_template_string(
+                '{% set cards = message_cards(messages) %}{% for m in messages %}{{ cards[m.id] }}{% endfor %}',
+                messages=messages
+            )
+
+    def test_hits_after_first_render(self):
+        messages = [make_message(1), make_message(2)]
+        first = self.render(messages)
+        second = self.render(messages)
+
+        self.assertEqual(first, second)
+        self.assertIn('@author', first)
+        self.assertIn('01 June 2023', first)
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 2))
+        self.assertEqual(stats['hit_rate'], 0.5)
+        self.assertGreater(stats['render_ms_per_miss'], 0)
+
+    def test_profile_change_misses(self):
+        self.render([make_message(1)])
+        html = self.render([make_message(1, username='renamed', profile_version=2)])
+
+        self.assertIn('@renamed', html)
+        self.assertEqual(self.cache.stats()['misses'], 2)
+
+    def test_cards_are_escaped(self):
+        message = make_message(1)
+        message.text = '<script>alert(1)</script>'
+        self.assertNotIn('<script>', self.render([message]))
+
+    def test_disabled(self):
+        self.app.config['FRAGMENT_CACHE_ENABLED'] = False
+        self.render([make_message(1)])
+        self.render([make_message(1)])
+        self.assertEqual(self.cache.stats()['hits'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import csv
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+USERS, MESSAGES, FOLLOWS = 500, 3000, 4000
+
+def generate(out, processes):
+    subprocess.run(
+        [sys.executable, os.path.join(ROOT, 'generator', 'create_csvs.py'),
+         '--users', str(USERS), '--messages', str(MESSAGES), '--follows', str(FOLLOWS),
+         '--shard-rows', '700', '--processes', str(processes),
+         '--seed', '3', '--end', '2024-01-01', '--out', out],
+        check=True, stdout=subprocess.DEVNULL
+    )
+
+def read(directory, name):
+    with open(os.path.join(directory, f'{name}.csv'), newline='') as source:
+        return list(csv.DictReader(source))
+
+class GeneratorTestCase(unittest.TestCase):
+    '''Generates a small sharded dataset with one process and with three'''
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.single = os.path.join(cls.directory.name, 'single')
+        cls.parallel = os.path.join(cls.directory.name, 'parallel')
+        generate(cls.single, 1)
+        generate(cls.parallel, 3)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+    def test_reproducible_across_processes(self):
+        for name in ('users', 'messages', 'follows'):
+            with open(os.path.join(self.single, f'{name}.csv'), 'rb') as single, \
+                 open(os.path.join(self.parallel, f'{name}.csv'), 'rb') as parallel:
+                self.assertEqual(single.read(), parallel.read(), name)
+
+    def test_unique_users(self):
+        users = read(self.single, 'users')
+        self.assertEqual(len(users), USERS)
+        self.assertEqual(len({user['username'] for user in users}), USERS)
+        self.assertEqual(len({user['email'] for user in users}), USERS)
+
+    def test_unique_message_ids(self):
+        messages = read(self.single, 'messages')
+        self.assertEqual(len(messages), MESSAGES)
+        self.assertEqual(len({message['id'] for message in messages}), MESSAGES)
+        self.assertTrue(all(1 <= int(message['user_id']) <= USERS for message in messages))
+
+    def test_unique_follows(self):
+        follows = {(int(row['user_following_id']), int(row['user_being_followed_id']))
+                   for row in read(self.single, 'follows')}
+        self.assertEqual(len(follows), FOLLOWS)
+        self.assertFalse([edge for edge in follows if edge[0] == edge[1]])
+        self.assertTrue(all(1 <= user_id <= USERS for edge in follows for user_id in edge))
+
+if __name__ == '__main__':
+    unittest.main()
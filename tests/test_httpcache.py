@@ -0,0 +1,79 @@
+import unittest
+from flask import Flask, flash, g
+from httpcache import apply_policy, cache_for, not_modified
+
+def make_app():
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = 'testsecretkey'
+    rendered = []
+
+    @app.before_request
+    def anonymous():
+        g.user = None
+
+    @app.route('/page/<int:version>')
+    def page(version):
+        cached = not_modified('page', version)
+        if cached:
+            return cached
+        rendered.append(version)
+        return 'page'
+
+    @app.route('/flash')
+    def add_flash():
+        flash('hello')
+        return 'ok'
+
+    @app.route('/form')
+    def form():
+        return 'form'
+
+    @app.route('/asset/<int:immutable>')
+    def asset(immutable):
+        cache_for(60, immutable=bool(immutable))
+        return 'asset'
+
+    app.after_request(apply_policy)
+    return app, rendered
+
+class HttpCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app, self.rendered = make_app()
+        self.client = self.app.test_client()
+
+    def test_conditional_get(self):
+        response = self.client.get('/page/1')
+        etag = response.headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+        self.assertEqual(response.headers['Cache-Control'], 'public, no-cache')
+
+        response = self.client.get('/page/1', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertEqual(self.rendered, [1])
+
+    def test_changed_data_renders(self):
+        etag = self.client.get('/page/1').headers['ETag']
+        response = self.client.get('/page/2', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+    def test_pending_flash_skips_validators(self):
+        etag = self.client.get('/page/1').headers['ETag']
+        self.client.get('/flash')
+        response = self.client.get('/page/1', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('ETag', response.headers)
+
+    def test_uncached_and_static(self):
+        self.assertEqual(self.client.get('/form').headers['Cache-Control'], 'no-store')
+        # A missing static file must not be cached for a year
+        static = self.client.get('/static/missing.css')
+        self.assertEqual(static.headers['Cache-Control'], 'no-store')
+
+    def test_cache_for(self):
+        self.assertEqual(self.client.get('/asset/1').headers['Cache-Control'], 'public, max-age=60, immutable')
+        self.assertEqual(self.client.get('/asset/0').headers['Cache-Control'], 'public, max-age=60')
+
+if __name__ == '__main__':
+    unittest.main()
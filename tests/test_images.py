@@ -0,0 +1,234 @@
+import io
+import os
+import struct
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from PIL import Image
+from sqlalchemy import create_engine, insert
+from app import create_app
+from images import DiskLRU, FileSource, HttpSource, ImageError, public_address, sniff
+from models import db, User
+
+def png(width, height, rgb=(200, 30, 30)):
+    '''A solid-colour PNG, built without Pillow'''
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    rows = b''.join(b'\x00' + bytes(rgb) * width for _ in range(height))
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(rows))
+            + chunk(b'IEND', b''))
+
+class DiskLRUTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_evicts_least_recently_used(self):
+        store = DiskLRU(self.directory.name, max_bytes=10)
+        store.put('aa1', b'12345')
+        store.put('bb2', b'12345')
+        store.get('aa1')
+        store.put('cc3', b'123')
+
+        self.assertIsNotNone(store.get('aa1'))
+        self.assertIsNone(store.get('bb2'))
+        self.assertFalse(os.path.exists(store.path('bb2')))
+        self.assertEqual(store.stats()['bytes'], 8)
+
+    def test_reloads_from_disk(self):
+        DiskLRU(self.directory.name, max_bytes=100).put('aa1', b'12345')
+        store = DiskLRU(self.directory.name, max_bytes=100)
+        self.assertEqual(store.read('aa1'), b'12345')
+        self.assertEqual(store.stats()['files'], 1)
+
+    def test_sniff(self):
+        self.assertEqual(sniff(png(1, 1)), 'image/png')
+        self.assertEqual(sniff(b'RIFF\x00\x00\x00\x00WEBPVP8 '), 'image/webp')
+        self.assertIsNone(sniff(b'<html>'))
+
+class ImageProxyTestCase(unittest.TestCase):
+    '''Users on a SQLite file whose pictures come from a directory of files'''
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        sources = os.path.join(self.directory.name, 'sources')
+        os.mkdir(sources)
+        with open(os.path.join(sources, 'big.png'), 'wb') as out:
+            out.write(png(600, 300))
+        with open(os.path.join(sources, 'default-pic.png'), 'wb') as out:
+            out.write(png(10, 10, (0, 0, 0)))
+        with open(os.path.join(sources, 'page.html'), 'wb') as out:
+            out.write(b'<html></html>')
+
+        url = 'sqlite:///' + os.path.join(self.directory.name, 'warbler.db')
+        engine = create_engine(url)
+        db.metadata.create_all(engine)
+        with engine.begin() as conn:
+            conn.execute(insert(User), [
+                dict(email=f'{name}@example.com', username=name, password='x', image_url=image_url,
+                     header_image_url='https://example.com/big.png')
+                for name, image_url in (('one', 'https://example.com/big.png'),
+                                        ('two', 'https://cdn.example.com/big.png'),
+                                        ('bad', 'https://example.com/page.html'))
+            ])
+        engine.dispose()
+
+        self.app = create_app('test', SQLALCHEMY_DATABASE_URI=url,
+                              IMAGE_CACHE_DIR=os.path.join(self.directory.name, 'cache'))
+        self.proxy = self.app.extensions['images']
+        self.proxy.source = FileSource(sources)
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.engine.dispose()
+        self.directory.cleanup()
+
+    def test_serves_immutable_image(self):
+        response = self.client.get('/img/1/avatar/96?v=1')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertIn('Accept', response.headers['Vary'])
+        self.assertEqual(sniff(response.data), response.mimetype)
+
+        again = self.client.get('/img/1/avatar/96?v=1', headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(again.status_code, 304)
+
+    def test_resizes_and_negotiates_webp(self):
+        response = self.client.get('/img/1/avatar/96?v=1', headers={'Accept': 'image/webp,*/*'})
+        self.assertEqual(response.mimetype, 'image/webp')
+        with Image.open(io.BytesIO(response.data)) as image:
+            self.assertEqual(image.size, (96, 96))
+
+        response = self.client.get('/img/1/header/400?v=1', headers={'Accept': 'image/png'})
+        self.assertEqual(response.mimetype, 'image/jpeg')
+        with Image.open(io.BytesIO(response.data)) as image:
+            self.assertEqual(image.size, (400, 200))
+
+    def test_same_picture_is_stored_once(self):
+        self.client.get('/img/1/avatar/96?v=1')
+        files = self.proxy.store.stats()['files']
+        self.client.get('/img/2/avatar/96?v=1')
+        # Only the second URL's entry is new; the original and its variant are shared
+        self.assertEqual(self.proxy.store.stats()['files'], files + 1)
+
+    def test_old_version_redirects(self):
+        response = self.client.get('/img/1/avatar/96?v=7')
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response.location.endswith('/img/1/avatar/96?v=1'))
+
+    def test_unknown_size_or_user(self):
+        self.assertEqual(self.client.get('/img/1/avatar/97?v=1').status_code, 404)
+        self.assertEqual(self.client.get('/img/1/banner/96?v=1').status_code, 404)
+        self.assertEqual(self.client.get('/img/99/avatar/96?v=1').status_code, 404)
+
+    def test_bad_source_falls_back_briefly(self):
+        response = self.client.get('/img/3/avatar/96?v=1')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('immutable', response.headers['Cache-Control'])
+        self.assertIn('max-age=300', response.headers['Cache-Control'])
+
+    def test_failed_sources_are_bounded(self):
+        self.app.config['IMAGE_FAILED_MAX'] = 2
+        with self.app.app_context():
+            for number in range(5):
+                self.proxy.mark_failed(f'url-{number}')
+            self.assertEqual(list(self.proxy.failed), ['url-3', 'url-4'])
+
+            self.app.config['IMAGE_RETRY_AFTER'] = 0
+            self.proxy.mark_failed('url-5')
+            self.assertFalse(self.proxy.failed_recently('url-5'))
+            self.assertEqual(list(self.proxy.failed), [])
+
+class SourceHandler(BaseHTTPRequestHandler):
+    '''Serves a picture, redirects to it or away from it, or trickles a body'''
+
+    def do_GET(self):
+        if self.path == '/big.png':
+            body = png(20, 10)
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path in ('/hop', '/to-private'):
+            self.send_response(302)
+            self.send_header('Location', '/big.png' if self.path == '/hop' else 'http://10.0.0.1/big.png')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.send_header('Content-Length', '1000')
+            self.end_headers()
+            for _ in range(100):
+                self.wfile.write(b'.' * 10)
+                self.wfile.flush()
+                time.sleep(0.05)
+
+    def log_message(self, format, *args):
+        pass
+
+def public_or_test_server(address):
+    '''Lets the test server on 127.0.0.1 through; every other address is checked as usual'''
+    return address == '127.0.0.1' or public_address(address)
+
+class HttpSourceTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), SourceHandler)
+        cls.server.daemon_threads = True
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base = f'http://127.0.0.1:{cls.server.server_port}'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def test_rejects_internal_addresses(self):
+        source = HttpSource(None, timeout=1, max_bytes=1024, deadline=1)
+        for url in ('http://127.0.0.1/a.png', 'http://localhost/a.png', 'http://169.254.169.254/latest',
+                    'http://10.1.2.3/a.png', 'http://[::1]/a.png', 'ftp://example.com/a.png', self.base + '/big.png'):
+            with self.assertRaises(ImageError, msg=url):
+                source.fetch(url)
+
+    @mock.patch('images.public_address', public_or_test_server)
+    def test_checks_every_redirect(self):
+        source = HttpSource(None, timeout=1, max_bytes=1024 * 1024, deadline=5)
+        self.assertEqual(sniff(source.fetch(self.base + '/hop')), 'image/png')
+        with self.assertRaises(ImageError):
+            source.fetch(self.base + '/to-private')
+
+    def test_checks_the_connected_address(self):
+        # As if the name had resolved to a public address for check_host
+        source = HttpSource(None, timeout=1, max_bytes=1024, deadline=1)
+        with mock.patch.object(source, 'check_host'):
+            with self.assertRaises(ImageError):
+                source.fetch(self.base + '/big.png')
+
+    @mock.patch('images.public_address', public_or_test_server)
+    def test_deadline(self):
+        source = HttpSource(None, timeout=5, max_bytes=1024 * 1024, deadline=0.3)
+        start = time.monotonic()
+        with self.assertRaises(ImageError):
+            source.fetch(self.base + '/slow')
+        self.assertLess(time.monotonic() - start, 2)
+
+    def test_errors_leave_out_the_url(self):
+        source = HttpSource(None, timeout=1, max_bytes=1024, deadline=1)
+        with self.assertRaises(ImageError) as caught:
+            source.fetch('http://127.0.0.1/avatar.png?token=secret')
+        self.assertNotIn('secret', str(caught.exception))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import os
+import tempfile
+import unittest
+from flask import Flask, render_template_string
+from sqlalchemy import create_engine, text
+from instrumentation import Instrumentation, timed
+from querybudget import QueryBudget
+
+engine = create_engine('sqlite://')
+
+def make_app(**config):
+    app = Flask(__name__)
+    app.config.update(config)
+    extension = Instrumentation(app)
+    # Statements are counted by QueryBudget
+    QueryBudget(app)
+
+    def view():
+        with engine.connect() as conn:
+            conn.execute(text('SELECT 1'))
+            conn.execute(text('SELECT 2'))
+        with timed('bcrypt'):
+            pass
+        return render_template_string('{{ 1 + 1 }}')
+
+    app.add_url_rule('/page', 'page', view)
+    return app, extension
+
+class InstrumentationTestCase(unittest.TestCase):
+
+    def test_server_timing(self):
+        app, extension = make_app()
+        response = app.test_client().get('/page')
+
+        timing = response.headers['Server-Timing']
+        self.assertIn('db;dur=', timing)
+        self.assertIn('desc="2 queries"', timing)
+        self.assertIn('template;dur=', timing)
+        self.assertIn('bcrypt;dur=', timing)
+        self.assertIn('app;dur=', timing)
+
+    def test_log_line(self):
+        app, extension = make_app()
+        with self.assertLogs('instrumentation', level='INFO') as logs:
+            app.test_client().get('/page')
+        self.assertIn('"db_statements": 2', logs.output[0])
+        self.assertIn('"endpoint": "page"', logs.output[0])
+
+    def test_metrics_endpoint(self):
+        app, extension = make_app(METRICS_ENDPOINT='/metrics')
+        client = app.test_client()
+        client.get('/page')
+        body = client.get('/metrics').get_data(as_text=True)
+
+        self.assertIn('warbler_requests_total{endpoint="page",method="GET",status="200"} 1', body)
+        self.assertIn('warbler_sql_statements_total{endpoint="page"} 2', body)
+        self.assertIn('warbler_request_duration_seconds_count{endpoint="page",method="GET"} 1', body)
+
+    def test_metrics_token(self):
+        app, extension = make_app(METRICS_ENDPOINT='/metrics', METRICS_TOKEN='secret')
+        client = app.test_client()
+
+        self.assertEqual(client.get('/metrics').status_code, 404)
+        self.assertEqual(client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code, 404)
+        self.assertEqual(client.get('/metrics', headers={'Authorization': 'Bearer secret'}).status_code, 200)
+
+    def test_disabled(self):
+        app, extension = make_app(INSTRUMENTATION_ENABLED=False, METRICS_ENDPOINT='/metrics')
+        client = app.test_client()
+        response = client.get('/page')
+
+        self.assertNotIn('Server-Timing', response.headers)
+        self.assertEqual(client.get('/metrics').status_code, 404)
+
+    def test_profile_capture(self):
+        with tempfile.TemporaryDirectory() as directory:
+            app, extension = make_app(PROFILE_ENDPOINT='page', PROFILE_SAMPLE_RATE=1, PROFILE_DIR=directory)
+            app.test_client().get('/page')
+
+            files = os.listdir(directory)
+            self.assertEqual(len(files), 1)
+            self.assertTrue(files[0].startswith('page-'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+from unittest import TestCase
+from app import create_app, db
+from models import User, Message, Likes
+from likes import like_message, liked_ids, toggle_like, unlike_message
+
+app = create_app('test')
+
+class LikesTestCase(TestCase):
+    def setUp(self):
+        """Set up an author with two messages and two fans"""
+        self.context = app.app_context()
+        self.context.push()
+        db.drop_all()
+        db.create_all()
+
+        users = [User(username=name, email=f'{name}@example.com', password='password')
+                 for name in ('author', 'fan1', 'fan2')]
+        db.session.add_all(users)
+        db.session.commit()
+        messages = [Message(text=f'Message {i}', user_id=users[0].id) for i in range(2)]
+        db.session.add_all(messages)
+        db.session.commit()
+
+        self.fan_ids = [users[1].id, users[2].id]
+        self.message_ids = [message.id for message in messages]
+
+    def tearDown(self):
+        """Clean up the test environment"""
+        db.session.rollback()
+        db.drop_all()
+        self.context.pop()
+
+    def test_many_users_like_one_message(self):
+        """Test every fan can like the same message and the count follows"""
+        for fan_id in self.fan_ids:
+            self.assertTrue(like_message(fan_id, self.message_ids[0]))
+        db.session.commit()
+
+        self.assertEqual(Likes.query.count(), 2)
+        self.assertEqual(db.session.get(Message, self.message_ids[0]).likes_count, 2)
+
+    def test_repeats_do_not_double_count(self):
+        """Test liking twice or unliking twice changes the counters once"""
+        fan_id, message_id = self.fan_ids[0], self.message_ids[0]
+        self.assertTrue(like_message(fan_id, message_id))
+        self.assertFalse(like_message(fan_id, message_id))
+        db.session.commit()
+        self.assertEqual(db.session.get(User, fan_id).likes_count, 1)
+
+        self.assertTrue(unlike_message(fan_id, message_id))
+        self.assertFalse(unlike_message(fan_id, message_id))
+        db.session.commit()
+        db.session.expire_all()
+        self.assertEqual(db.session.get(User, fan_id).likes_count, 0)
+        self.assertEqual(db.session.get(Message, message_id).likes_count, 0)
+
+    def test_toggle_and_liked_ids(self):
+        """Test toggling flips the like and liked_ids sees only the viewer's likes"""
+        fan_id, other_id = self.fan_ids
+        self.assertTrue(toggle_like(fan_id, self.message_ids[1]))
+        like_message(other_id, self.message_ids[0])
+        db.session.commit()
+
+        self.assertEqual(liked_ids(fan_id, self.message_ids), {self.message_ids[1]})
+        self.assertEqual(liked_ids(fan_id, []), set())
+
+        self.assertFalse(toggle_like(fan_id, self.message_ids[1]))
+        db.session.commit()
+        self.assertEqual(liked_ids(fan_id, self.message_ids), set())
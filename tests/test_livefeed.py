@@ -0,0 +1,131 @@
+import os
+import tempfile
+import time
+import unittest
+from sqlalchemy import create_engine, insert
+from app import create_app
+from livefeed import Broker, Hub, LocalBus
+from models import db, Follows, User
+
+def message(message_id, author_id):
+    return {'type': 'message', 'id': str(message_id), 'user_id': author_id, 'html': f'<p>{message_id}</p>'}
+
+class BrokerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = Broker(LocalBus(), queue_size=3)
+
+    def test_routes_by_author(self):
+        reader = self.broker.subscribe(1, {1, 2})
+        other = self.broker.subscribe(3, {3})
+        self.broker.publish(message(10, 2))
+        self.broker.publish(message(11, 4))
+
+        self.assertEqual(reader.get(0), ([message(10, 2)], 0))
+        self.assertEqual(other.get(0), ([], 0))
+
+    def test_follow_events(self):
+        reader = self.broker.subscribe(1, {1})
+        self.broker.publish({'type': 'follow', 'user_id': 1, 'followed_id': 2})
+        self.broker.publish(message(10, 2))
+        self.broker.publish({'type': 'unfollow', 'user_id': 1, 'followed_id': 2})
+        self.broker.publish(message(11, 2))
+
+        self.assertEqual(reader.get(0), ([message(10, 2)], 0))
+        self.assertNotIn(2, self.broker.by_author)
+
+    def test_slow_client_gets_a_gap(self):
+        reader = self.broker.subscribe(1, {2})
+        for message_id in range(5):
+            self.broker.publish(message(message_id, 2))
+
+        self.assertEqual(reader.get(0), ([message(3, 2), message(4, 2)], 3))
+        self.assertEqual(reader.get(0), ([], 0))
+
+    def test_unsubscribe(self):
+        reader = self.broker.subscribe(1, {1, 2})
+        self.broker.unsubscribe(reader)
+        self.assertEqual(self.broker.stats(), {'streams': 0, 'authors': 0})
+        self.assertTrue(reader.closed)
+
+    def test_nodes_share_a_hub(self):
+        hub = Hub()
+        nodes = [Broker(hub.bus()), Broker(hub.bus())]
+        reader = nodes[1].subscribe(1, {2})
+        nodes[0].publish(message(10, 2))
+
+        self.assertEqual(reader.get(5), ([message(10, 2)], 0))
+        for node in nodes:
+            node.close()
+
+class StreamViewTestCase(unittest.TestCase):
+    '''A SQLite file where reader follows author'''
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        url = 'sqlite:///' + os.path.join(self.directory.name, 'warbler.db')
+        engine = create_engine(url)
+        db.metadata.create_all(engine)
+        with engine.begin() as conn:
+            conn.execute(insert(User), [dict(email=f'{name}@example.com', username=name, password='x')
+                                        for name in ('reader', 'author', 'stranger')])
+            conn.execute(insert(Follows), [dict(user_following_id=1, user_being_followed_id=2)])
+        engine.dispose()
+
+        self.app = create_app('test', SQLALCHEMY_DATABASE_URI=url, LIVE_HEARTBEAT=0.05, LIVE_MAX_AGE=5)
+        self.client = self.app.test_client()
+        with self.client.session_transaction() as session:
+            session['current_user'] = 1
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.engine.dispose()
+        self.directory.cleanup()
+
+    def post(self, user_id, text):
+        with self.client.session_transaction() as session:
+            session['current_user'] = user_id
+        self.client.post('/messages/new', data={'text': text})
+        with self.client.session_transaction() as session:
+            session['current_user'] = 1
+
+    def read_until(self, response, marker):
+        body = b''
+        deadline = time.monotonic() + 5
+        while marker not in body and time.monotonic() < deadline:
+            body += next(response.response)
+        return body.decode()
+
+    def test_login_required(self):
+        with self.client.session_transaction() as session:
+            del session['current_user']
+        self.assertEqual(self.client.get('/stream/timeline').status_code, 401)
+
+    def test_pushes_followed_messages(self):
+        response = self.client.get('/stream/timeline', buffered=False)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+
+        self.post(3, 'from a stranger')
+        self.post(2, 'from the author')
+        body = self.read_until(response, b'from the author')
+        response.close()
+
+        self.assertIn('event: message', body)
+        # The event carries the whole feed item, like form included
+        self.assertIn('messages-form', body)
+        self.assertNotIn('from a stranger', body)
+        self.assertEqual(self.app.extensions['live_feed'].broker.stats()['streams'], 0)
+
+    def test_heartbeat(self):
+        response = self.client.get('/stream/timeline', buffered=False)
+        self.assertIn(': heartbeat', self.read_until(response, b'heartbeat'))
+        response.close()
+
+    def test_gap_on_resume(self):
+        self.post(2, 'while away')
+        response = self.client.get('/stream/timeline?since=1', buffered=False)
+        self.assertIn('event: gap', self.read_until(response, b'gap'))
+        response.close()
+
+if __name__ == '__main__':
+    unittest.main()
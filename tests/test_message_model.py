@@ -1,17 +1,14 @@
 from unittest import TestCase
-from app import app, db
+from app import create_app, db
 from models import User, Message
 
-# Set up a test database
-app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///warbler_db'
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['TESTING'] = True
-app.config['WTF_CSRF_ENABLED'] = False
-db.create_all()
+app = create_app('test')
 
 class MessageModelTestCase(TestCase):
     def setUp(self):
         """Set up the test environment"""
+        self.context = app.app_context()
+        self.context.push()
         db.drop_all()
         db.create_all()
 
@@ -25,6 +22,7 @@ class MessageModelTestCase(TestCase):
         """Clean up the test environment"""
         db.session.rollback()
         db.drop_all()
+        self.context.pop()
 
     def test_message_creation(self):
         """Test message creation"""
@@ -0,0 +1,93 @@
+import os
+import unittest
+from datetime import datetime
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import SQLAlchemyError
+from messageids import IdGenerator, MAX_SEQUENCE, LEASE_TABLE, WorkerIdsExhausted, claim_worker, make_id, timestamp_of
+from models import MessageIdLease
+
+# Leases are PostgreSQL only; the tests drop the lease table, so use a throwaway database
+DATABASE_URL = os.environ.get('MESSAGE_ID_DATABASE_URL', 'postgresql:///warbler_ids')
+
+def reachable(url):
+    '''Whether the database at url accepts connections'''
+
+    try:
+        engine = create_engine(url)
+        with engine.connect():
+            pass
+    except (ImportError, SQLAlchemyError):
+        return False
+    engine.dispose()
+    return True
+
+class FakeClock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+class IdGeneratorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock(1700000000.0)
+        self.ids = IdGenerator(worker=5, clock=self.clock)
+
+    def test_timestamp_round_trip(self):
+        message_id = make_id(1700000000123, 5, 7)
+        self.assertEqual(timestamp_of(message_id), datetime(2023, 11, 14, 22, 13, 20, 123000))
+
+    def test_increasing_within_a_millisecond(self):
+        ids = [self.ids.next_id() for _ in range(10)]
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertEqual(timestamp_of(ids[-1]), timestamp_of(ids[0]))
+
+    def test_clock_going_back(self):
+        first = self.ids.next_id()
+        self.clock.now -= 5
+        self.assertGreater(self.ids.next_id(), first)
+
+    def test_sequence_overflow_moves_to_next_millisecond(self):
+        ids = [self.ids.next_id() for _ in range(MAX_SEQUENCE + 2)]
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertEqual((timestamp_of(ids[-1]) - timestamp_of(ids[0])).microseconds, 1000)
+
+    def test_workers_do_not_collide(self):
+        other = IdGenerator(worker=6, clock=self.clock)
+        self.assertNotEqual(self.ids.next_id(), other.next_id())
+
+@unittest.skipUnless(reachable(DATABASE_URL), f'no database at {DATABASE_URL}')
+class WorkerLeaseTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine(DATABASE_URL)
+        MessageIdLease.__table__.drop(self.engine, checkfirst=True)
+        MessageIdLease.__table__.create(self.engine)
+
+    def tearDown(self):
+        MessageIdLease.__table__.drop(self.engine)
+        self.engine.dispose()
+
+    def test_live_leases_are_distinct(self):
+        first = claim_worker(self.engine, 60, workers=2)
+        second = claim_worker(self.engine, 60, workers=2)
+        self.assertNotEqual(first.worker, second.worker)
+        self.assertTrue(first.renew(self.engine))
+
+    def test_fails_when_every_id_is_leased(self):
+        claim_worker(self.engine, 60, workers=1)
+        with self.assertRaises(WorkerIdsExhausted):
+            claim_worker(self.engine, 60, workers=1)
+
+    def test_expired_lease_is_taken_over(self):
+        stale = claim_worker(self.engine, 60, workers=1)
+        with self.engine.begin() as conn:
+            conn.execute(text(f"UPDATE {LEASE_TABLE} SET expires_at = now() - interval '1 second'"))
+
+        fresh = claim_worker(self.engine, 60, workers=1)
+        self.assertEqual(fresh.worker, stale.worker)
+        self.assertFalse(stale.renew(self.engine))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+import os
+import tempfile
+import unittest
+from sqlalchemy import create_engine, inspect, text
+from models import db
+from migrations import v0000_baseline, v0003_index_plan
+import migrations
+
+class IndexPlanMigrationTestCase(unittest.TestCase):
+    '''A SQLite file migrated up to v0002, as it was before the index plan'''
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.engine = create_engine('sqlite:///' + os.path.join(self.directory.name, 'warbler.db'))
+        db.metadata.create_all(self.engine)
+        migrations.schema_migrations.create(self.engine)
+        with self.engine.begin() as conn:
+            for name, table, columns in v0003_index_plan.INDEXES:
+                conn.execute(text(f'DROP INDEX {name}'))
+            migrations.record(conn, 'v0000_baseline')
+            migrations.record(conn, 'v0001_likes_key')
+            migrations.record(conn, 'v0002_message_ids')
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.directory.cleanup()
+
+    def indexes(self, table):
+        return {index['name'] for index in inspect(self.engine).get_indexes(table)}
+
+    def test_upgrade_builds_indexes(self):
+        self.assertEqual(migrations.pending(self.engine)[0][0], 'v0003_index_plan')
+        self.assertEqual(migrations.upgrade(self.engine)[0], 'v0003_index_plan')
+
+        self.assertIn('ix_follows_following_followed', self.indexes('follows'))
+        self.assertLessEqual({'ix_timeline_entries_message_id', 'ix_timeline_entries_user_author'},
+                             self.indexes('timeline_entries'))
+        self.assertEqual(migrations.pending(self.engine), [])
+
+    def test_create_index_is_rerunnable(self):
+        with self.engine.connect() as conn:
+            conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+            v0003_index_plan.upgrade(conn)
+            v0003_index_plan.upgrade(conn)
+        self.assertIn('ix_follows_following_followed', self.indexes('follows'))
+
+class BaselineMigrationTestCase(unittest.TestCase):
+    '''A SQLite file with the original app's schema and a little data'''
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.engine = create_engine('sqlite:///' + os.path.join(self.directory.name, 'warbler.db'))
+        with self.engine.begin() as conn:
+            for statement in BASELINE_SCHEMA:
+                conn.execute(text(statement))
+            conn.execute(text(
+                "INSERT INTO users (id, email, username, password) VALUES "
+                "(1, 'a@example.com', 'a', 'x'), (2, 'b@example.com', 'b', 'x'), (3, 'c@example.com', 'c', 'x')"
+            ))
+            # b and c follow a; a likes b's message
+            conn.execute(text('INSERT INTO follows VALUES (1, 2), (1, 3)'))
+            conn.execute(text(
+                "INSERT INTO messages (id, text, timestamp, user_id) VALUES "
+                "(1, 'one', '2020-01-01 00:00:00', 1), (2, 'two', '2020-01-02 00:00:00', 2)"
+            ))
+            conn.execute(text('INSERT INTO likes (user_id, message_id) VALUES (1, 2)'))
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.directory.cleanup()
+
+    def upgrade(self):
+        with self.engine.begin() as conn:
+            v0000_baseline.upgrade(conn)
+
+    def test_adds_what_the_models_gained(self):
+        self.upgrade()
+        inspector = inspect(self.engine)
+
+        users = {column['name'] for column in inspector.get_columns('users')}
+        self.assertLessEqual({'profile_version', 'followers_count', 'deleted_at'}, users)
+        self.assertIn('likes_count', {column['name'] for column in inspector.get_columns('messages')})
+        self.assertLessEqual({'timeline_entries', 'deletion_jobs'}, set(inspector.get_table_names()))
+        # v0002 drops this column and moves timelines to the message id
+        self.assertIn('timestamp', {column['name'] for column in inspector.get_columns('timeline_entries')})
+
+    def test_fills_counters_and_timelines(self):
+        self.upgrade()
+        with self.engine.connect() as conn:
+            counts = conn.execute(text('SELECT id, followers_count, likes_count FROM users ORDER BY id')).all()
+            timelines = conn.execute(text('SELECT user_id, message_id FROM timeline_entries ORDER BY 1, 2')).all()
+            likes = conn.scalar(text('SELECT likes_count FROM messages WHERE id = 2'))
+
+        self.assertEqual([tuple(row) for row in counts], [(1, 2, 1), (2, 0, 0), (3, 0, 0)])
+        self.assertEqual([tuple(row) for row in timelines], [(1, 1), (2, 1), (2, 2), (3, 1)])
+        self.assertEqual(likes, 1)
+
+    def test_rerun_and_current_schema_are_no_ops(self):
+        self.upgrade()
+        self.upgrade()
+        with self.engine.connect() as conn:
+            self.assertEqual(conn.scalar(text('SELECT count(*) FROM timeline_entries')), 4)
+
+        current = create_engine('sqlite:///' + os.path.join(self.directory.name, 'current.db'))
+        db.metadata.create_all(current)
+        with current.begin() as conn:
+            v0000_baseline.upgrade(conn)
+        self.assertNotIn('timestamp', {column['name'] for column in inspect(current).get_columns('timeline_entries')})
+        current.dispose()
+
+# The tables the original app's models created
+BASELINE_SCHEMA = [
+    '''CREATE TABLE users (
+        id INTEGER PRIMARY KEY, email TEXT NOT NULL UNIQUE, username TEXT NOT NULL UNIQUE,
+        image_url TEXT, header_image_url TEXT, bio TEXT, location TEXT, password TEXT NOT NULL
+    )''',
+    '''CREATE TABLE follows (
+        user_being_followed_id INTEGER REFERENCES users (id) ON DELETE CASCADE,
+        user_following_id INTEGER REFERENCES users (id) ON DELETE CASCADE,
+        PRIMARY KEY (user_being_followed_id, user_following_id)
+    )''',
+    '''CREATE TABLE messages (
+        id INTEGER PRIMARY KEY, text VARCHAR(140) NOT NULL, timestamp DATETIME NOT NULL,
+        user_id INTEGER REFERENCES users (id) ON DELETE CASCADE
+    )''',
+    '''CREATE TABLE likes (
+        id INTEGER PRIMARY KEY, user_id INTEGER REFERENCES users (id) ON DELETE CASCADE,
+        message_id INTEGER UNIQUE REFERENCES messages (id) ON DELETE CASCADE
+    )''',
+]
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+import unittest
+from datetime import datetime
+from werkzeug.exceptions import BadRequest
+from pagination import encode_cursor, decode_cursor, decode_message_cursor, decode_user_cursor, make_page
+
+class PaginationTestCase(unittest.TestCase):
+
+    def test_message_cursor_round_trip(self):
+        # A 64-bit message id survives encoding unchanged
+        message_id = 2 ** 62 + 42
+        self.assertEqual(decode_message_cursor(encode_cursor(message_id)), message_id)
+        self.assertEqual(decode_cursor(encode_cursor(datetime(2023, 6, 1, 12, 30, 5, 123))), ['2023-06-01T12:30:05.000123'])
+
+    def test_user_cursor_round_trip(self):
+        self.assertEqual(decode_user_cursor(encode_cursor(7)), 7)
+        self.assertIsNone(decode_user_cursor(None))
+
+    def test_malformed_cursor(self):
+        # Garbage cursors are rejected with a 400 rather than a 500
+        with self.assertRaises(BadRequest):
+            decode_message_cursor('not-a-cursor')
+        with self.assertRaises(BadRequest):
+            decode_user_cursor(encode_cursor('a', 'b'))
+
+    def test_make_page(self):
+        # The extra row only signals another page; it is not returned
+        page = make_page([1, 2, 3], 2, lambda n: (n,))
+        self.assertEqual(page.items, [1, 2])
+        self.assertEqual(decode_user_cursor(page.next_cursor), 2)
+
+        last = make_page([1, 2], 2, lambda n: (n,))
+        self.assertIsNone(last.next_cursor)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import threading
+import unittest
+from passwords import HasherBusy, PasswordHasher, calibrate, cost_of
+
+class PasswordHasherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.hasher = PasswordHasher()
+        self.hasher.rounds = 4
+        self.hasher.start(workers=1, queue=0)
+
+    def test_hash_and_verify(self):
+        hashed = self.hasher.hash('password')
+        self.assertTrue(hashed.startswith('$2b$04$'))
+        self.assertTrue(self.hasher.verify(hashed, 'password'))
+        self.assertFalse(self.hasher.verify(hashed, 'wrongpassword'))
+        self.assertFalse(self.hasher.verify('not-a-hash', 'password'))
+
+    def test_needs_rehash(self):
+        self.assertEqual(cost_of('$2b$12$Q1PUFjhN/AWRQ21LbGYvje'), 12)
+        self.assertFalse(self.hasher.needs_rehash(self.hasher.hash('password')))
+        # Stronger hashes are kept; weaker ones are upgraded
+        self.assertFalse(self.hasher.needs_rehash('$2b$12$Q1PUFjhN/AWRQ21LbGYvje'))
+        self.hasher.rounds = 13
+        self.assertTrue(self.hasher.needs_rehash('$2b$12$Q1PUFjhN/AWRQ21LbGYvje'))
+
+    def test_busy_when_queue_full(self):
+        # One worker, no queue: a second job while the first runs is shed
+        started, release = threading.Event(), threading.Event()
+
+        def slow():
+            started.set()
+            release.wait(5)
+
+        worker = threading.Thread(target=self.hasher.run, args=(slow,))
+        worker.start()
+        started.wait(5)
+        with self.assertRaises(HasherBusy):
+            self.hasher.run(lambda: None)
+        release.set()
+        worker.join()
+        self.assertIsNone(self.hasher.run(lambda: None))
+
+    def test_calibrate_is_clamped(self):
+        self.assertEqual(calibrate(0.001, min_rounds=10, max_rounds=16), 10)
+        self.assertEqual(calibrate(10 ** 9, min_rounds=10, max_rounds=16), 16)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from sqlalchemy import create_engine
+from sqlalchemy.exc import SQLAlchemyError
+from app import create_app
+from bulkload import bulk_load
+from models import db, Follows, Message, User
+import queryplans
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Plans depend on table sizes; the generated data is large enough that the
+# planner prefers an index wherever one fits. The tests load, change and drop
+# every table, so this must be a throwaway database.
+DATABASE_URL = os.environ.get('QUERY_PLAN_DATABASE_URL', 'postgresql:///warbler_plans')
+SIZES = ['--users', '20000', '--messages', '200000', '--follows', '300000']
+
+def reachable(url):
+    '''Whether the database at url accepts connections'''
+
+    try:
+        engine = create_engine(url)
+        with engine.connect():
+            pass
+    except (ImportError, SQLAlchemyError):
+        return False
+    engine.dispose()
+    return True
+
+@unittest.skipUnless(reachable(DATABASE_URL), f'no database at {DATABASE_URL}')
+class QueryPlanTestCase(unittest.TestCase):
+    '''The hot pages never read a whole table'''
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        subprocess.run(
+            [sys.executable, os.path.join(ROOT, 'generator', 'create_csvs.py'), *SIZES,
+             '--seed', '1', '--end', '2024-01-01', '--out', cls.directory.name],
+            check=True, stdout=subprocess.DEVNULL
+        )
+        cls.app = create_app('test', SQLALCHEMY_DATABASE_URI=DATABASE_URL, DB_STATEMENT_TIMEOUT_MS=None)
+        with cls.app.app_context():
+            bulk_load([
+                (User, os.path.join(cls.directory.name, 'users.csv')),
+                (Message, os.path.join(cls.directory.name, 'messages.csv')),
+                (Follows, os.path.join(cls.directory.name, 'follows.csv')),
+            ])
+
+    @classmethod
+    def tearDownClass(cls):
+        with cls.app.app_context():
+            db.drop_all()
+        cls.directory.cleanup()
+
+    def test_no_full_scans(self):
+        findings = queryplans.check(self.app, writes=True)
+        self.assertEqual(findings, [], '\n\n'.join(
+            f'{finding["method"]} {finding["path"]}: {finding["tables"]}\n{finding["plan"]}' for finding in findings
+        ))
+
+    def test_detects_missing_index(self):
+        with self.app.app_context():
+            index = next(index for index in Follows.__table__.indexes if index.name == 'ix_follows_following_followed')
+            index.drop(db.engine)
+            try:
+                findings = queryplans.check(self.app, writes=True)
+            finally:
+                index.create(db.engine)
+        self.assertTrue(findings)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import unittest
+from flask import Flask
+from sqlalchemy import create_engine, text
+from querybudget import QueryBudget, QueryBudgetExceeded, query_budget
+
+engine = create_engine('sqlite://')
+
+def make_app(enforce):
+    app = Flask(__name__)
+    app.config['QUERY_BUDGET'] = 2
+    app.config['QUERY_BUDGET_ENFORCE'] = enforce
+    QueryBudget(app)
+
+    def run(n):
+        with engine.connect() as conn:
+            for _ in range(n):
+                conn.execute(text('SELECT 1'))
+        return 'ok'
+
+    app.add_url_rule('/cheap', 'cheap', lambda: run(2))
+    app.add_url_rule('/expensive', 'expensive', lambda: run(3))
+    app.add_url_rule('/allowed', 'allowed', query_budget(5)(lambda: run(3)))
+    return app
+
+class QueryBudgetTestCase(unittest.TestCase):
+
+    def test_within_budget(self):
+        client = make_app(True).test_client()
+        self.assertEqual(client.get('/cheap').status_code, 200)
+
+    def test_over_budget_fails_when_enforced(self):
+        app = make_app(True)
+        app.config['TESTING'] = True
+        with self.assertRaises(QueryBudgetExceeded):
+            app.test_client().get('/expensive')
+
+    def test_over_budget_logs_when_not_enforced(self):
+        client = make_app(False).test_client()
+        with self.assertLogs('querybudget', level='WARNING'):
+            self.assertEqual(client.get('/expensive').status_code, 200)
+
+    def test_view_override(self):
+        client = make_app(True).test_client()
+        self.assertEqual(client.get('/allowed').status_code, 200)
+
+if __name__ == '__main__':
+    unittest.main()
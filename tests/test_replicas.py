@@ -0,0 +1,72 @@
+import os
+import tempfile
+import unittest
+from sqlalchemy import create_engine, insert
+from app import create_app
+from models import db, User
+from replicas import WROTE_AT_KEY
+
+class ReadReplicaTestCase(unittest.TestCase):
+    '''Two SQLite files stand in for the primary and a replica that has not caught up'''
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        primary = 'sqlite:///' + os.path.join(self.directory.name, 'primary.db')
+        replica = 'sqlite:///' + os.path.join(self.directory.name, 'replica.db')
+
+        for url, username in ((primary, 'on-primary'), (replica, 'on-replica')):
+            engine = create_engine(url)
+            db.metadata.create_all(engine)
+            with engine.begin() as conn:
+                conn.execute(insert(User), [dict(email=f'{username}@example.com', username=username, password='x')])
+            engine.dispose()
+
+        self.app = create_app('test', SQLALCHEMY_DATABASE_URI=primary, SQLALCHEMY_REPLICA_URIS=[replica])
+
+        def read():
+            return User.query.get(1).username
+
+        def write():
+            user = User.query.get(1)
+            user.bio = 'changed'
+            db.session.commit()
+            return 'ok'
+
+        def read_after_flush():
+            db.session.add(User(email='new@example.com', username='new', password='x'))
+            db.session.flush()
+            return str(User.query.count())
+
+        self.app.add_url_rule('/_read', 'read', read)
+        self.app.add_url_rule('/_write', 'write', write, methods=['POST'])
+        self.app.add_url_rule('/_read_after_flush', 'read_after_flush', read_after_flush)
+
+    def tearDown(self):
+        with self.app.app_context():
+            for engine in [db.engine, *self.app.extensions['replicas'].engines]:
+                engine.dispose()
+        self.directory.cleanup()
+
+    def test_reads_go_to_replica(self):
+        client = self.app.test_client()
+        self.assertEqual(client.get('/_read').get_data(as_text=True), 'on-replica')
+
+    def test_reads_after_flush_use_primary(self):
+        client = self.app.test_client()
+        self.assertEqual(client.get('/_read_after_flush').get_data(as_text=True), '2')
+
+    def test_read_your_writes(self):
+        client = self.app.test_client()
+        client.post('/_write')
+        self.assertEqual(client.get('/_read').get_data(as_text=True), 'on-primary')
+
+        with client.session_transaction() as cookie:
+            cookie[WROTE_AT_KEY] -= 60
+        self.assertEqual(client.get('/_read').get_data(as_text=True), 'on-replica')
+
+    def test_outside_request_uses_primary(self):
+        with self.app.app_context():
+            self.assertEqual(db.session.get(User, 1).username, 'on-primary')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import unittest
+from search import InvertedIndex, escape_like, tokenize
+
+class InvertedIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.index = InvertedIndex()
+        self.index.add(1, [('john_doe', 3), ('Loves hiking', 1), ('Boston', 1)])
+        self.index.add(2, [('johnny', 3), ('Boston sports fan', 1), ('Denver', 1)])
+        self.index.add(3, [('mary', 3), ('Johnson fan club', 1), ('Boston', 1)])
+
+    def test_tokenize(self):
+        self.assertEqual(tokenize('John_Doe, Boston!'), ['john', 'doe', 'boston'])
+        self.assertEqual(tokenize(None), [])
+
+    def test_prefix_match(self):
+        # Prefixes match across fields; username hits outrank bio hits
+        self.assertEqual(self.index.search('john', 10), [1, 2, 3])
+
+    def test_exact_beats_prefix(self):
+        self.assertEqual(self.index.search('johnny', 10), [2])
+        self.assertEqual(self.index.search('boston fan', 10)[:2], [2, 3])
+
+    def test_limit(self):
+        self.assertEqual(len(self.index.search('boston', 2)), 2)
+
+    def test_reindex_and_remove(self):
+        self.index.add(1, [('jane', 3)])
+        self.assertEqual(self.index.search('john', 10), [2, 3])
+        self.assertEqual(self.index.search('hiking', 10), [])
+
+        self.index.remove(2)
+        self.assertEqual(self.index.search('johnny', 10), [])
+        self.assertNotIn('johnny', self.index.vocabulary)
+        self.assertEqual(len(self.index), 2)
+
+    def test_escape_like(self):
+        self.assertEqual(escape_like('50%_off'), '50\\%\\_off')
+
+if __name__ == '__main__':
+    unittest.main()
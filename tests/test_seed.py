@@ -0,0 +1,78 @@
+import csv
+import os
+import tempfile
+import unittest
+from datetime import datetime
+from sqlalchemy import func, select
+from app import create_app
+from bulkload import bulk_load
+from models import db, Follows, Message, TimelineEntry, User
+from seed import orm_load
+
+USERS = [(f'user{n}@example.com', f'user{n}', '/static/images/default-pic.png', 'x', '', '', '')
+         for n in (1, 2, 3)]
+# id, text, timestamp, user_id
+MESSAGES = [
+    (1000, 'first', '2024-01-01 10:00:00.000001', 1),
+    (1001, 'second', '2024-01-01 11:00:00', 1),
+    (1002, 'third', '2024-01-02 09:30:00', 2),
+    (1003, 'fourth', '2024-01-03 08:00:00', 3),
+]
+# followed, follower
+FOLLOWS = [(1, 2), (1, 3), (2, 3)]
+
+class SeedTestCase(unittest.TestCase):
+    '''Loads a few hand-written CSVs into a SQLite file both ways'''
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        for name, headers, rows in (
+            ('users', ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location'], USERS),
+            ('messages', ['id', 'text', 'timestamp', 'user_id'], MESSAGES),
+            ('follows', ['user_being_followed_id', 'user_following_id'], FOLLOWS),
+        ):
+            with open(self.path(f'{name}.csv'), 'w', newline='') as out:
+                writer = csv.writer(out)
+                writer.writerow(headers)
+                writer.writerows(rows)
+
+        self.app = create_app('test', SQLALCHEMY_DATABASE_URI='sqlite:///' + self.path('warbler.db'))
+        self.context = self.app.app_context()
+        self.context.push()
+
+    def tearDown(self):
+        db.session.remove()
+        db.engine.dispose()
+        self.context.pop()
+        self.directory.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.directory.name, name)
+
+    def assertLoaded(self):
+        counts = {user.id: (user.messages_count, user.followers_count, user.following_count)
+                  for user in User.query}
+        self.assertEqual(counts, {1: (2, 2, 0), 2: (1, 1, 1), 3: (1, 0, 2)})
+
+        # Each user sees their own messages plus those of everyone they follow
+        timelines = dict(db.session.execute(
+            select(TimelineEntry.user_id, func.count()).group_by(TimelineEntry.user_id)
+        ).all())
+        self.assertEqual(timelines, {1: 2, 2: 3, 3: 4})
+
+        first = db.session.get(Message, 1000)
+        self.assertEqual(first.timestamp, datetime(2024, 1, 1, 10, 0, 0, 1))
+
+    def test_orm_load(self):
+        orm_load(self.directory.name)
+        self.assertLoaded()
+
+    def test_bulk_load(self):
+        bulk_load([(User, self.path('users.csv')),
+                   (Message, self.path('messages.csv')),
+                   (Follows, self.path('follows.csv'))], chunk_size=2)
+        db.session.remove()
+        self.assertLoaded()
+
+if __name__ == '__main__':
+    unittest.main()
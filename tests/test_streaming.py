@@ -0,0 +1,99 @@
+import unittest
+from flask import Flask, flash
+from jinja2 import DictLoader
+from sqlalchemy import create_engine, text
+from instrumentation import Instrumentation
+from querybudget import QueryBudget, QueryBudgetExceeded
+from streaming import buffered, stream_page
+
+engine = create_engine('sqlite://')
+
+class StreamingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.secret_key = 'streaming'
+        self.app.config['STREAM_BUFFER_SIZE'] = 20
+        self.app.jinja_loader = DictLoader({
+            'list.html': '{% for m in get_flashed_messages() %}<b>{{ m }}</b>{% endfor %}'
+                         '{% for item in items %}<li>{{ item }}</li>{% endfor %}'
+        })
+        self.rendered = []
+
+        def items():
+            for number in range(10):
+                self.rendered.append(number)
+                yield number
+
+        @self.app.route('/flash')
+        def add_flash():
+            flash('hello')
+            return ''
+
+        @self.app.route('/list')
+        def show_list():
+            return stream_page('list.html', items=items())
+
+    def test_buffered(self):
+        self.assertEqual(list(buffered(['ab', 'c', 'de', 'f'], 3)), ['abc', 'def'])
+        self.assertEqual(list(buffered(['abcd', 'e'], 3)), ['abcd', 'e'])
+        self.assertEqual(list(buffered([], 3)), [])
+
+    def test_renders_while_sending(self):
+        client = self.app.test_client()
+        response = client.get('/list', buffered=False)
+
+        self.assertTrue(response.is_streamed)
+        first = next(response.response)
+        self.assertGreaterEqual(len(first), 20)
+        self.assertLess(len(self.rendered), 10)
+
+        body = first + b''.join(response.response)
+        self.assertEqual(body.decode(), ''.join(f'<li>{number}</li>' for number in range(10)))
+        response.close()
+
+    def test_flashes_are_consumed(self):
+        client = self.app.test_client()
+        client.get('/flash')
+        self.assertIn('<b>hello</b>', client.get('/list').get_data(as_text=True))
+
+        with client.session_transaction() as cookie:
+            self.assertNotIn('_flashes', cookie)
+        self.assertNotIn('hello', client.get('/list').get_data(as_text=True))
+
+class StreamedRequestTestCase(unittest.TestCase):
+    '''Statements run while the body is sent count towards the request'''
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config['STREAM_BUFFER_SIZE'] = 20
+        self.app.config['QUERY_BUDGET'] = 5
+        self.app.jinja_loader = DictLoader({'list.html': '{% for item in items %}<li>{{ item }}</li>{% endfor %}'})
+        Instrumentation(self.app)
+        QueryBudget(self.app)
+
+        def items(count):
+            with engine.connect() as conn:
+                for number in range(count):
+                    yield conn.execute(text(f'SELECT {number}')).scalar()
+
+        @self.app.route('/list/<int:count>')
+        def show_list(count):
+            return stream_page('list.html', items=items(count))
+
+    def test_log_line_counts_body_statements(self):
+        client = self.app.test_client()
+        with self.assertLogs('instrumentation', level='INFO') as logs:
+            response = client.get('/list/4')
+            self.assertEqual(logs.output, [])
+            response.get_data()
+        self.assertIn('"db_statements": 4', logs.output[0])
+
+    def test_budget_covers_body(self):
+        self.app.config['TESTING'] = True
+        client = self.app.test_client()
+        with self.assertRaises(QueryBudgetExceeded):
+            client.get('/list/6').get_data()
+
+if __name__ == '__main__':
+    unittest.main()
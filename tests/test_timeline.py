@@ -0,0 +1,125 @@
+from unittest import TestCase
+from app import create_app, db
+from models import User, Message, Follows, TimelineEntry
+import timeline
+import counters
+from jobs import FINISHED
+
+app = create_app('test')
+
+class TimelineTestCase(TestCase):
+    def setUp(self):
+        """Set up two users where reader follows author"""
+        self.context = app.app_context()
+        self.context.push()
+        db.drop_all()
+        db.create_all()
+
+        author = User(username='author', email='author@example.com', password='password')
+        reader = User(username='reader', email='reader@example.com', password='password')
+        db.session.add_all([author, reader])
+        db.session.commit()
+
+        db.session.add(Follows(user_being_followed_id=author.id, user_following_id=reader.id))
+        counters.followed(reader.id, author.id)
+        db.session.commit()
+
+        self.author = author
+        self.reader = reader
+
+    def tearDown(self):
+        """Clean up the test environment"""
+        app.config['TIMELINE_FANOUT_CAP'] = timeline.DEFAULT_FANOUT_CAP
+        app.config['TIMELINE_BACKFILL_LIMIT'] = timeline.DEFAULT_BACKFILL_LIMIT
+        db.session.rollback()
+        db.drop_all()
+        self.context.pop()
+
+    def post(self, text):
+        message = Message(text=text, user_id=self.author.id)
+        db.session.add(message)
+        db.session.flush()
+        timeline.fan_out_message(message)
+        db.session.commit()
+        return message
+
+    def test_fan_out_reaches_followers(self):
+        """Test a new message lands in the author's and follower's timelines"""
+        message = self.post('Hello followers')
+
+        self.assertIn(message, timeline.home_timeline(self.reader))
+        self.assertIn(message, timeline.home_timeline(self.author))
+
+    def test_prune_and_backfill(self):
+        """Test unfollowing prunes and re-following backfills the timeline"""
+        message = self.post('Hello followers')
+
+        timeline.prune_follow(self.reader.id, self.author.id)
+        db.session.commit()
+        self.assertNotIn(message, timeline.home_timeline(self.reader))
+
+        timeline.backfill_follow(self.reader.id, self.author.id)
+        db.session.commit()
+        self.assertIn(message, timeline.home_timeline(self.reader))
+
+    def test_pull_authors_over_cap(self):
+        """Test authors over the fan-out cap are merged in at read time"""
+        app.config['TIMELINE_FANOUT_CAP'] = 0
+        message = self.post('Too popular to fan out')
+
+        self.assertEqual(timeline.pull_authors(self.reader.id), [self.author.id])
+        self.assertIn(message, timeline.home_timeline(self.reader))
+
+    def test_back_under_cap_fans_out(self):
+        """Test messages posted over the cap stay in the feed once the author drops back to it"""
+        app.config['TIMELINE_FANOUT_CAP'] = 0
+        message = self.post('Posted while popular')
+
+        app.config['TIMELINE_FANOUT_CAP'] = 1
+        timeline.settle_authors([self.author.id])
+        db.session.commit()
+        self.assertEqual(timeline.pending_settles(), [self.author.id])
+
+        self.assertEqual(timeline.run_settle(self.author.id), FINISHED)
+        self.assertEqual(timeline.pending_settles(), [])
+        self.assertEqual(timeline.pull_authors(self.reader.id), [])
+        self.assertIn(message, timeline.home_timeline(self.reader))
+
+        # Settling again does not deliver the message twice
+        timeline.settle_authors([self.author.id])
+        db.session.commit()
+        timeline.run_settle(self.author.id)
+        self.assertEqual(timeline.home_ids(self.reader.id), [message.id])
+
+    def test_settle_dropped_when_pulled_again(self):
+        """Test a settle job is dropped if the author is back over the cap before it runs"""
+        app.config['TIMELINE_FANOUT_CAP'] = 0
+        message = self.post('Posted while popular')
+
+        app.config['TIMELINE_FANOUT_CAP'] = 1
+        timeline.settle_authors([self.author.id])
+        db.session.commit()
+
+        app.config['TIMELINE_FANOUT_CAP'] = 0
+        self.assertEqual(timeline.run_settle(self.author.id), FINISHED)
+        self.assertEqual(timeline.pending_settles(), [])
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=self.reader.id).count(), 0)
+        self.assertIn(message, timeline.home_timeline(self.reader))
+
+    def test_rebuild_caps_each_author(self):
+        """Test a rebuild gives followers only each author's newest messages, as a new follow does"""
+        older = self.post('Older')
+        newer = self.post('Newer')
+
+        app.config['TIMELINE_BACKFILL_LIMIT'] = 1
+        timeline.rebuild_timelines()
+        db.session.commit()
+
+        self.assertEqual(timeline.home_ids(self.reader.id), [newer.id])
+        self.assertEqual(timeline.home_ids(self.author.id), [newer.id, older.id])
+
+# Run the tests
+if __name__ == '__main__':
+    import unittest
+
+    unittest.main()
@@ -1,13 +1,15 @@
 import unittest
-from app import app, db, User
+from app import create_app, db, User
+
+app = create_app('test')
 
 # Define a test class for the User model
 class UserModelTestCase(unittest.TestCase):
     
     def setUp(self):
-        # Configure the app for testing
-        app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///warbler_db'
-        app.config['TESTING'] = True
+        # Work inside the test app
+        self.context = app.app_context()
+        self.context.push()
         self.app = app.test_client()
         
         # Create the database and tables
@@ -16,6 +18,7 @@ class UserModelTestCase(unittest.TestCase):
     def tearDown(self):
         # Remove the database and tables
         db.drop_all()
+        self.context.pop()
     
     def test_repr_method(self):
         # Create a test user
@@ -1,12 +1,14 @@
 import unittest
-from app import app, db, User
+from app import create_app, db, User
+
+app = create_app('test')
 
 class UserViewsTestCase(unittest.TestCase):
     
     def setUp(self):
-        # Configure the app for testing
-        app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///warbler_db'
-        app.config['TESTING'] = True
+        # Work inside the test app
+        self.context = app.app_context()
+        self.context.push()
         self.app = app.test_client()
         
         # Create the database and tables
@@ -15,6 +17,7 @@ class UserViewsTestCase(unittest.TestCase):
     def tearDown(self):
         # Remove the database and tables
         db.drop_all()
+        self.context.pop()
     
     def test_register_route(self):
         # Send a POST request to the register route with valid data
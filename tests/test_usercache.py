@@ -0,0 +1,48 @@
+import unittest
+from usercache import LRUCache
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class LRUCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = LRUCache(maxsize=2, ttl=10, clock=self.clock)
+
+    def test_hit_and_miss(self):
+        self.cache.set(1, 'a')
+        self.assertEqual(self.cache.get(1), 'a')
+        self.assertIsNone(self.cache.get(2))
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertEqual(stats['hit_rate'], 0.5)
+
+    def test_evicts_least_recently_used(self):
+        self.cache.set(1, 'a')
+        self.cache.set(2, 'b')
+        self.cache.get(1)
+        self.cache.set(3, 'c')
+        self.assertIsNone(self.cache.get(2))
+        self.assertEqual(self.cache.get(1), 'a')
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_expires_after_ttl(self):
+        self.cache.set(1, 'a')
+        self.clock.now = 10
+        self.assertIsNone(self.cache.get(1))
+        self.assertEqual(self.cache.stats()['expirations'], 1)
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+    def test_delete(self):
+        self.cache.set(1, 'a')
+        self.cache.delete(1)
+        self.cache.delete(1)
+        self.assertIsNone(self.cache.get(1))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,378 @@
+'''Materialized home timelines.
+
+New messages are pushed (fanned out) into a ``timeline_entries`` row for every
+follower at write time, so reading the home feed is a bounded index scan over
+one user's entries instead of an ``IN (...)`` over everyone they follow.
+
+Accounts with more followers than ``TIMELINE_FANOUT_CAP`` are not fanned out;
+their messages are pulled at read time and merged into the feed instead. When
+an account drops back to the cap, ``settle_authors`` queues a settle job that
+fans its recent messages (``TIMELINE_BACKFILL_LIMIT`` of them, as for a new
+follow) out to every follower, since they are no longer pulled. That can be
+millions of rows, so it is not done in the unfollow request: the
+``TimelineSettler`` worker (see jobs.py) does it in the background,
+``TIMELINE_SETTLE_BATCH_SIZE`` followers per transaction, and drops the job if
+the author goes back over the cap first. ``flask settle-timelines`` runs every
+pending job in the foreground instead.
+'''
+
+import logging
+from datetime import datetime
+import click
+from flask import current_app, has_app_context
+from sqlalchemy import event, exists, func, literal, select, true, update
+from sqlalchemy.orm import Session, contains_eager, joinedload
+from models import db, Follows, Message, SettleJob, TimelineEntry, User
+from jobs import FAILED, FINISHED, SKIPPED, JobWorker
+from pagination import decode_message_cursor, make_page, message_key, messages_before
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FANOUT_CAP = 5000
+DEFAULT_BACKFILL_LIMIT = 100
+
+QUEUED_SETTLES = 'settled_author_ids'
+
+
+def fanout_cap():
+    '''Follower count above which an author is read with pull instead of push'''
+    return current_app.config.get('TIMELINE_FANOUT_CAP', DEFAULT_FANOUT_CAP)
+
+
+def backfill_limit():
+    '''How many of an author's newest messages a follower's timeline is filled with'''
+    return current_app.config.get('TIMELINE_BACKFILL_LIMIT', DEFAULT_BACKFILL_LIMIT)
+
+
+def follower_count(user_id):
+    '''Reads the denormalized follower count of a user'''
+    return db.session.scalar(select(User.followers_count).where(User.id == user_id)) or 0
+
+
+def is_pull_author(user_id):
+    '''True when the author has too many followers to fan out on write'''
+    return follower_count(user_id) > fanout_cap()
+
+
+def fan_out_message(message):
+    '''Delivers a new message to its author's timeline and to every follower.
+
+    The message must already be flushed so it has an id.
+    '''
+
+    db.session.add(TimelineEntry(
+        user_id=message.user_id,
+        message_id=message.id,
+        author_id=message.user_id
+    ))
+
+    if is_pull_author(message.user_id):
+        return
+
+    followers = (select(
+                    Follows.user_following_id,
+                    literal(message.id),
+                    literal(message.user_id))
+                 .where(Follows.user_being_followed_id == message.user_id))
+
+    db.session.execute(
+        TimelineEntry.__table__.insert().from_select(
+            ['user_id', 'message_id', 'author_id'], followers
+        )
+    )
+
+
+def backfill_follow(follower_id, followed_id):
+    '''Copies the followed user's recent messages into the follower's timeline'''
+
+    if is_pull_author(followed_id):
+        return
+
+    recent = (select(
+                literal(follower_id),
+                Message.id,
+                Message.user_id)
+              .where(Message.user_id == followed_id)
+              .order_by(Message.id.desc())
+              .limit(backfill_limit()))
+
+    db.session.execute(
+        TimelineEntry.__table__.insert().from_select(
+            ['user_id', 'message_id', 'author_id'], recent
+        )
+    )
+
+
+def settle_authors(author_ids):
+    '''Queues a settle job for each author whose follower count just dropped to the cap.
+
+    Call it after decrementing followers_count; the caller commits. Messages
+    posted while an author was pulled were never fanned out, and stop being
+    pulled now, so the worker fans the recent ones out to every follower.
+    '''
+
+    settled = db.session.scalars(
+        select(User.id).where(User.id.in_(set(author_ids)), User.followers_count == fanout_cap())
+    ).all()
+
+    now = datetime.utcnow()
+    for author_id in settled:
+        # merge: dropping to the cap again restarts an unfinished job from the first follower
+        db.session.merge(SettleJob(author_id=author_id, after_follower_id=0, attempts=0, last_error=None,
+                                   created_at=now))
+    db.session.info.setdefault(QUEUED_SETTLES, set()).update(settled)
+
+
+def deliver_recent(author_id, follower_ids):
+    '''Fans the author's recent messages out to the given followers, skipping ones already delivered'''
+
+    recent = (select(Message.id)
+              .where(Message.user_id == author_id)
+              .order_by(Message.id.desc())
+              .limit(backfill_limit())
+              .subquery())
+    delivered = exists().where(TimelineEntry.user_id == Follows.user_following_id,
+                               TimelineEntry.message_id == recent.c.id)
+    missing = (select(
+                    Follows.user_following_id,
+                    recent.c.id,
+                    literal(author_id))
+               .join(recent, true())
+               .where(Follows.user_being_followed_id == author_id,
+                      Follows.user_following_id.in_(follower_ids),
+                      ~delivered))
+
+    db.session.execute(
+        TimelineEntry.__table__.insert().from_select(
+            ['user_id', 'message_id', 'author_id'], missing
+        )
+    )
+
+
+def settle_batch(author_id, limit):
+    '''Settles the author for the next limit followers; returns True while there are more.
+
+    Returns False once the job is done, and None when another worker holds it.
+    '''
+
+    job = (SettleJob
+           .query
+           .filter_by(author_id=author_id)
+           .with_for_update(skip_locked=True)
+           .first())
+    if job is None:
+        pending = db.session.scalar(select(SettleJob.author_id).where(SettleJob.author_id == author_id))
+        db.session.rollback()
+        return None if pending is not None else False
+
+    author = db.session.execute(
+        select(User.followers_count, User.deleted_at).where(User.id == author_id)
+    ).first()
+    # Pulled again, or deleted: nothing to fan out
+    if author is None or author.deleted_at is not None or author.followers_count > fanout_cap():
+        db.session.delete(job)
+        db.session.commit()
+        return False
+
+    followers = db.session.scalars(
+        select(Follows.user_following_id)
+        .where(Follows.user_being_followed_id == author_id, Follows.user_following_id > job.after_follower_id)
+        .order_by(Follows.user_following_id)
+        .limit(limit)
+    ).all()
+    if followers:
+        deliver_recent(author_id, followers)
+        job.after_follower_id = followers[-1]
+    more = len(followers) == limit
+    if not more:
+        db.session.delete(job)
+    db.session.commit()
+    return more
+
+
+def run_settle(author_id, limit=None):
+    '''Settles an author batch by batch, recording failures on the job.
+
+    Returns FINISHED, SKIPPED when another worker holds the job, or FAILED.
+    '''
+
+    limit = limit or current_app.config['TIMELINE_SETTLE_BATCH_SIZE']
+    try:
+        more = True
+        while more:
+            more = settle_batch(author_id, limit)
+    except Exception as error:
+        db.session.rollback()
+        logger.exception('Settling author %s failed', author_id)
+        db.session.execute(
+            update(SettleJob)
+            .where(SettleJob.author_id == author_id)
+            .values(attempts=SettleJob.attempts + 1, last_error=str(error)[:1000])
+        )
+        db.session.commit()
+        return FAILED
+    return SKIPPED if more is None else FINISHED
+
+
+def pending_settles():
+    return db.session.scalars(select(SettleJob.author_id).order_by(SettleJob.created_at)).all()
+
+
+class TimelineSettler(JobWorker):
+    '''Flask extension running settle jobs on a background thread'''
+
+    settings = 'TIMELINE_SETTLE'
+    extension = 'timeline_settler'
+    thread_name = 'timeline-settler'
+
+    def init_app(self, app):
+        # Followers per transaction; each gets up to TIMELINE_BACKFILL_LIMIT rows
+        app.config.setdefault('TIMELINE_SETTLE_BATCH_SIZE', 50)
+        super().init_app(app)
+        app.cli.add_command(settle_timelines_command)
+        if not event.contains(Session, 'after_commit', _enqueue_settles):
+            event.listen(Session, 'after_rollback', _discard_settles)
+            event.listen(Session, 'after_commit', _enqueue_settles)
+
+    def pending_jobs(self):
+        return pending_settles()
+
+    def run_job(self, author_id):
+        return run_settle(author_id)
+
+
+@click.command('settle-timelines')
+def settle_timelines_command():
+    '''Fans out the recent messages of every author still waiting to be settled'''
+
+    finished = current_app.extensions['timeline_settler'].run_pending()
+    click.echo(f'{finished} settle jobs finished')
+
+
+def _discard_settles(session):
+    session.info.pop(QUEUED_SETTLES, None)
+
+
+def _enqueue_settles(session):
+    settled = session.info.pop(QUEUED_SETTLES, ())
+    settler = current_app.extensions.get('timeline_settler') if has_app_context() else None
+    if settler is not None:
+        for author_id in settled:
+            settler.enqueue(author_id)
+
+
+def prune_follow(follower_id, followed_id):
+    '''Removes the unfollowed user's messages from the follower's timeline'''
+
+    (TimelineEntry
+        .query
+        .filter_by(user_id=follower_id, author_id=followed_id)
+        .delete(synchronize_session=False))
+
+
+def remove_message(message_id):
+    '''Removes a deleted message from every timeline it was delivered to'''
+
+    (TimelineEntry
+        .query
+        .filter_by(message_id=message_id)
+        .delete(synchronize_session=False))
+
+
+def pull_authors(user_id):
+    '''Ids of followed accounts whose messages are merged in at read time'''
+
+    return db.session.scalars(
+        select(Follows.user_being_followed_id)
+        .join(User, User.id == Follows.user_being_followed_id)
+        .where(
+            Follows.user_following_id == user_id,
+            User.followers_count > fanout_cap(),
+            User.deleted_at.is_(None)
+        )
+    ).all()
+
+
+def home_timeline(user, limit=100, before=None):
+    '''Returns the newest messages for a user's home feed, older than before if given'''
+
+    entries = (Message
+               .query
+               .join(TimelineEntry, TimelineEntry.message_id == Message.id)
+               .join(Message.user)
+               .filter(TimelineEntry.user_id == user.id, User.deleted_at.is_(None))
+               .options(contains_eager(Message.user)))
+    messages = (messages_before(entries, TimelineEntry.message_id, before)
+                .limit(limit)
+                .all()
+            )
+
+    authors = pull_authors(user.id)
+    if not authors:
+        return messages
+
+    pulled = Message.query.filter(Message.user_id.in_(authors)).options(joinedload(Message.user))
+    pulled = (messages_before(pulled, Message.id, before)
+              .limit(limit)
+              .all()
+            )
+
+    merged = {message.id: message for message in messages + pulled}
+    return sorted(merged.values(), key=message_key, reverse=True)[:limit]
+
+
+def home_page(user, cursor, per_page):
+    '''Returns one page of the home feed starting after cursor'''
+
+    rows = home_timeline(user, per_page + 1, decode_message_cursor(cursor))
+    return make_page(rows, per_page, message_key)
+
+
+def home_ids(user_id, limit=100, before=None):
+    '''Returns the message ids of a user's home feed, newest first, without loading messages'''
+
+    entries = (select(TimelineEntry.message_id)
+               .join(User, User.id == TimelineEntry.author_id)
+               .where(TimelineEntry.user_id == user_id, User.deleted_at.is_(None)))
+    ids = db.session.scalars(messages_before(entries, TimelineEntry.message_id, before).limit(limit)).all()
+
+    authors = pull_authors(user_id)
+    if authors:
+        pulled = select(Message.id).where(Message.user_id.in_(authors))
+        ids += db.session.scalars(messages_before(pulled, Message.id, before).limit(limit)).all()
+    return sorted(set(ids), reverse=True)[:limit]
+
+
+def rebuild_timelines():
+    '''Rebuilds every timeline from the messages and follows tables.
+
+    Each follower gets the ``TIMELINE_BACKFILL_LIMIT`` newest messages of each
+    author they follow, as a new follow would. Relies on the follower
+    counters, so run it after counters.recount_all().
+    '''
+
+    TimelineEntry.query.delete(synchronize_session=False)
+
+    columns = ['user_id', 'message_id', 'author_id']
+    own = select(Message.user_id, Message.id, Message.user_id)
+
+    pull = select(User.id).where(User.followers_count > fanout_cap())
+
+    # Every author's messages ranked newest first, once, rather than per follower
+    ranked = select(
+        Message.id,
+        Message.user_id,
+        func.row_number().over(partition_by=Message.user_id, order_by=Message.id.desc()).label('position')
+    ).subquery()
+
+    followed = (select(
+                    Follows.user_following_id,
+                    ranked.c.id,
+                    ranked.c.user_id)
+                .join(ranked, ranked.c.user_id == Follows.user_being_followed_id)
+                .where(ranked.c.position <= backfill_limit(),
+                       Follows.user_being_followed_id.not_in(pull)))
+
+    table = TimelineEntry.__table__
+    db.session.execute(table.insert().from_select(columns, own))
+    db.session.execute(table.insert().from_select(columns, followed))
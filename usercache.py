@@ -0,0 +1,166 @@
+'''Cache for the logged-in user.
+
+``add_user_to_g`` used to SELECT the session user on every request. Instead,
+the user's column values are kept in a bounded LRU with a TTL and turned back
+into a session-attached ``User`` without touching the database, so every
+lookup in the request shares that one instance.
+
+Entries are dropped after any commit that changed the user: ORM edits and
+deletes are seen in ``before_flush``, and counter bumps mark the user through
+``mark_changed``. Changes made by other processes are picked up after
+``USER_CACHE_TTL`` seconds.
+'''
+
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from flask import current_app, jsonify
+from sqlalchemy import event
+from sqlalchemy.orm import Session, make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
+from werkzeug.local import LocalProxy
+from models import db, User
+
+CHANGED_USERS = 'changed_user_ids'
+
+_caches = weakref.WeakSet()
+
+
+class LRUCache:
+    '''A bounded least-recently-used mapping whose entries expire after ttl seconds'''
+
+    def __init__(self, maxsize=1024, ttl=60, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires = entry
+            if expires <= self.clock():
+                del self.entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, self.clock() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+def mark_changed(user_id):
+    '''Drops the user from the cache once the current transaction commits'''
+    db.session.info.setdefault(CHANGED_USERS, set()).add(user_id)
+
+
+def _collect_changed(session, flush_context, instances):
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, User) and obj.id is not None:
+            session.info.setdefault(CHANGED_USERS, set()).add(obj.id)
+
+
+def _discard_changes(session):
+    session.info.pop(CHANGED_USERS, None)
+
+
+def _invalidate_changed(session):
+    for user_id in session.info.pop(CHANGED_USERS, ()):
+        for cache in _caches:
+            cache.invalidate(user_id)
+
+
+class UserCache:
+    '''Flask extension caching the session user's row across requests'''
+
+    def __init__(self, app=None):
+        self.cache = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('USER_CACHE_SIZE', 1024)
+        app.config.setdefault('USER_CACHE_TTL', 60)
+        self.cache = LRUCache(app.config['USER_CACHE_SIZE'], app.config['USER_CACHE_TTL'])
+        app.extensions['user_cache'] = self
+
+        _caches.add(self)
+        if not event.contains(Session, 'before_flush', _collect_changed):
+            event.listen(Session, 'before_flush', _collect_changed)
+            event.listen(Session, 'after_rollback', _discard_changes)
+            event.listen(Session, 'after_commit', _invalidate_changed)
+
+        app.add_url_rule('/_stats/user-cache', 'user_cache_stats', self.stats_view)
+
+    def load(self, user_id):
+        '''Returns the user attached to the current session, from cache when possible'''
+
+        key = identity_key(User, user_id)
+        user = db.session.identity_map.get(key)
+        if user is not None:
+            return user
+
+        values = self.cache.get(user_id)
+        if values is None:
+            user = db.session.get(User, user_id)
+            if user is not None:
+                self.cache.set(user_id, {column.key: getattr(user, column.key) for column in User.__mapper__.column_attrs})
+            return user
+
+        user = User(**values)
+        make_transient_to_detached(user)
+        db.session.add(user)
+        return user
+
+    def invalidate(self, user_id):
+        self.cache.delete(user_id)
+
+    def stats(self):
+        return self.cache.stats()
+
+    def stats_view(self):
+        '''Exposes cache counters in debug mode for sizing the cache'''
+
+        if not current_app.debug:
+            return ('', 404)
+        return jsonify(self.stats())
+
+
+# The current app's UserCache; create_app makes one per app
+user_cache = LocalProxy(lambda: current_app.extensions['user_cache'])